@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+'''
+Compares the cost of serializing responses of the interop service with lxml
+and with the direct emitter (Application.use_direct_emitter). The script's
+own directory is the first entry of sys.path, so from the root of the source
+tree, soaplib has to be put in the path explicitly unless it's installed:
+
+    PYTHONPATH=src python benchmarks/emitter.py
+'''
+
+import datetime
+import timeit
+
+from soaplib.service import MethodContext
+from soaplib.test.interop.server import _service
+
+size = 1000
+
+def measure(func):
+    '''Returns the cost of one call, in milliseconds.'''
+
+    return min(timeit.repeat(func, number=1, repeat=5)) * 1e3
+
+def make(cls, **kwargs):
+    retval = cls()
+    for k, v in kwargs.items():
+        setattr(retval, k, v)
+
+    return retval
+
+def nested_class(i):
+    return make(_service.NestedClass,
+        simple=[make(_service.SimpleClass, i=j, s='simple <%d>' % j)
+                                                           for j in range(3)],
+        s=u'nested \u00e7 %d' % i, i=i, f=i * 0.5,
+        other=make(_service.OtherClass, dt=datetime.datetime(2010, 1, 1),
+                                                          d=i * 1.5, b=True),
+        ai=range(5),
+    )
+
+def main():
+    app = _service.application
+
+    cases = (
+        (_service.InteropArray, 'echo_integer_array', range(size * 10)),
+        (_service.InteropArray, 'echo_string_array',
+                                 ['string & %d' % i for i in range(size * 10)]),
+        (_service.InteropClass, 'echo_simple_class_array',
+            [make(_service.SimpleClass, i=i, s='s%d' % i)
+                                                       for i in range(size)]),
+        (_service.InteropClass, 'echo_nested_class_array',
+                                         [nested_class(i) for i in range(size)]),
+        (_service.InteropClass, 'echo_extension_class',
+            make(_service.ExtensionClass, s='e', q=1, ai=range(size * 10),
+                p=make(_service.NonNillableClass, i=1, s='x',
+                                           dt=datetime.datetime(2010, 1, 1)))),
+    )
+
+    print '%-32s %10s %10s' % ('', 'lxml', 'direct')
+
+    for service_class, method_name, value in cases:
+        srv = service_class()
+        ctx = MethodContext(srv)
+        ctx.descriptor = srv.get_method(method_name)
+
+        def serialize(use_direct_emitter):
+            app.use_direct_emitter = use_direct_emitter
+            return app.serialize_soap(ctx, value)
+
+        assert serialize(False) == serialize(True)
+
+        print '%-32s %10.2f %10.2f' % (method_name,
+                                    measure(lambda: serialize(False)),
+                                    measure(lambda: serialize(True)))
+
+    print '(milliseconds per response)'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+'''
+Compares ClassSerializer instances whose members are stored in slots, which
+is the default, with instances that store them in a __dict__ and go through
+NonExtendingClass.__setattr__, as they used to: memory per instance, and the
+cost of building and deserializing them. From the root of the source tree:
+
+    PYTHONPATH=src python benchmarks/instances.py
+'''
+
+import sys
+import timeit
+
+from lxml import etree
+
+from soaplib.serializers.clazz import Array
+from soaplib.serializers.clazz import ClassSerializer
+from soaplib.serializers.clazz import NonExtendingClass
+from soaplib.serializers.primitive import DateTime
+from soaplib.serializers.primitive import Float
+from soaplib.serializers.primitive import Integer
+from soaplib.serializers.primitive import String
+from soaplib.serializers.target import PayloadTarget
+
+size = 20000
+
+class Record(ClassSerializer):
+    id = Integer
+    name = String
+    email = String
+    created = DateTime
+    score = Float
+    status = String
+
+class DictRecord(ClassSerializer):
+    __slots__ = ('__dict__', '__weakref__')
+    __setattr__ = NonExtendingClass.__setattr__
+
+    id = Integer
+    name = String
+    email = String
+    created = DateTime
+    score = Float
+    status = String
+
+def measure(func):
+    '''Returns the cost of one call, in milliseconds.'''
+
+    return min(timeit.repeat(func, number=1, repeat=3)) * 1e3
+
+def instance_size(inst):
+    retval = sys.getsizeof(inst)
+
+    if hasattr(inst, '__dict__'):
+        retval += sys.getsizeof(inst.__dict__)
+
+    return retval
+
+def make_document(cls):
+    array = Array(cls)
+    array.resolve_namespace(array, 'tns')
+
+    values = []
+    for i in range(size):
+        inst = cls()
+        inst.id = i
+        inst.name = 'name %d' % i
+        inst.email = 'user%d@example.com' % i
+        inst.score = i * 0.5
+        inst.status = 'active'
+        values.append(inst)
+
+    parent = etree.Element('parent')
+    array.to_xml(values, 'tns', parent)
+
+    return array, etree.tostring(parent[0])
+
+def main():
+    print '%d records' % size
+    print '%-24s %12s %12s' % ('', 'dict', 'slots')
+
+    print '%-24s %12d %12d' % ('bytes per instance',
+                    instance_size(DictRecord()), instance_size(Record()))
+
+    print '%-24s %12.2f %12.2f' % ('construction (ms)',
+                    measure(lambda: [DictRecord() for i in xrange(size)]),
+                    measure(lambda: [Record() for i in xrange(size)]))
+
+    results = []
+    for cls in (DictRecord, Record):
+        array, data = make_document(cls)
+        element = etree.fromstring(data)
+
+        def parse():
+            parser = etree.XMLParser(target=PayloadTarget(array))
+            parser.feed(data)
+            return parser.close()
+
+        assert parse()[-1].name == 'name %d' % (size - 1)
+
+        results.append((measure(lambda: array.from_xml(element)),
+                                                              measure(parse)))
+
+    print '%-24s %12.2f %12.2f' % ('from_xml (ms)', results[0][0],
+                                                               results[1][0])
+    print '%-24s %12.2f %12.2f' % ('PayloadTarget (ms)', results[0][1],
+                                                               results[1][1])
+
+if __name__ == '__main__':
+    main()
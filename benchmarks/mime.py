@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+'''
+Measures the cost of parsing MTOM requests with 1, 10 and 100 attachments,
+with the email package based parser soaplib used to have, with split_mtom
+and with the streaming parser. From the root of the source tree, or without
+PYTHONPATH when soaplib is installed:
+
+    PYTHONPATH=src python benchmarks/mime.py
+'''
+
+import cgi
+import os
+import timeit
+
+from base64 import b64encode
+from email import message_from_string
+from StringIO import StringIO
+
+import soaplib
+
+from soaplib.mime import join_attachment
+from soaplib.mime import parse_mtom
+from soaplib.mime import split_mtom
+
+boundary = 'MIME_boundary'
+content_type = cgi.parse_header('multipart/related; '
+        'type="application/xop+xml"; boundary="%s"; start="<root>"' % boundary)
+attachment_size = 64 * 1024
+
+def make_message(count):
+    includes = ''.join(['<tns:data><xop:Include href="cid:a%d"/></tns:data>'
+                                                      % i for i in range(count)])
+    envelope = ('<senv:Envelope xmlns:senv="%s" xmlns:xop="%s" '
+                'xmlns:tns="tns"><senv:Body><tns:upload>%s</tns:upload>'
+                '</senv:Body></senv:Envelope>' % (soaplib.ns_soap_env,
+                                                      soaplib.ns_xop, includes))
+    data = os.urandom(attachment_size)
+
+    parts = ['--%s\r\nContent-ID: <root>\r\n\r\n%s\r\n' % (boundary, envelope)]
+    for i in range(count):
+        parts.append('--%s\r\nContent-ID: <a%d>\r\n'
+                     'Content-Transfer-Encoding: binary\r\n\r\n%s\r\n' %
+                                                         (boundary, i, data))
+    parts.append('--%s--\r\n' % boundary)
+
+    return ''.join(parts)
+
+def email_collapse_swa(content_type, envelope):
+    '''The email package based implementation of collapse_swa.'''
+
+    msg = message_from_string('\r\n'.join([
+        "MIME-Version: 1.0",
+        "Content-Type: %s; boundary=\"%s\"" % (content_type[0], boundary),
+        "",
+        envelope
+    ]))
+
+    soapmsg = None
+    for part in msg.walk():
+        if part.get_content_maintype() == 'multipart':
+            continue
+
+        if part.get('Content-ID') == '<root>':
+            soapmsg = part.get_payload()
+            continue
+
+        cid = part.get("Content-ID").strip("<>")
+        soapmsg, numreplaces = join_attachment(cid, soapmsg,
+                                                 b64encode(part.get_payload()))
+
+    return soapmsg
+
+def measure(func):
+    '''Returns the cost of one call, in milliseconds.'''
+
+    return min(timeit.repeat(func, number=1, repeat=3)) * 1e3
+
+def main():
+    print '%-12s %12s %12s %12s' % ('attachments', 'email', 'split_mtom',
+                                                               'parse_mtom')
+
+    for count in (1, 10, 100):
+        message = make_message(count)
+
+        def stream():
+            envelope, attachments = parse_mtom(content_type, StringIO(message))
+            for f in attachments.values():
+                f.close()
+
+        print '%-12d %12.2f %12.2f %12.2f' % (count,
+                measure(lambda: email_collapse_swa(content_type, message)),
+                measure(lambda: split_mtom(content_type, message)),
+                measure(stream))
+
+    print '(%d bytes per attachment, times in ms)' % attachment_size
+
+if __name__ == '__main__':
+    main()
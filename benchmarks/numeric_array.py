@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+'''
+Measures the cost of encoding and decoding large arrays of primitives, in
+bulk and one item at a time. From the root of the source tree:
+
+    PYTHONPATH=src python benchmarks/numeric_array.py
+'''
+
+import array
+import timeit
+
+from lxml import etree
+
+from soaplib.serializers.clazz import Array
+from soaplib.serializers.primitive import Double
+from soaplib.serializers.primitive import Integer
+
+ns = 'benchmark'
+size = 100000
+
+def measure(func):
+    '''Returns the cost of one call, in milliseconds.'''
+
+    return min(timeit.repeat(func, number=1, repeat=3)) * 1e3
+
+def main():
+    print '%-32s %10s %10s' % ('', 'encode', 'decode')
+
+    for serializer, typecode, values in (
+                (Double, 'd', [i * 1.25 for i in range(size)]),
+                (Integer, 'l', range(size)),
+            ):
+        list_array = Array(serializer)
+        list_array.resolve_namespace(list_array, ns)
+
+        typed_array = Array(serializer, typecode=typecode)
+        typed_array.resolve_namespace(typed_array, ns)
+
+        parent = etree.Element('{%s}parent' % ns)
+        list_array.to_xml(values, ns, parent)
+        element = parent[0]
+
+        def per_item():
+            parent = etree.Element('{%s}parent' % ns)
+            list_array.get_members(
+                   list_array.get_serialization_instance(values),
+                   etree.SubElement(parent, '{%s}array' % ns))
+
+        def per_item_decode():
+            [serializer.from_xml(child) for child in element]
+
+        print '%-32s %10.2f %10.2f' % ('%s per item' % serializer.__name__,
+                                 measure(per_item), measure(per_item_decode))
+
+        def bulk():
+            list_array.to_xml(values, ns, etree.Element('{%s}parent' % ns))
+
+        print '%-32s %10.2f %10.2f' % ('%s bulk' % serializer.__name__,
+                    measure(bulk), measure(lambda: list_array.from_xml(element)))
+
+        typed_values = array.array(typecode, values)
+        def typed():
+            typed_array.to_xml(typed_values, ns,
+                                            etree.Element('{%s}parent' % ns))
+
+        print '%-32s %10.2f %10.2f' % ('%s bulk array.array' %
+                serializer.__name__, measure(typed),
+                measure(lambda: typed_array.from_xml(element)))
+
+    print '(%d items)' % size
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+'''
+Measures the per-value cost of encoding and decoding primitives, on their own
+and as members of a ClassSerializer. From the root of the source tree:
+
+    PYTHONPATH=src python benchmarks/primitive.py
+
+These are the costs, in microseconds, of the serializers as they were before
+they were moved to to_string/from_string codecs, and after that (py2.7, best
+of 3, on a noisy machine):
+
+                          encode before/after  decode before/after
+    Integer                   4.6 / 3.4            1.9 / 1.9
+    Date                      4.2 / 2.4            6.1 / 3.7
+    DateTime (local)          4.9 / 4.6           11.5 / 5.6
+    DateTime (offset)             -               15.9 / 7.9
+    Record (7 members)       37.0 / 22.5          70.1 / 61.8
+'''
+
+import datetime
+import decimal
+import timeit
+
+from lxml import etree
+
+from soaplib.serializers.clazz import ClassSerializer
+from soaplib.serializers.primitive import Boolean
+from soaplib.serializers.primitive import Date
+from soaplib.serializers.primitive import DateTime
+from soaplib.serializers.primitive import Decimal
+from soaplib.serializers.primitive import Double
+from soaplib.serializers.primitive import Integer
+from soaplib.serializers.primitive import String
+
+ns = 'benchmark'
+number = 20000
+
+values = [
+    (Integer, 1234567),
+    (Decimal, decimal.Decimal('1234.5678')),
+    (Double, 1234.5678),
+    (Boolean, True),
+    (Date, datetime.date(2010, 5, 17)),
+    (DateTime, datetime.datetime(2010, 5, 17, 13, 40, 44, 3000)),
+    (String, 'some string'),
+]
+
+datetime_values = [
+    ('utc', '2010-05-17T13:40:44.003Z'),
+    ('offset', '2010-05-17T13:40:44.003+02:00'),
+    ('local', '2010-05-17T13:40:44.003'),
+]
+
+class Record(ClassSerializer):
+    i = Integer
+    d = Decimal
+    f = Double
+    b = Boolean
+    day = Date
+    dt = DateTime
+    s = String
+
+def measure(stmt):
+    '''Returns the cost of one call, in microseconds.'''
+
+    return min(timeit.repeat(stmt, number=number, repeat=3)) / number * 1e6
+
+def main():
+    print '%-24s %10s %10s' % ('', 'encode', 'decode')
+
+    for serializer, value in values:
+        def encode():
+            serializer.to_xml(value, ns, parent)
+
+        parent = etree.Element('parent')
+        serializer.to_xml(value, ns, parent)
+        element = parent[0]
+
+        def decode():
+            serializer.from_xml(element)
+
+        parent = etree.Element('parent')
+        print '%-24s %10.2f %10.2f' % (serializer.__name__, measure(encode),
+                                                             measure(decode))
+
+    for kind, text in datetime_values:
+        element = etree.Element('e')
+        element.text = text
+
+        print '%-24s %10s %10.2f' % ('DateTime (%s)' % kind, '',
+                                measure(lambda: DateTime.from_xml(element)))
+
+    record = Record()
+    record.i = 1234567
+    record.d = decimal.Decimal('1234.5678')
+    record.f = 1234.5678
+    record.b = True
+    record.day = datetime.date(2010, 5, 17)
+    record.dt = datetime.datetime(2010, 5, 17, 13, 40, 44, 3000)
+    record.s = 'some string'
+
+    parent = etree.Element('parent')
+    Record.to_xml(record, ns, parent)
+    element = parent[0]
+
+    def encode():
+        Record.to_xml(record, ns, etree.Element('parent'))
+
+    def decode():
+        Record.from_xml(element)
+
+    print '%-24s %10.2f %10.2f' % ('Record (7 members)', measure(encode),
+                                                             measure(decode))
+
+if __name__ == '__main__':
+    main()
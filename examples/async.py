@@ -18,36 +18,27 @@
 #
 
 import time
-from threading import Thread
-
 
 from soaplib.service import rpc, DefinitionBase
 from soaplib.serializers.primitive import String, Integer
-from soaplib.util import get_callback_info
+from soaplib.util.worker import AsyncEngine
 from soaplib.wsgi import Application
 
-
 '''
 This is a very simple async service that sleeps for a specified
-number of seconds and then call back the caller with a message.
-This kicks off a new Thread for each request, which is not recommended
-for a real-world application.  Soaplib does not provide any thread
-management or scheduling mechanism, the service is responsible for the
-execution of the async. process.
+number of seconds and then calls back the caller with a message.
+The request is acknowledged right away with a '202 Accepted' response. The
+method is run by one of the worker threads of the AsyncEngine, and its return
+value is sent to the ReplyTo address of the request as a call to the woke_up
+callback, with a RelatesTo header that contains the MessageID of the request.
 '''
 
 class SleepingService(DefinitionBase):
-    @rpc(Integer, _is_async=True)
+    @rpc(Integer, _is_async=True, _callback='woke_up')
     def sleep(self, seconds):
-        msgid, replyto = get_callback_info()
-
-        def run():
-            time.sleep(seconds)
-
-            client = make_service_client(replyto, self)
-            client.woke_up('good morning', msgid=msgid)
+        time.sleep(seconds)
 
-        Thread(target=run).start()
+        return 'good morning'
 
     @rpc(String, _is_callback=True)
     def woke_up(self, message):
@@ -56,7 +47,9 @@ class SleepingService(DefinitionBase):
 if __name__=='__main__':
     try:
         from wsgiref.simple_server import make_server
-        server = make_server('localhost', 7789, Application([SleepingService], "tns"))
+        engine = AsyncEngine(workers=4, max_pending=100)
+        server = make_server('localhost', 7789,
+                Application([SleepingService], "tns", async_engine=engine))
         server.serve_forever()
     except ImportError:
         print "Error: example server code requires Python >= 2.5"
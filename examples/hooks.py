@@ -20,9 +20,10 @@
 from time import time
 
 from soaplib.service import rpc
-from soaplib.serializers.primitive import String, Integer, Array
-from soaplib.wsgi_soap import request
-from soaplib.wsgi_soap import SimpleWSGIApp
+from soaplib.service import DefinitionBase
+from soaplib.serializers.primitive import String, Integer
+from soaplib.serializers.clazz import Array
+from soaplib.wsgi import Application
 
 '''
 This example is an enhanced version of the HelloWorld example that
@@ -35,47 +36,53 @@ available hooks are:
     * on_call
     * on_wsdl
     * on_wsdl_exception
-    * on_method_exec
-    * on_results
-    * on_exception
+    * on_method_call
+    * on_method_return
+    * on_method_exception_object
+    * on_method_exception_xml
     * on_return
 
 These method can be used to easily apply cross-cutting functionality
 accross all methods in the service to do things like database transaction
-management, logging and measuring performance.  This example also
-employs the threadlocal request (soaplib.wsgi_soap.request) object
-to hold the data points for this request.
+management, logging and measuring performance. All hooks that are called
+during the processing of a soap call get the MethodContext of that call as
+their first argument. This example uses its udc (user defined context)
+attribute to hold the data points for this request.
 '''
 
+class CallTimes(object):
+    def __init__(self, call_start):
+        self.call_start = call_start
+        self.method_start = None
+        self.method_end = None
 
-class HelloWorldService(SimpleWSGIApp):
-
+class HelloWorldService(DefinitionBase):
     @rpc(String, Integer, _returns=Array(String))
     def say_hello(self, name, times):
         results = []
-        raise Exception("this is some crazy crap")
         for i in range(0, times):
             results.append('Hello, %s' % name)
         return results
 
-    def on_call(self, environ):
-        request.additional['call_start'] = time()
+    def on_method_call(self, ctx, environ, method_name, py_params,
+                                                                   soap_params):
+        ctx.udc = CallTimes(environ['call_start'])
+        ctx.udc.method_start = time()
 
-    def on_method_exec(self, environ, body, py_params, soap_params):
-        request.additional['method_start'] = time()
+    def on_method_return(self, ctx, environ, py_results, soap_results,
+                                                                 http_headers):
+        ctx.udc.method_end = time()
 
-    def on_results(self, environ, py_results, soap_results, http_headers):
-        request.additional['method_end'] = time()
+class HelloWorldApplication(Application):
+    def on_call(self, environ):
+        environ['call_start'] = time()
 
-    def on_return(self, environ, return_String):
-        call_start = request.additional['call_start']
+    def on_return(self, ctx, environ, http_headers, return_str):
         call_end = time()
-        method_start = request.additional['method_start']
-        method_end = request.additional['method_end']
 
         print 'Method took [%s] - total execution time[%s]'% (
-            method_end-method_start, call_end-call_start)
-
+            ctx.udc.method_end - ctx.udc.method_start,
+            call_end - ctx.udc.call_start)
 
 def make_client():
     from soaplib.client import make_service_client
@@ -85,7 +92,8 @@ def make_client():
 if __name__=='__main__':
     try:
         from wsgiref.simple_server import make_server
-        server = make_server('localhost', 7889, HelloWorldService())
+        server = make_server('localhost', 7889,
+                          HelloWorldApplication([HelloWorldService], 'tns'))
         server.serve_forever()
     except ImportError:
         print "Error: example server code requires Python >= 2.5"
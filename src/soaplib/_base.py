@@ -17,22 +17,44 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 #
 
+import hashlib
 import logging
 logger = logging.getLogger("soaplib._base")
 
-import shutil
-import tempfile
+import sys
+import threading
 import traceback
+import types
+import uuid
+
+from Queue import Empty
+from Queue import Queue
+
+from xml.sax.saxutils import escape as xml_escape
 
 from lxml import etree
 
 import soaplib
 
+from soaplib.serializers.binary import bind_attachments
+from soaplib.serializers.clazz import Array
+from soaplib.serializers.emitter import Emitter
+from soaplib.serializers.emitter import UnsupportedType
 from soaplib.serializers.exception import Fault
 from soaplib.serializers.primitive import string_encoding
+from soaplib.serializers.target import PayloadTarget
+from soaplib.util import create_relates_to_header
+from soaplib.util import get_callback_info
+from soaplib.util import normalize_url
+from soaplib.util.cache import LRUCache
+from soaplib.util.cache import SingleFlight
+from soaplib.util.cache import get_canonical_key
 from soaplib.util.odict import odict
 
+from soaplib.batch import BatchService
+from soaplib.soap import decode_soap
 from soaplib.soap import from_soap
+from soaplib.service import MethodContext
 
 HTTP_500 = '500 Internal server error'
 HTTP_200 = '200 OK'
@@ -129,25 +151,97 @@ class _SchemaEntries(object):
         schema_info = self.get_schema_info(cls.get_namespace_prefix(self.app))
         schema_info.types[cls.get_type_name()] = node
 
+# the endpoint address in the wsdl template, see Application.get_wsdl
+_WSDL_ADDRESS = 'soaplib-wsdl-endpoint-address'
+
+# service instance lifecycles, see Application.get_service
+SERVICE_PER_REQUEST = 'request'
+SERVICE_PER_THREAD = 'thread'
+SERVICE_SINGLETON = 'singleton'
+
 class Application(object):
     transport = None
-
-    def __init__(self, services, tns, name=None, _with_partnerlink=False):
+    stream_chunk_size = 64 * 1024
+    wsdl_cache_size = 32
+    batch_enabled = False
+    batch_workers = 1
+    attachment_spool_size = 1024 * 1024
+    use_parser_target = False
+    use_direct_emitter = False
+    response_cache = None
+
+    def __init__(self, services, tns, name=None, _with_partnerlink=False,
+                   service_lifecycle=SERVICE_PER_REQUEST, async_engine=None):
         '''
         @param A ServiceBase subclass that defines the exposed services.
+        @param service_lifecycle One of SERVICE_PER_REQUEST,
+               SERVICE_PER_THREAD or SERVICE_SINGLETON.
+        @param async_engine An soaplib.util.worker.AsyncEngine instance that
+               runs the asynchronous methods and delivers their callbacks.
+               When None, asynchronous methods are called like the others.
+
+        When batch_enabled is set, a 'batch' operation that calls several
+        operations in one request is added to the application. See
+        BatchService. When batch_workers is more than 1, the operations of a
+        batch are run in parallel by that many threads.
+
+        The attachments of multipart requests that are larger than
+        attachment_spool_size bytes are written to temporary files instead of
+        being kept in memory.
+
+        When use_parser_target is set, requests are deserialized while they
+        are parsed, by a soaplib.serializers.target.PayloadTarget, instead of
+        being parsed to an element tree first. ctx.body_xml is then None, and
+        validate_request is not called. Multiref requests are rejected.
+
+        When use_direct_emitter is set, responses are written as strings by a
+        soaplib.serializers.emitter.Emitter, instead of being built as element
+        trees first. The output is the same, but ctx.soap_body is then None.
+        Responses with types that the Emitter doesn't support are serialized
+        by lxml as usual.
+
+        response_cache is the cache of the methods published with
+        _cache=True, e.g. a soaplib.util.shared_cache.SharedResponseCache that
+        is shared by all the worker processes of a server. The wsdl documents
+        are cached there as well, as long as they fit: the slot_size of a
+        SharedResponseCache has to be raised above the size of the wsdl for
+        it to be shared.
         '''
 
+        if not (service_lifecycle in (SERVICE_PER_REQUEST, SERVICE_PER_THREAD,
+                                                           SERVICE_SINGLETON)):
+            raise ValueError("invalid service lifecycle %r" %
+                                                              service_lifecycle)
+
+        if self.batch_enabled:
+            batch_service = type('BatchService', (BatchService,), {'app': self})
+            services = list(services) + [batch_service]
+
         self.services = services
         self.__tns = tns
         self.__name = name
         self._with_plink = _with_partnerlink
+        self.service_lifecycle = service_lifecycle
+        self.async_engine = async_engine
+
+        self.__definitions = {}
+        self.__instances = {}
+        self.__instances_lock = threading.Lock()
+        self.__local = threading.local()
 
-        self.call_routes = {}
+        self.routes = {}
         self.__wsdl = None
+        self.__source_digest = None
+        self.__wsdl_lock = threading.Lock()
+        self.__wsdl_cache = LRUCache(self.wsdl_cache_size)
         self.__public_methods = {}
         self.schema = None
+        self.envelope_schema = None
+        self.__schema_documents = None
 
         self.__ns_counter = 0
+        self.__emitter = None
+        self.__flight = SingleFlight()
 
         self.nsmap = dict(soaplib.const_nsmap)
         self.prefmap = dict(soaplib.const_prefmap)
@@ -155,12 +249,13 @@ class Application(object):
         self.build_schema()
 
     def __decompose_request(self, envelope_string, charset=None):
-        service_ctx = None
-        method_name = None
-
         # deserialize the body of the message
-        header, body = from_soap(envelope_string, charset)
+        header, body = from_soap(envelope_string, charset,
+                                                           self.envelope_schema)
 
+        return self.__build_context(header, body)
+
+    def __build_context(self, header, body, method_name=None):
         if not (body is None):
             try:
                 self.validate_request(body)
@@ -183,43 +278,114 @@ class Application(object):
         if method_name is None:
             raise Exception("Could not extract method name from the request!")
 
-        service_class = self.get_service_class(method_name)
-        service_ctx = self.get_service(service_class)
+        service_class, descriptor = self.get_route(method_name)
+
+        ctx = MethodContext(self.get_service(service_class))
+        ctx.descriptor = descriptor
+        ctx.header_xml = header
+        ctx.body_xml = body
+        ctx.method_name = method_name
 
-        service_ctx.header_xml = header
-        service_ctx.body_xml = body
-        service_ctx.method_name = method_name
+        ctx.service.set_context(ctx)
 
-        return service_ctx
+        return ctx
 
-    def deserialize_soap(self, envelope_string, charset=None):
-        """Takes a string containing ONE soap message.
+    def deserialize_soap(self, envelope_string, charset=None,
+                                                             attachments=None):
+        """Takes a string or a file-like object containing ONE soap message.
         Returns the corresponding native python object, along with the request
-        context
+        context, which is a MethodContext instance.
+
+        attachments is the dict of the MIME attachments of the message, as
+        returned by soaplib.mime.parse_mtom or split_mtom. The Attachment
+        values that refer to them get them as is.
 
         Not meant to be overridden.
         """
 
+        if self.use_parser_target:
+            return self.__decode_with_target(envelope_string, charset,
+                                                                   attachments)
+
         try:
             ctx = self.__decompose_request(envelope_string, charset)
-        except ValidationError, e:
+        except Fault, e:
             return None, e
 
-        # retrieve the method descriptor
-        descriptor = ctx.descriptor = ctx.get_method(ctx.method_name)
+        ctx.attachments = attachments
+
+        return ctx, self.__decode_request(ctx)
+
+    def __get_payload_target(self, method_name):
+        service_class, descriptor = self.get_route(method_name)
+
+        return PayloadTarget(descriptor.in_message)
+
+    def __decode_with_target(self, envelope_string, charset, attachments):
+        previous = bind_attachments(attachments)
+        try:
+            try:
+                header, method_name, params = decode_soap(envelope_string,
+                                         self.__get_payload_target, charset)
+
+                ctx = self.__build_context(header, None, method_name)
+
+            except Fault, e:
+                return None, e
+
+            ctx.attachments = attachments
+            self.__decode_header(ctx)
 
-        # decode header object
-        if ctx.header_xml is not None and len(ctx.header_xml) > 0:
-            in_header = descriptor.in_header
+        finally:
+            bind_attachments(previous)
+
+        if params is None:
+            params = [None] * len(ctx.descriptor.in_message._type_info)
+
+        return ctx, params
+
+    def deserialize_payload(self, body, header=None):
+        """Same as deserialize_soap, but takes the request element, i.e. the
+        first child of the soap body, and optionally the first child of the
+        soap header, instead of a whole soap message.
+
+        Not meant to be overridden.
+        """
+
+        try:
+            ctx = self.__build_context(header, body)
+        except Fault, e:
+            return None, e
+
+        return ctx, self.__decode_request(ctx)
+
+    def __decode_request(self, ctx):
+        previous = bind_attachments(ctx.attachments)
+        try:
+            return self.__decode_params(ctx)
+
+        finally:
+            bind_attachments(previous)
+
+    def __decode_header(self, ctx):
+        # decode header object, if the method has one
+        in_header = ctx.descriptor.in_header
+        if ctx.header_xml is not None and len(ctx.header_xml) > 0 and \
+                                                      not (in_header is None):
             ctx.soap_in_header = in_header.from_xml(ctx.header_xml)
 
+    def __decode_params(self, ctx):
+        descriptor = ctx.descriptor
+
+        self.__decode_header(ctx)
+
         # decode method arguments
         if ctx.body_xml is not None and len(ctx.body_xml) > 0:
             params = descriptor.in_message.from_xml(ctx.body_xml)
         else:
             params = [None] * len(descriptor.in_message._type_info)
 
-        return ctx, params
+        return params
 
     def process_request(self,ctx,req_obj):
         """Takes the native request object.
@@ -229,11 +395,15 @@ class Application(object):
         """
 
         try:
+            # the call could be processed by a thread other than the one that
+            # deserialized it.
+            ctx.service.set_context(ctx)
+
             # retrieve the method
-            func = getattr(ctx, ctx.descriptor.name)
+            func = getattr(ctx.service, ctx.descriptor.name)
 
             # call the method
-            return ctx.call_wrapper(func, req_obj)
+            return ctx.service.call_wrapper(func, req_obj)
 
         except Fault, e:
             return e
@@ -243,6 +413,293 @@ class Application(object):
 
             return fault
 
+    def get_cached_response(self, ctx, req_obj):
+        """Returns the cached response to the call with the given context,
+        or None when it's not in the response cache of the method, or when the
+        method doesn't have one. See soaplib.util.cache.ResponseCache.
+
+        Not meant to be overridden.
+        """
+
+        cache = self.__get_response_cache(ctx)
+        if cache is None or ctx.descriptor.mtom or self.is_async(ctx):
+            return None
+
+        # the parameters are keyed as a list, as they're passed to the method.
+        ctx.cache_key = cache.get_key(ctx.method_name, list(req_obj),
+                                                           ctx.soap_in_header)
+
+        return cache.get(ctx.cache_key)
+
+    def cache_response(self, ctx, native_obj, result_str):
+        """Stores the serialized response to the call with the given context
+        in the response cache of the method. Faults are not cached.
+
+        Not meant to be overridden.
+        """
+
+        if ctx is None or ctx.cache_key is None or \
+                                             isinstance(native_obj, Exception):
+            return
+
+        self.__get_response_cache(ctx).set(ctx.cache_key, result_str)
+
+    def __get_response_cache(self, ctx):
+        retval = ctx.descriptor.cache
+        if retval is True:
+            retval = self.response_cache
+
+        return retval
+
+    def is_coalesced(self, ctx):
+        """Returns True when the call with the given context is to be
+        processed by process_coalesced, i.e. when its method is published with
+        _coalesce=True.
+        """
+
+        return not (ctx is None) and ctx.descriptor.coalesce and \
+                                                        not self.is_async(ctx)
+
+    def get_coalescing_key(self, ctx, req_obj):
+        """Returns the key that identical calls have in common: calls to the
+        same method, with the same parameters and soap header, once
+        deserialized.
+        """
+
+        return get_canonical_key(ctx.method_name, list(req_obj),
+                                                           ctx.soap_in_header)
+
+    def process_coalesced(self, ctx, req_obj):
+        """Processes the request and serializes the response, unless an
+        identical call is being processed by another thread, in which case its
+        results are waited for and shared. Returns the native response along
+        with the serialized one. Faults are shared as well.
+
+        Responses of coalesced calls are never streamed, and the
+        on_method_return hook of their service is called after they're
+        serialized.
+
+        Not meant to be overridden.
+        """
+
+        return self.__flight.do(self.get_coalescing_key(ctx, req_obj),
+                                     self.__process_and_serialize, ctx, req_obj)
+
+    def __process_and_serialize(self, ctx, req_obj):
+        native_obj = self.process_request(ctx, req_obj)
+
+        result_str = self.serialize_soap(ctx, native_obj)
+        self.cache_response(ctx, native_obj, result_str)
+
+        return native_obj, result_str
+
+    def get_coalescing_stats(self):
+        """Returns the counters of process_coalesced as a dict: calls is the
+        number of calls that were processed, collapsed the number of those
+        that shared the results of another one, and in_flight the number of
+        calls in progress.
+        """
+
+        return self.__flight.get_stats()
+
+    def is_async(self, ctx):
+        """Returns True when the call with the given context is to be run by
+        the async engine, in which case the request is acknowledged by
+        submit_request() instead of being answered.
+        """
+
+        return not (ctx is None or self.async_engine is None) and \
+                                                        ctx.descriptor.is_async
+
+    def submit_request(self, ctx, req_obj):
+        """Queues the call to the asynchronous method with the given context.
+        Once the method returns, its result is posted to the ReplyTo address
+        of the request, as a call to the callback method of the service, with
+        a RelatesTo header that contains the MessageID of the request.
+
+        Returns None when the call is accepted, or the fault to send back
+        when it's not.
+
+        Not meant to be overridden.
+        """
+
+        message_id, reply_to = get_callback_info(ctx)
+
+        try:
+            if message_id is None or reply_to is None:
+                raise Fault('Client', 'Asynchronous methods need the '
+                                             'MessageID and ReplyTo headers')
+
+            callback = self.get_callback(ctx)
+            self.async_engine.submit(message_id, self.__run_async, ctx,
+                                        req_obj, message_id, reply_to, callback)
+
+        except Fault, e:
+            return e
+
+        except Exception, e:
+            return Fault('Server', str(e))
+
+    def get_callback(self, ctx):
+        """Returns the descriptor of the callback method that receives the
+        result of the asynchronous call with the given context: the one named
+        by the _callback argument of its rpc decorator, or the only callback
+        method of the service.
+        """
+
+        name = ctx.descriptor.callback
+        if not (name is None):
+            return ctx.service.get_method(name)
+
+        callbacks = [m for m in ctx.service.public_methods if m.is_callback]
+        if len(callbacks) != 1:
+            raise Fault('Server', 'Cannot determine the callback method of %r'
+                                                      % ctx.descriptor.name)
+
+        return callbacks[0]
+
+    def __run_async(self, ctx, req_obj, message_id, reply_to, callback):
+        try:
+            native_obj = self.process_request(ctx, req_obj)
+
+        finally:
+            ctx.service.clear_context(ctx)
+
+        envelope = self.serialize_callback(ctx, callback, native_obj,
+                                                          message_id, reply_to)
+
+        self.async_engine.post(reply_to, envelope, {
+            'Content-Type': 'text/xml; charset=%s' % string_encoding,
+            'SOAPAction': '"%s"' % callback.public_name,
+        })
+
+    def serialize_callback(self, ctx, callback, native_obj, message_id,
+                                                                     reply_to):
+        """Returns the callback request that carries the result of the
+        asynchronous call with the given context, or the fault it raised.
+
+        Not meant to be overridden.
+        """
+
+        envelope = etree.Element('{%s}Envelope' % soaplib.ns_soap_env,
+                                                               nsmap=self.nsmap)
+        header = etree.SubElement(envelope, '{%s}Header' % soaplib.ns_soap_env)
+
+        msg_id = etree.SubElement(header, '{%s}MessageID' % soaplib.ns_wsa)
+        msg_id.text = 'urn:uuid:%s' % uuid.uuid4()
+        header.append(create_relates_to_header(message_id))
+        to = etree.SubElement(header, '{%s}To' % soaplib.ns_wsa)
+        to.text = reply_to
+
+        body = etree.SubElement(envelope, '{%s}Body' % soaplib.ns_soap_env)
+
+        if isinstance(native_obj, Exception):
+            native_obj.__class__.to_xml(native_obj, self.get_tns(), body)
+
+        else:
+            in_message = callback.in_message
+            names = in_message._type_info.keys()
+            if len(names) == 1:
+                native_obj = [native_obj]
+
+            message = in_message()
+            if len(names) > 0:
+                for name, value in zip(names, native_obj):
+                    setattr(message, name, value)
+
+            in_message.to_xml(message, self.get_tns(), body)
+
+        return etree.tostring(envelope, xml_declaration=True,
+                                                       encoding=string_encoding)
+
+    def process_batch(self, payloads):
+        """Calls the operations whose request elements are given, and returns
+        their response elements, or their fault elements, in the same order.
+        This is what the batch operation of applications with batch_enabled
+        does.
+
+        The service hooks are called for the batch call as a whole, not for
+        the operations in it.
+
+        Not meant to be overridden.
+        """
+
+        calls = []
+        for payload in payloads or ():
+            if payload is None:
+                calls.append((None, Fault('Client', 'Empty batch item')))
+                continue
+
+            try:
+                ctx, params = self.deserialize_payload(payload)
+
+            except Exception, e:
+                ctx, params = None, Fault('Client', str(e))
+
+            if not (ctx is None) and isinstance(ctx.service, BatchService):
+                ctx.service.clear_context(ctx)
+                ctx, params = None, Fault('Client', 'Batch calls can not be '
+                                                                     'nested')
+
+            calls.append((ctx, params))
+
+        try:
+            return self.__run_batch(calls)
+
+        finally:
+            # deserialize_payload binds the context of every item to this
+            # thread, as does process_request when there's only one worker.
+            for ctx, params in calls:
+                if not (ctx is None):
+                    ctx.service.clear_context(ctx)
+
+    def __run_batch(self, calls):
+        results = [None] * len(calls)
+        queue = Queue()
+        for i, call in enumerate(calls):
+            queue.put((i, call))
+
+        def run():
+            while True:
+                try:
+                    i, (ctx, params) = queue.get_nowait()
+                except Empty:
+                    return
+
+                if ctx is None:
+                    results[i] = params
+                else:
+                    results[i] = self.process_request(ctx, params)
+
+        workers = min(self.batch_workers, len(calls))
+        if workers > 1:
+            threads = [threading.Thread(target=run) for i in range(workers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        else:
+            run()
+
+        return [self.__serialize_payload(ctx, result)
+                             for (ctx, params), result in zip(calls, results)]
+
+    def __serialize_payload(self, ctx, native_obj):
+        envelope = etree.Element('{%s}Envelope' % soaplib.ns_soap_env,
+                                                               nsmap=self.nsmap)
+
+        if ctx is None or isinstance(native_obj, Exception):
+            soap_body = etree.SubElement(envelope,
+                                               '{%s}Body' % soaplib.ns_soap_env)
+            native_obj.__class__.to_xml(native_obj, self.get_tns(), soap_body)
+
+        else:
+            self.__build_response(ctx, native_obj, envelope)
+            soap_body = ctx.soap_body
+
+        return soap_body[0]
+
     def serialize_soap(self, ctx, native_obj):
         """Pushes the native python object to the output stream as a soap
         response
@@ -250,6 +707,12 @@ class Application(object):
         Not meant to be overridden.
         """
 
+        if self.use_direct_emitter and not (ctx is None or
+                                            isinstance(native_obj, Exception)):
+            retval = self.__emit_response(ctx, native_obj)
+            if not (retval is None):
+                return retval
+
         # construct the soap response, and serialize it
         envelope = etree.Element('{%s}Envelope' % soaplib.ns_soap_env,
                                                                nsmap=self.nsmap)
@@ -260,8 +723,8 @@ class Application(object):
 
             # implementation hook
             if not (ctx is None):
-                ctx.on_method_exception_object(native_obj)
-            self.on_exception_object(native_obj)
+                ctx.service.on_method_exception_object(ctx, native_obj)
+            self.on_exception_object(ctx, native_obj)
 
             # FIXME: There's no way to alter soap response headers for the user.
             soap_body = etree.SubElement(envelope,
@@ -270,54 +733,15 @@ class Application(object):
 
             # implementation hook
             if not (ctx is None):
-                ctx.on_method_exception_xml(soap_body)
+                ctx.service.on_method_exception_xml(ctx, soap_body)
                 ctx.soap_body = soap_body
-            self.on_exception_xml(soap_body)
+            self.on_exception_xml(ctx, soap_body)
 
             if logger.level == logging.DEBUG:
                 logger.debug(etree.tostring(envelope, pretty_print=True))
 
         else:
-            #
-            # header
-            #
-            if ctx.soap_out_header != None:
-                if ctx.descriptor.out_header is None:
-                    logger.warning(
-                        "Skipping soap response header as %r method is not "
-                        "published to have a soap response header" %
-                                native_obj.get_type_name()[:-len('Response')])
-                else:
-                    soap_header_elt = etree.SubElement(envelope,
-                                             '{%s}Header' % soaplib.ns_soap_env)
-                    ctx.descriptor.out_header.to_xml(
-                        ctx.soap_out_header,
-                        self.get_tns(),
-                        soap_header_elt,
-                        ctx.descriptor.out_header.get_type_name()
-                    )
-
-            #
-            # body
-            #
-            ctx.soap_body = soap_body = etree.SubElement(envelope,
-                                               '{%s}Body' % soaplib.ns_soap_env)
-
-            # instantiate the result message
-            result_message = ctx.descriptor.out_message()
-
-            # assign raw result to its wrapper, result_message
-            out_type = ctx.descriptor.out_message._type_info
-
-            if len(out_type) > 0:
-                assert len(out_type) == 1
-
-                attr_name = ctx.descriptor.out_message._type_info.keys()[0]
-                setattr(result_message, attr_name, native_obj)
-
-            # transform the results into an element
-            ctx.descriptor.out_message.to_xml(
-                                      result_message, self.get_tns(), soap_body)
+            self.__build_response(ctx, native_obj, envelope)
 
             if logger.level == logging.DEBUG:
                 logger.debug('\033[91m'+ "Response" + '\033[0m')
@@ -327,6 +751,238 @@ class Application(object):
         return etree.tostring(envelope, xml_declaration=True,
                                                        encoding=string_encoding)
 
+    def is_streaming(self, ctx, native_obj):
+        """Returns True when the response should be serialized using
+        serialize_soap_stream. That's the case for methods published with
+        _streaming=True, and for methods declared to return an array that
+        return a generator or an iterator instead of a sequence, e.g. a
+        database cursor.
+
+        Mtom and fault responses are never streamed.
+        """
+
+        if ctx is None or isinstance(native_obj, Exception):
+            return False
+
+        if ctx.descriptor.mtom:
+            return False
+
+        if ctx.descriptor.streaming:
+            return True
+
+        # only the items of arrays are serialized as they're produced. Array
+        # serializers are customized duplicates of the Array class.
+        fields = ctx.descriptor.out_message.get_plan().fields
+        if len(fields) != 1:
+            return False
+
+        name, serializer, is_array, ns = fields[0]
+        if not (is_array or issubclass(getattr(serializer, '_is_clone_of',
+                                                        serializer), Array)):
+            return False
+
+        return isinstance(native_obj, types.GeneratorType) or (
+                hasattr(native_obj, 'next') and hasattr(native_obj, '__iter__'))
+
+    def serialize_soap_stream(self, ctx, native_obj):
+        """Same as serialize_soap, but returns an iterable of strings instead
+        of a single string. Array members of the response are serialized one
+        item at a time, as the iterable is consumed, so that only one item is
+        held in memory as an xml tree. The output is identical to that of
+        serialize_soap.
+
+        Not meant to be overridden.
+        """
+
+        if ctx is None or isinstance(native_obj, Exception):
+            return [self.serialize_soap(ctx, native_obj)]
+
+        envelope = etree.Element('{%s}Envelope' % soaplib.ns_soap_env,
+                                                               nsmap=self.nsmap)
+        streams = []
+        self.__build_response(ctx, native_obj, envelope, streams)
+
+        return self.__stream_envelope(envelope, streams)
+
+    def __stream_envelope(self, envelope, streams):
+        """Generator that serializes the envelope, replacing the stream
+        markers with the serialized items of the respective streams.
+        """
+
+        chunk_size = self.stream_chunk_size
+        retval = etree.tostring(envelope, xml_declaration=True,
+                                                       encoding=string_encoding)
+        buf = []
+        buf_len = 0
+
+        for marker, values, serializer, ns, name in streams:
+            head, retval = retval.split(etree.tostring(marker), 1)
+            buf.append(head)
+
+            # the items are serialized as subelements of the marker's parent,
+            # so their namespace declarations, which etree.tostring repeats on
+            # every item, are known in advance and can be stripped.
+            parent = marker.getparent()
+            probe = etree.SubElement(parent, 'probe')
+            ns_decls = etree.tostring(probe)[len('<probe'):-len('/>')]
+            ns_decls = [' xmlns%s' % d for d in ns_decls.split(' xmlns')[1:]]
+            parent.remove(probe)
+
+            for value in values:
+                serializer.to_xml(value, ns, parent, name)
+                element = parent[-1]
+                item = etree.tostring(element, encoding=string_encoding,
+                                                          xml_declaration=False)
+                parent.remove(element)
+
+                tag_end = item.index('>')
+                start_tag = item[:tag_end]
+                for d in ns_decls:
+                    start_tag = start_tag.replace(d, '', 1)
+
+                buf.append(start_tag)
+                buf.append(item[tag_end:])
+                buf_len += len(item)
+
+                if buf_len >= chunk_size:
+                    yield ''.join(buf)
+                    buf = []
+                    buf_len = 0
+
+        buf.append(retval)
+        yield ''.join(buf)
+
+    def __get_result_message(self, ctx, native_obj):
+        # instantiate the result message
+        out_message = ctx.descriptor.out_message
+        result_message = out_message()
+
+        # assign raw result to its wrapper, result_message
+        out_type = out_message._type_info
+
+        if len(out_type) > 0:
+            assert len(out_type) == 1
+
+            attr_name = out_message._type_info.keys()[0]
+            setattr(result_message, attr_name, native_obj)
+
+        return result_message
+
+    def __get_emitter(self):
+        """Returns the Emitter for the current namespace map, along with the
+        serialized envelope parts it goes with: the text before the Header
+        element, the Header and Body start and end tags, and the text after
+        the Body element.
+        """
+
+        emitter = self.__emitter
+        # generating the wsdl can rename prefixes, so the whole map is
+        # compared.
+        if emitter is None or emitter[0] != self.nsmap:
+            # the envelope is serialized by lxml once, with a marker in the
+            # body, so that the namespace declarations are identical.
+            marker = 'soaplib-emitter-body'
+            envelope = etree.Element('{%s}Envelope' % soaplib.ns_soap_env,
+                                                               nsmap=self.nsmap)
+            etree.SubElement(envelope, '{%s}Body' % soaplib.ns_soap_env
+                                                                ).text = marker
+
+            head, tail = etree.tostring(envelope, xml_declaration=True,
+                                  encoding=string_encoding).split(marker)
+
+            direct = Emitter(self.nsmap)
+            header = direct.get_tag(soaplib.ns_soap_env, 'Header')
+            body = direct.get_tag(soaplib.ns_soap_env, 'Body')
+            head = head[:-len('<%s>' % body)]
+
+            emitter = self.__emitter = (dict(self.nsmap), direct, head,
+                    '<%s>' % header, '</%s>' % header, '<%s>' % body, tail)
+
+        return emitter
+
+    def __emit_response(self, ctx, native_obj):
+        """Serializes the response with the Emitter. Returns None when the
+        response can't be serialized that way.
+        """
+
+        descriptor = ctx.descriptor
+        out_message = descriptor.out_message
+        tns = self.get_tns()
+
+        try:
+            (nsmap, emitter, head, header_start, header_end, body_start,
+                                                    tail) = self.__get_emitter()
+
+            retval = [head]
+
+            if ctx.soap_out_header != None:
+                out_header = descriptor.out_header
+                if out_header is None:
+                    return None # __build_response logs the warning.
+
+                retval.append(header_start)
+                emitter.get_encoder(out_header, tns, out_header.get_type_name()
+                                                  )(ctx.soap_out_header, retval)
+                retval.append(header_end)
+
+            retval.append(body_start)
+            emitter.get_encoder(out_message, tns, out_message.get_type_name()
+                    )(self.__get_result_message(ctx, native_obj), retval)
+            retval.append(tail)
+
+        except UnsupportedType:
+            return None
+
+        retval = ''.join(retval)
+
+        if logger.level == logging.DEBUG:
+            logger.debug('\033[91m'+ "Response" + '\033[0m')
+            logger.debug(retval)
+
+        return retval
+
+    def __build_response(self, ctx, native_obj, envelope, streams=None):
+        """Fills the given envelope with the response header and body. When
+        streams is not None, the array members of the response are left out
+        and recorded in the streams list instead. See
+        ClassSerializerBase.get_members_stream.
+        """
+
+        #
+        # header
+        #
+        if ctx.soap_out_header != None:
+            if ctx.descriptor.out_header is None:
+                logger.warning(
+                    "Skipping soap response header as %r method is not "
+                    "published to have a soap response header" %
+                            native_obj.get_type_name()[:-len('Response')])
+            else:
+                soap_header_elt = etree.SubElement(envelope,
+                                         '{%s}Header' % soaplib.ns_soap_env)
+                ctx.descriptor.out_header.to_xml(
+                    ctx.soap_out_header,
+                    self.get_tns(),
+                    soap_header_elt,
+                    ctx.descriptor.out_header.get_type_name()
+                )
+
+        #
+        # body
+        #
+        ctx.soap_body = soap_body = etree.SubElement(envelope,
+                                               '{%s}Body' % soaplib.ns_soap_env)
+
+        out_message = ctx.descriptor.out_message
+        result_message = self.__get_result_message(ctx, native_obj)
+
+        # transform the results into an element
+        if streams is None:
+            out_message.to_xml(result_message, self.get_tns(), soap_body)
+        else:
+            out_message.to_xml_stream(result_message, self.get_tns(),
+                         soap_body, out_message.get_type_name(), streams)
+
     def get_namespace_prefix(self, ns):
         """Returns the namespace prefix for the given namespace. Creates a new
         one automatically if it doesn't exist
@@ -411,9 +1067,11 @@ class Application(object):
 
     tns = property(get_tns)
 
-    def __build_schema_nodes(self, schema_entries, types=None):
+    def build_schema_nodes(self, schema_entries, types=None):
         """Fill individual <schema> nodes for every service that are part of this
         app.
+
+        This is a protected method.
         """
 
         schema_nodes = {}
@@ -446,49 +1104,163 @@ class Application(object):
         """
 
         if types is None:
-            # populate call routes
-            for s in self.services:
-                s.__tns__ = self.get_tns()
-                inst = self.get_service(s)
-
-                for method in inst.public_methods:
-                    method_name = "{%s}%s" % (self.get_tns(), method.name)
-
-                    if method_name in self.call_routes:
-                        o = self.call_routes[method_name]
-                        raise Exception("%s.%s.%s overwrites %s.%s.%s" %
-                                        (s.__module__, s.__name__, method.name,
-                                         o.__module__, o.__name__, method.name))
-
-                    else:
-                        logger.debug('adding method %r' % method_name)
-                        self.call_routes[method_name] = s
-                        self.call_routes[method.name] = s
-
-        # populate types
+            self.routes = self.build_routes()
+
+        schema_nodes = self.build_schema_nodes(self.build_schema_entries(),
+                                                                         types)
+
+        return schema_nodes
+
+    def build_schema_entries(self):
+        """Collects the types of all services.
+
+        This is a protected method.
+        """
+
         schema_entries = _SchemaEntries(self.get_tns(), self)
         for s in self.services:
-            inst = self.get_service(s)
+            inst = self.get_definition(s)
             schema_entries = inst.add_schema(schema_entries)
 
-        schema_nodes = self.__build_schema_nodes(schema_entries, types)
+        return schema_entries
 
-        return schema_nodes
+    def get_schema_documents(self):
+        """Returns the standalone schema documents of the application, as a
+        dict of serialized documents keyed by file name ('sN.xsd'). The
+        documents import each other using these file names. They're generated
+        once.
 
-    def get_service_class(self, method_name):
-        """This call maps method names to the services that will handle them.
+        Not meant to be overridden.
+        """
+
+        if self.__schema_documents is None:
+            schema_nodes = self.build_schema_nodes(self.build_schema_entries())
+
+            self.__schema_documents = dict([
+                ('%s.xsd' % k, etree.tostring(v, xml_declaration=True,
+                                                             encoding='UTF-8'))
+                for k, v in schema_nodes.items()
+            ])
+
+        return self.__schema_documents
+
+    def build_routes(self):
+        """Builds the dispatch table of the application. It maps the qualified
+        name of the request element, the qualified and unqualified method
+        names, and the public name of the method (which is also its soap
+        action) to a (service_class, method_descriptor) tuple. It's built
+        once and must not be modified afterwards.
+
+        This is a protected method.
+        """
+
+        retval = {}
+        tns = self.get_tns()
+
+        for s in self.services:
+            s.__tns__ = tns
+            inst = self.get_definition(s)
+
+            for method in inst.public_methods:
+                method_name = "{%s}%s" % (tns, method.name)
+                logger.debug('adding method %r' % method_name)
+
+                route = (s, method)
+                type_name = method.in_message.get_type_name()
+
+                keys = set(("{%s}%s" % (tns, type_name), method_name,
+                                             method.name, method.public_name))
+
+                # a method can't take over any of the names of another one,
+                # even when they only share e.g. a soap action.
+                for key in keys:
+                    if key in retval:
+                        o, o_method = retval[key]
+                        raise Exception("%s.%s.%s overwrites %s.%s.%s as %r" %
+                                    (s.__module__, s.__name__, method.name,
+                                     o.__module__, o.__name__, o_method.name,
+                                     key))
+
+                for key in keys:
+                    retval[key] = route
+
+        return retval
+
+    def get_route(self, method_name):
+        """This call maps the name of the request element, a method name or a
+        soap action to the service class that will handle it, along with the
+        method descriptor. Returns a (service_class, method_descriptor) tuple.
 
         Override this function to alter the method mappings. Just try not to get
         too crazy with regular expressions :)
         """
-        return self.call_routes[method_name]
+
+        retval = self.routes.get(method_name, None)
+        if retval is None:
+            if method_name[:1] == '"' and method_name[-1:] == '"':
+                # soap actions are quoted strings
+                retval = self.routes.get(method_name[1:-1], None)
+
+            if retval is None:
+                raise Fault('Client', 'Method %r not found' % method_name)
+
+        return retval
+
+    def get_service_class(self, method_name):
+        """Returns the service class that handles the given method. See
+        get_route.
+        """
+
+        return self.get_route(method_name)[0]
 
     def get_service(self, service, http_req_env=None):
         """The function that maps service classes to service instances.
         Overriding this function is useful in case e.g. you need to pass
         additional parameters to service constructors.
+
+        Depending on the service_lifecycle of the application, a new instance
+        is created for every request, for every thread, or only once. The
+        state of the call is kept in a MethodContext in any case.
+        """
+
+        if self.service_lifecycle == SERVICE_PER_REQUEST:
+            return service(http_req_env)
+
+        if self.service_lifecycle == SERVICE_PER_THREAD:
+            instances = getattr(self.__local, 'instances', None)
+            if instances is None:
+                instances = self.__local.instances = {}
+
+            retval = instances.get(service, None)
+            if retval is None:
+                retval = instances[service] = service(http_req_env)
+
+            return retval
+
+        retval = self.__instances.get(service, None)
+        if retval is None:
+            self.__instances_lock.acquire()
+            try:
+                retval = self.__instances.get(service, None)
+                if retval is None:
+                    retval = self.__instances[service] = service(http_req_env)
+            finally:
+                self.__instances_lock.release()
+
+        return retval
+
+    def get_definition(self, service):
+        """Returns the service instance that's used to generate the schema and
+        the wsdl of the given service class. It's created only once.
+
+        This is a protected method.
         """
-        return service(http_req_env)
+
+        retval = self.__definitions.get(service, None)
+        if retval is None:
+            retval = self.__definitions[service] = self.get_service(service)
+
+        return retval
 
     def get_schema(self):
         """Simple accessor method that caches application's xml schema, once
@@ -502,15 +1274,126 @@ class Application(object):
             return self.schema
 
     def get_wsdl(self, url):
-        """Simple accessor method that caches the wsdl of the application, once
-        generated.
+        """Simple accessor method that caches the wsdl of the application for
+        the given endpoint url, once generated. Urls are normalized, and only
+        the wsdl_cache_size most recently requested ones are kept.
+
+        The wsdl is generated only once, with a placeholder as the endpoint
+        address, and the wsdl for a specific url is made by substituting that
+        placeholder.
 
         Not meant to be overridden.
         """
+
+        url = normalize_url(url)
+
+        return self.__wsdl_cache.get_or_create(url,
+                                       lambda: self.__get_shared_wsdl(url))
+
+    def __get_shared_wsdl(self, url):
+        """Returns the wsdl for the given url from the response cache, when
+        there's one, so that the processes that share it generate the wsdl
+        only once. The key includes a digest of the source of the services,
+        so that a wsdl stored by another version of the code isn't used.
+        """
+
+        cache = self.response_cache
+        if cache is None:
+            return self.__build_wsdl_for_url(url)
+
+        if self.__source_digest is None:
+            self.__source_digest = self.__get_source_digest()
+
+        key = cache.get_key('{%s}%s.wsdl' % (self.get_tns(), self.get_name()),
+                [url, self.__source_digest] + ['%s.%s' % (s.__module__,
+                                               s.__name__) for s in self.services])
+
+        retval = cache.get(key)
+        if retval is None:
+            retval = self.__build_wsdl_for_url(url)
+
+            capacity = getattr(cache, 'capacity', None)
+            if not (capacity is None) and len(retval) > capacity:
+                logger.warning('the wsdl for %r is %d bytes long, which is '
+                               'more than the %d bytes that the response cache '
+                               'can store in a slot, so it is not shared' %
+                                                 (url, len(retval), capacity))
+
+            cache.set(key, retval)
+
+        return retval
+
+    def __get_source_digest(self):
+        """Returns a digest of the source files of the modules that define
+        the application, its services and the types they use."""
+
+        modules = set([self.__class__.__module__])
+        seen = set()
+
+        def add_type(cls):
+            if cls is None or cls in seen:
+                return
+
+            seen.add(cls)
+            modules.add(cls.__module__)
+
+            for v in getattr(cls, '_type_info', {}).values():
+                add_type(v)
+
+            add_type(getattr(cls, '__extends__', None))
+
+        for s in self.services:
+            modules.add(s.__module__)
+
+            for method in self.get_definition(s).public_methods:
+                for cls in (method.in_message, method.out_message,
+                                          method.in_header, method.out_header):
+                    add_type(cls)
+
+        digest = hashlib.sha1()
+        for name in sorted(modules):
+            digest.update(name)
+
+            path = getattr(sys.modules.get(name, None), '__file__', None)
+            if path is None:
+                continue
+
+            # the source, as compiled files depend on its modification time.
+            if path[-4:] in ('.pyc', '.pyo'):
+                path = path[:-1]
+
+            try:
+                f = open(path, 'rb')
+                try:
+                    digest.update(f.read())
+                finally:
+                    f.close()
+
+            except IOError:
+                pass
+
+        return digest.hexdigest()
+
+    def __build_wsdl_for_url(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+
+        address = xml_escape(url, {'"': '&quot;'})
+
+        return self.__get_wsdl_template().replace(_WSDL_ADDRESS, address)
+
+    def __get_wsdl_template(self):
         if self.__wsdl is None:
-            return self.__build_wsdl(url)
-        else:
-            return self.__wsdl
+            # generating the wsdl alters the namespace prefix maps, so this
+            # must not be done by more than one thread.
+            self.__wsdl_lock.acquire()
+            try:
+                if self.__wsdl is None:
+                    self.__build_wsdl(_WSDL_ADDRESS)
+            finally:
+                self.__wsdl_lock.release()
+
+        return self.__wsdl
 
     def __get_schema_node(self, pref, schema_nodes, types):
         """Return schema node for the given namespace prefix.
@@ -566,7 +1449,7 @@ class Application(object):
         messages = set()
 
         for s in self.services:
-            s=self.get_service(s,None)
+            s=self.get_definition(s)
 
             s.add_messages_for_methods(self, root, messages)
 
@@ -600,15 +1483,15 @@ class Application(object):
         cb_binding = None
 
         for s in self.services:
-            s=self.get_service(s)
+            s=self.get_definition(s)
             s.add_port_type(self, root, service_name, types, url, port_type)
             cb_binding = s.add_bindings_for_methods(self, root, service_name,
                                                 types, url, binding, cb_binding)
 
-        self.__wsdl = etree.tostring(root, xml_declaration=True,
-                                                               encoding="UTF-8")
+        retval = etree.tostring(root, xml_declaration=True, encoding="UTF-8")
+        self.__wsdl = retval
 
-        return self.__wsdl
+        return retval
 
     def __add_partner_link(self, root, service_name, types, url, plink):
         """Add the partnerLinkType node to the wsdl.
@@ -646,7 +1529,7 @@ class Application(object):
         retval = False
 
         for s in self.services:
-            if self.get_service(s)._has_callbacks():
+            if self.get_definition(s)._has_callbacks():
                 return True
 
         return retval
@@ -656,23 +1539,54 @@ class Application(object):
         validation.
         """
 
-    def on_exception_object(self, exc):
+    def on_exception_object(self, ctx, exc):
         '''Called when the app throws an exception. (might be inside or outside
         the service call.
 
-        @param the wsgi environment
+        @param the MethodContext of the call, None if the exception occured
+               before the call could be identified.
         @param the fault object
         '''
 
-    def on_exception_xml(self, fault_xml):
+    def on_exception_xml(self, ctx, fault_xml):
         '''Called when the app throws an exception. (might be inside or outside
         the service call.
 
-        @param the wsgi environment
+        @param the MethodContext of the call, None if the exception occured
+               before the call could be identified.
         @param the xml element containing the xml serialization of the fault
         '''
 
+class _SchemaResolver(etree.Resolver):
+    """Serves the schema documents generated by ValidatingApplication, so that
+    they don't have to be written to disk in order to be imported by each
+    other.
+    """
+
+    def __init__(self, documents):
+        etree.Resolver.__init__(self)
+
+        self.documents = documents
+
+    def resolve(self, url, pubid, context):
+        document = self.documents.get(url.rsplit('/', 1)[-1], None)
+        if not (document is None):
+            return self.resolve_string(document, context)
+
 class ValidatingApplication(Application):
+    # validation needs the element tree of the request.
+    use_parser_target = False
+
+    # when True, the request is validated against the whole application
+    # schema while it's being parsed, instead of validating the body of the
+    # finished request tree against the schema of the requested operation.
+    validate_while_parsing = False
+
+    def __init__(self, *args, **kwargs):
+        self.__validators = {}
+
+        Application.__init__(self, *args, **kwargs)
+
     def build_schema(self, types=None):
         """Build application schema specifically for xml validation purposes.
         """
@@ -683,31 +1597,119 @@ class ValidatingApplication(Application):
             logger.debug("generating schema for targetNamespace=%r, prefix: %r"
                                                    % (self.get_tns(), pref_tns))
 
-            tmp_dir_name = tempfile.mkdtemp()
-
-            # serialize nodes to files
-            for k,v in schema_nodes.items():
-                file_name = '%s/%s.xsd' % (tmp_dir_name, k)
-                f = open(file_name, 'w')
-                etree.ElementTree(v).write(f, pretty_print=True)
-                f.close()
-                logger.debug("writing %r for ns %s" % (file_name,
-                                                            self.nsmap[k]))
-
-            f = open('%s/%s.xsd' % (tmp_dir_name, pref_tns), 'r')
+            documents = self.__serialize_schema_nodes(schema_nodes)
 
             logger.debug("building schema...")
-            self.schema = etree.XMLSchema(etree.parse(f))
+            self.schema = self.__compile_schema(documents, '%s.xsd' % pref_tns)
+            logger.debug("schema %r built" % self.schema)
+
+            self.__validators = {}
 
-            logger.debug("schema %r built, cleaning up..." % self.schema)
-            f.close()
-            shutil.rmtree(tmp_dir_name)
-            logger.debug("removed %r" % tmp_dir_name)
+            if self.validate_while_parsing:
+                documents['envelope.xsd'] = self.__get_envelope_schema_node(
+                                                                       pref_tns)
+                self.envelope_schema = self.__compile_schema(documents,
+                                                                'envelope.xsd')
 
         return self.schema
 
+    def __serialize_schema_nodes(self, schema_nodes):
+        retval = {}
+
+        for k,v in schema_nodes.items():
+            retval['%s.xsd' % k] = etree.tostring(v)
+            logger.debug("generated %s.xsd for ns %s" % (k, self.nsmap[k]))
+
+        return retval
+
+    def __compile_schema(self, documents, root_name):
+        # the schema documents import each other using their file names,
+        # which are resolved from memory.
+        parser = etree.XMLParser()
+        parser.resolvers.add(_SchemaResolver(documents))
+
+        root = etree.fromstring(documents[root_name], parser,
+                                                            base_url=root_name)
+
+        return etree.XMLSchema(etree.ElementTree(root))
+
+    def __get_envelope_schema_node(self, pref_tns):
+        """Returns a schema for the soap envelope whose body entries are
+        validated against the application schema. The header is not
+        validated, just like when validating the body of the request tree.
+        """
+
+        ns_xsd = soaplib.ns_xsd
+
+        schema = etree.Element('{%s}schema' % ns_xsd)
+        schema.set('targetNamespace', soaplib.ns_soap_env)
+        schema.set('elementFormDefault', 'qualified')
+
+        import_ = etree.SubElement(schema, '{%s}import' % ns_xsd)
+        import_.set('namespace', self.get_tns())
+        import_.set('schemaLocation', '%s.xsd' % pref_tns)
+
+        envelope = etree.SubElement(schema, '{%s}element' % ns_xsd)
+        envelope.set('name', 'Envelope')
+        envelope_seq = etree.SubElement(etree.SubElement(envelope,
+                '{%s}complexType' % ns_xsd), '{%s}sequence' % ns_xsd)
+
+        for name, min_occurs, process_contents in (('Header', '0', 'skip'),
+                                                   ('Body', '1', 'lax')):
+            element = etree.SubElement(envelope_seq, '{%s}element' % ns_xsd)
+            element.set('name', name)
+            element.set('minOccurs', min_occurs)
+
+            complex_type = etree.SubElement(element, '{%s}complexType'% ns_xsd)
+            any_ = etree.SubElement(etree.SubElement(complex_type,
+                             '{%s}sequence' % ns_xsd), '{%s}any' % ns_xsd)
+            any_.set('processContents', process_contents)
+            any_.set('minOccurs', '0')
+            any_.set('maxOccurs', 'unbounded')
+
+            any_attr = etree.SubElement(complex_type,
+                                             '{%s}anyAttribute' % ns_xsd)
+            any_attr.set('processContents', 'skip')
+
+        any_attr = etree.SubElement(envelope_seq.getparent(),
+                                             '{%s}anyAttribute' % ns_xsd)
+        any_attr.set('processContents', 'skip')
+
+        return etree.tostring(schema)
+
+    def get_validator(self, descriptor):
+        """Returns the schema that covers only the types that are reachable
+        from the input message of the given method. It's compiled on first
+        use.
+        """
+
+        retval = self.__validators.get(descriptor, None)
+        if retval is None:
+            schema_entries = _SchemaEntries(self.get_tns(), self)
+            descriptor.in_message.add_to_schema(schema_entries)
+
+            schema_nodes = self.build_schema_nodes(schema_entries)
+            documents = self.__serialize_schema_nodes(schema_nodes)
+
+            pref_tns = self.get_namespace_prefix(self.get_tns())
+            retval = self.__compile_schema(documents, '%s.xsd' % pref_tns)
+
+            self.__validators[descriptor] = retval
+            logger.debug("schema %r built for %r" % (retval, descriptor.name))
+
+        return retval
+
     def validate_request(self, payload):
-        schema = self.schema
+        if not (self.envelope_schema is None):
+            # already validated by the parser.
+            return
+
+        route = self.routes.get(payload.tag, None)
+        if route is None:
+            schema = self.schema
+        else:
+            schema = self.get_validator(route[1])
+
         ret = schema.validate(payload)
 
         logger.debug("validation result: %s" % str(ret))
@@ -0,0 +1,53 @@
+
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+from soaplib.serializers.clazz import Array
+from soaplib.serializers.primitive import Any
+from soaplib.service import DefinitionBase
+from soaplib.service import rpc
+
+class BatchService(DefinitionBase):
+    '''
+    The service that's added to applications with batch_enabled set. Its
+    batch method takes a sequence of request payloads, i.e. the elements that
+    would be the children of the soap body if they were sent one by one, and
+    returns the corresponding response payloads, or faults, in the same
+    order:
+
+        <tns:batch>
+          <tns:payloads>
+            <tns:anyType><tns:some_method>...</tns:some_method></tns:anyType>
+            ...
+          </tns:payloads>
+        </tns:batch>
+
+    Each subclass is bound to one application, see Application.__init__.
+    '''
+
+    app = None
+
+    @rpc(Array(Any), _returns=Array(Any))
+    def batch(self, payloads):
+        '''
+        Calls the operations whose request payloads are given.
+        @param payloads the request elements of the operations
+        @return the response elements, or faults, in the same order
+        '''
+
+        return self.app.process_batch(payloads)
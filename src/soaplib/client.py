@@ -0,0 +1,305 @@
+
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+
+from Queue import Empty
+from Queue import Queue
+
+from lxml import etree
+
+import soaplib
+
+from soaplib.serializers.exception import Fault
+from soaplib.serializers.primitive import string_encoding
+from soaplib.soap import from_soap
+from soaplib.util.http import ConnectionPool
+
+class _RemoteMethod(object):
+    def __init__(self, client, descriptor):
+        self.client = client
+        self.descriptor = descriptor
+
+    def __call__(self, *args, **kwargs):
+        return self.client.call(self.descriptor, *args, **kwargs)
+
+class ServiceClientBase(object):
+    '''
+    Calls the methods of a remote soaplib service, using the definition of
+    the service instead of its wsdl. The requests and the responses are
+    (de)serialized by the messages of the method descriptors, the same way
+    the server does it.
+
+    The methods of the service are available as attributes of the client,
+    and take the same arguments as the service methods. The soap header of a
+    call can be passed as the _soap_header keyword argument.
+
+    This class does not do any i/o, see ServiceClient for the client that
+    does.
+    '''
+
+    def __init__(self, url, service, tns=None):
+        '''
+        @param url the endpoint url of the service
+        @param service the DefinitionBase subclass, or an instance of it
+        @param tns the target namespace of the remote application. Defaults
+               to the one of the service.
+        '''
+
+        if isinstance(service, type):
+            service = service()
+
+        if tns is None:
+            tns = service.get_tns()
+
+        self.url = url
+        self.service = service
+        self.tns = tns
+
+        self.nsmap = dict(soaplib.const_nsmap)
+        self.nsmap['tns'] = tns
+
+        self.methods = dict([(m.name, m) for m in service.public_methods
+                                                        if not m.is_callback])
+
+    def __getattr__(self, name):
+        methods = self.__dict__.get('methods', {})
+
+        descriptor = methods.get(name, None)
+        if descriptor is None:
+            raise AttributeError(name)
+
+        return _RemoteMethod(self, descriptor)
+
+    def serialize_request(self, descriptor, args, kwargs):
+        '''Returns the request body and the http headers for the call to the
+        method with the given descriptor.
+        '''
+
+        soap_header = kwargs.pop('_soap_header', None)
+
+        envelope = etree.Element('{%s}Envelope' % soaplib.ns_soap_env,
+                                                               nsmap=self.nsmap)
+
+        if not (soap_header is None or descriptor.in_header is None):
+            header = etree.SubElement(envelope,
+                                             '{%s}Header' % soaplib.ns_soap_env)
+            descriptor.in_header.to_xml(soap_header, self.tns, header,
+                                         descriptor.in_header.get_type_name())
+
+        body = etree.SubElement(envelope, '{%s}Body' % soaplib.ns_soap_env)
+        self.__serialize_payload(descriptor, args, kwargs, body)
+
+        return self.__to_request(envelope, descriptor.public_name)
+
+    def serialize_batch_request(self, calls):
+        '''Returns the request body and the http headers for the call to the
+        batch operation of the server, see soaplib.batch.BatchService. calls
+        is a sequence of (method_name, args) tuples.
+        '''
+
+        envelope = etree.Element('{%s}Envelope' % soaplib.ns_soap_env,
+                                                               nsmap=self.nsmap)
+        body = etree.SubElement(envelope, '{%s}Body' % soaplib.ns_soap_env)
+        batch = etree.SubElement(body, '{%s}batch' % self.tns)
+        payloads = etree.SubElement(batch, '{%s}payloads' % self.tns)
+
+        for name, args in calls:
+            item = etree.SubElement(payloads, '{%s}anyType' % self.tns)
+            self.__serialize_payload(self.methods[name], args, {}, item)
+
+        return self.__to_request(envelope, 'batch')
+
+    def __serialize_payload(self, descriptor, args, kwargs, parent):
+        in_message = descriptor.in_message
+        if len(args) > len(in_message._type_info):
+            raise TypeError('%s() takes at most %d arguments (%d given)' %
+                  (descriptor.name, len(in_message._type_info), len(args)))
+
+        message = in_message.get_serialization_instance(list(args))
+        for k, v in kwargs.items():
+            if not (k in in_message._type_info):
+                raise TypeError('%s() got an unexpected keyword argument %r'
+                                                         % (descriptor.name, k))
+            setattr(message, k, v)
+
+        in_message.to_xml(message, self.tns, parent)
+
+    def __to_request(self, envelope, soap_action):
+        data = etree.tostring(envelope, xml_declaration=True,
+                                                       encoding=string_encoding)
+        headers = {
+            'Content-Type': 'text/xml; charset=%s' % string_encoding,
+            'SOAPAction': '"%s"' % soap_action,
+        }
+
+        return data, headers
+
+    def deserialize_response(self, descriptor, status, data):
+        '''Returns the native result of the call, or raises the fault that
+        the server responded with.
+        '''
+
+        body = self.__parse_response(status, data)
+        if body is None:
+            return None
+
+        return self.__deserialize_payload(descriptor, body)
+
+    def deserialize_batch_response(self, calls, status, data):
+        '''Returns the results of the batch call with the given calls, in the
+        same order. Operations that failed have their Fault in place of their
+        result.
+        '''
+
+        body = self.__parse_response(status, data)
+        items = body.findall('{%s}batchResult/{%s}anyType' % (self.tns,
+                                                                     self.tns))
+
+        retval = []
+        for (name, args), item in zip(calls, items):
+            try:
+                retval.append(self.__deserialize_payload(self.methods[name],
+                                                                      item[0]))
+            except Fault, e:
+                retval.append(e)
+
+        return retval
+
+    def __parse_response(self, status, data):
+        if not data:
+            if 200 <= status < 300:
+                return None
+
+            raise Fault('Server', 'HTTP error %d' % status)
+
+        header, body = from_soap(data)
+
+        if not (body is None) and \
+                            body.tag == '{%s}Fault' % soaplib.ns_soap_env:
+            self.__raise_fault(body)
+
+        return body
+
+    def __raise_fault(self, element):
+        fault = Fault.from_xml(element)
+        # keep the fault code as sent by the server
+        fault.faultcode = element.find('faultcode').text
+        raise fault
+
+    def __deserialize_payload(self, descriptor, body):
+        if body.tag == '{%s}Fault' % soaplib.ns_soap_env:
+            self.__raise_fault(body)
+
+        out_message = descriptor.out_message
+        result = out_message.from_xml(body)
+
+        names = out_message._type_info.keys()
+        if len(names) == 0:
+            return None
+
+        if len(names) == 1:
+            return getattr(result, names[0])
+
+        return [getattr(result, k) for k in names]
+
+class ServiceClient(ServiceClientBase):
+    '''
+    A blocking client that sends its requests over persistent connections,
+    at most max_per_host at a time per host. Instances can be shared between
+    threads.
+    '''
+
+    def __init__(self, url, service, tns=None, max_per_host=4, timeout=None,
+                                                      connection_pool=None):
+        ServiceClientBase.__init__(self, url, service, tns)
+
+        if connection_pool is None:
+            connection_pool = ConnectionPool(max_idle=max_per_host,
+                                  timeout=timeout, max_per_host=max_per_host)
+
+        self.connection_pool = connection_pool
+
+    def call(self, descriptor, *args, **kwargs):
+        data, headers = self.serialize_request(descriptor, args, kwargs)
+
+        status, reason, resp_headers, resp_data = \
+                   self.connection_pool.request('POST', self.url, data, headers)
+
+        return self.deserialize_response(descriptor, status, resp_data)
+
+    def call_batch(self, calls):
+        '''Sends the given calls in one request to the batch operation of the
+        server, which must have batch_enabled set. calls is a sequence of
+        (method_name, args) tuples. Returns the results in the same order.
+        Calls that fail have their Fault in place of their result.
+        '''
+
+        data, headers = self.serialize_batch_request(calls)
+
+        status, reason, resp_headers, resp_data = \
+                   self.connection_pool.request('POST', self.url, data, headers)
+
+        return self.deserialize_batch_response(calls, status, resp_data)
+
+    def call_concurrently(self, calls, workers=None):
+        '''Runs the given calls in parallel, over up to workers connections.
+        calls is a sequence of (method_name, args) tuples. Returns the
+        results in the same order. Calls that fail have the exception they
+        raised in place of their result.
+        '''
+
+        if workers is None:
+            workers = self.connection_pool.max_per_host or 4
+
+        retval = [None] * len(calls)
+        queue = Queue()
+        for i, call in enumerate(calls):
+            queue.put((i, call))
+
+        def run():
+            while True:
+                try:
+                    i, (name, args) = queue.get_nowait()
+                except Empty:
+                    return
+
+                try:
+                    retval[i] = self.call(self.methods[name], *args)
+                except Exception, e:
+                    retval[i] = e
+
+        threads = [threading.Thread(target=run)
+                                   for i in range(min(workers, len(calls)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return retval
+
+def make_service_client(url, service, tns=None, **kwargs):
+    '''Returns a ServiceClient for the given service, hosted at the given
+    url.
+    '''
+
+    return ServiceClient(url, service, tns, **kwargs)
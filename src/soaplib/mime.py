@@ -3,7 +3,12 @@ import logging
 logger = logging.getLogger(__name__)
 from lxml import etree
 
+import base64
+import quopri
+
+from base64 import b64decode
 from base64 import b64encode
+from tempfile import SpooledTemporaryFile
 from urllib import unquote
 
 # import email data format related stuff
@@ -22,6 +27,7 @@ from email import message_from_string
 
 # import soaplib stuff
 from soaplib.serializers.binary import Attachment
+from soaplib.serializers.exception import Fault
 
 import soaplib
 
@@ -89,10 +95,318 @@ def join_attachment(href_id, envelope, payload, prefix=True):
 
     return (etree.tostring(soaptree), numreplaces)
 
+def _parse_part_headers(data):
+    headers = {}
+    name = None
+
+    for line in data.split('\r\n'):
+        if line[:1] in (' ', '\t') and not (name is None):
+            # folded header
+            headers[name] += ' ' + line.strip()
+            continue
+
+        name, sep, value = line.partition(':')
+        name = name.strip().lower()
+        headers[name] = value.strip()
+
+    return headers
+
+def split_mtom(content_type, data):
+    '''
+    Splits an SwA or MTOM multipart/related message into its root part, which
+    is the soap envelope, and its attachments. The message is scanned once,
+    and the attachments are not copied: they are memoryviews of the given
+    data, unless they have a base64 or quoted-printable
+    Content-Transfer-Encoding, in which case they're decoded.
+
+    @param  content_type value of the Content-Type header field, parsed by
+                         cgi.parse_header() function
+    @param  data         body of the HTTP message
+    @return              tuple of length 2 with the soap envelope string and
+                         the dict of attachments, keyed by their 'cid:' urls
+                         and by their Content-Locations, i.e. by the hrefs
+                         that refer to them
+    '''
+
+    params = content_type[1]
+    boundary = params.get('boundary', None)
+    if boundary is None:
+        raise Fault('Client', 'The multipart message has no boundary')
+
+    root = params.get('start', None)
+    if not (root is None):
+        root = root.strip('<>')
+
+    delimiter = '--%s' % boundary
+    separator = '\r\n%s' % delimiter
+
+    view = memoryview(data)
+    envelope = None
+    attachments = {}
+
+    pos = data.find(delimiter)
+    if pos < 0:
+        raise Fault('Client', 'The multipart message has no parts')
+
+    while True:
+        pos += len(delimiter)
+        if data.startswith('--', pos):
+            break # close delimiter
+
+        # skip the transport padding
+        pos = data.find('\r\n', pos)
+        if pos < 0:
+            raise Fault('Client', 'Truncated multipart message')
+        pos += 2
+
+        if data.startswith('\r\n', pos):
+            headers = {}
+            body_start = pos + 2
+
+        else:
+            header_end = data.find('\r\n\r\n', pos)
+            if header_end < 0:
+                raise Fault('Client', 'Truncated multipart message')
+
+            headers = _parse_part_headers(data[pos:header_end])
+            body_start = header_end + 4
+
+        body_end = data.find(separator, body_start)
+        if body_end < 0:
+            raise Fault('Client', 'Truncated multipart message')
+
+        pos = body_end + 2
+
+        cid = headers.get('content-id', '').strip('<>')
+        if envelope is None and (root is None or root == cid):
+            envelope = data[body_start:body_end]
+            continue
+
+        cte = headers.get('content-transfer-encoding', '').lower()
+        if cte == 'base64':
+            payload = b64decode(data[body_start:body_end])
+        elif cte == 'quoted-printable':
+            payload = quopri.decodestring(data[body_start:body_end])
+        else:
+            payload = view[body_start:body_end]
+
+        if cid:
+            attachments['cid:%s' % cid] = payload
+
+        location = headers.get('content-location', None)
+        if location:
+            attachments[location] = payload
+
+    if envelope is None:
+        raise Fault('Client', 'The multipart message has no root part')
+
+    return envelope, attachments
+
+_PREAMBLE, _DELIMITER, _HEADERS, _BODY, _EPILOGUE = range(5)
+
+class MultipartParser(object):
+    '''
+    Incremental parser for SwA and MTOM multipart/related messages. The
+    message is fed in chunks of arbitrary size, and every part is written to
+    its own SpooledTemporaryFile as it arrives, so the parts that are larger
+    than spool_size bytes end up on disk instead of in memory. Parts with a
+    base64 or quoted-printable Content-Transfer-Encoding are decoded once
+    they're complete.
+
+    The root part is the one whose Content-ID is the start parameter of the
+    Content-Type, or the first one when there's no such parameter.
+    '''
+
+    def __init__(self, content_type, spool_size=1024 * 1024):
+        '''
+        @param  content_type value of the Content-Type header field, parsed by
+                             cgi.parse_header() function
+        @param  spool_size   the size past which the parts are written to
+                             disk
+        '''
+
+        params = content_type[1]
+        boundary = params.get('boundary', None)
+        if boundary is None:
+            raise Fault('Client', 'The multipart message has no boundary')
+
+        self.root = params.get('start', None)
+        if not (self.root is None):
+            self.root = self.root.strip('<>')
+
+        self.spool_size = spool_size
+        self.envelope = None
+        self.attachments = {}
+
+        self.__delimiter = '--%s' % boundary
+        self.__separator = '\r\n--%s' % boundary
+        self.__state = _PREAMBLE
+        self.__buffer = ''
+        self.__part = None
+        self.__headers = None
+
+    def feed(self, data):
+        '''Parses the given chunk of the message.'''
+
+        self.__buffer += data
+
+        while self.__parse():
+            pass
+
+    def close(self):
+        '''Returns a tuple of length 2 with the file object of the root
+        part and the dict of attachments, keyed by their 'cid:' urls and by
+        their Content-Locations. The file objects are rewound.
+        '''
+
+        if self.__state != _EPILOGUE:
+            raise Fault('Client', 'Truncated multipart message')
+
+        if self.envelope is None:
+            raise Fault('Client', 'The multipart message has no root part')
+
+        self.envelope.seek(0)
+        for f in self.attachments.values():
+            f.seek(0)
+
+        return self.envelope, self.attachments
+
+    def __parse(self):
+        '''Consumes what it can from the buffer. Returns True when the parser
+        moved to another state, i.e. when it should be called again.
+        '''
+
+        buffer = self.__buffer
+        state = self.__state
+
+        if state == _PREAMBLE:
+            i = buffer.find(self.__delimiter)
+            if i < 0:
+                self.__buffer = buffer[-len(self.__delimiter):]
+                return False
+
+            self.__buffer = buffer[i + len(self.__delimiter):]
+            self.__state = _DELIMITER
+
+        elif state == _DELIMITER:
+            if len(buffer) < 2:
+                return False
+
+            if buffer.startswith('--'):
+                self.__buffer = ''
+                self.__state = _EPILOGUE
+                return False
+
+            # skip the transport padding
+            i = buffer.find('\r\n')
+            if i < 0:
+                return False
+
+            self.__buffer = buffer[i + 2:]
+            self.__state = _HEADERS
+
+        elif state == _HEADERS:
+            if buffer.startswith('\r\n'):
+                headers = {}
+                self.__buffer = buffer[2:]
+
+            else:
+                i = buffer.find('\r\n\r\n')
+                if i < 0:
+                    return False
+
+                headers = _parse_part_headers(buffer[:i])
+                self.__buffer = buffer[i + 4:]
+
+            self.__start_part(headers)
+            self.__state = _BODY
+
+        elif state == _BODY:
+            i = buffer.find(self.__separator)
+            if i < 0:
+                # keep what could be the beginning of the separator
+                keep = len(self.__separator) - 1
+                if len(buffer) > keep:
+                    self.__part.write(buffer[:-keep])
+                    self.__buffer = buffer[-keep:]
+
+                return False
+
+            self.__part.write(buffer[:i])
+            self.__buffer = buffer[i + len(self.__separator):]
+            self.__end_part()
+            self.__state = _DELIMITER
+
+        else:
+            self.__buffer = ''
+            return False
+
+        return True
+
+    def __start_part(self, headers):
+        self.__part = SpooledTemporaryFile(self.spool_size)
+        self.__headers = headers
+
+    def __end_part(self):
+        headers = self.__headers
+        part = self.__part
+        self.__part = None
+
+        cid = headers.get('content-id', '').strip('<>')
+        if self.envelope is None and (self.root is None or self.root == cid):
+            self.envelope = part
+            return
+
+        cte = headers.get('content-transfer-encoding', '').lower()
+        if cte in ('base64', 'quoted-printable'):
+            decoded = SpooledTemporaryFile(self.spool_size)
+
+            part.seek(0)
+            if cte == 'base64':
+                base64.decode(part, decoded)
+            else:
+                quopri.decode(part, decoded)
+
+            part.close()
+            part = decoded
+
+        if cid:
+            self.attachments['cid:%s' % cid] = part
+
+        location = headers.get('content-location', None)
+        if location:
+            self.attachments[location] = part
+
+def parse_mtom(content_type, stream, spool_size=1024 * 1024,
+                                                       chunk_size=64 * 1024):
+    '''
+    Reads an SwA or MTOM multipart/related message from the given file-like
+    object, chunk_size bytes at a time, using a MultipartParser.
+
+    @return tuple of length 2 with the file object of the soap envelope and
+            the dict of attachment file objects, keyed by their 'cid:' urls
+            and by their Content-Locations
+    '''
+
+    parser = MultipartParser(content_type, spool_size)
+
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+
+        parser.feed(data)
+
+    return parser.close()
+
 def collapse_swa(content_type, envelope):
     '''
     Translates an SwA multipart/related message into an
-    application/soap+xml message.
+    application/soap+xml message, where attachments are base64 encoded
+    in place of the xop:Include elements or hrefs that refer to them.
+
+    Deserializing the message returned by split_mtom along with its
+    attachments avoids the base64 round trip.
 
     References:
     SwA     http://www.w3.org/TR/SOAP-attachments
@@ -107,62 +421,31 @@ def collapse_swa(content_type, envelope):
     '''
 
     # convert multipart messages back to pure SOAP
-    mime_type = content_type[0]
-
-    if 'multipart/related' not in mime_type:
+    if 'multipart/related' not in content_type[0]:
         return envelope
 
-    charset = content_type[1].get('charset', None)
-    if charset is None:
-        charset='ascii'
-
-    # parse the body into an email.Message object
-    msg_string = [
-        "MIME-Version: 1.0",
-        "Content-Type: %s; charset=%s" % (mime_type, charset),
-        "",
-        envelope
-    ]
-
-    msg = message_from_string('\r\n'.join(msg_string)) # our message
+    soapmsg, attachments = split_mtom(content_type, envelope)
+    if len(attachments) == 0:
+        return soapmsg
 
-    soapmsg = None
-    root = msg.get_param('start')
+    soaptree = etree.fromstring(soapmsg)
 
-    # walk through sections, reconstructing pure SOAP
-    for part in msg.walk():
-        # skip the multipart container section
-        if part.get_content_maintype() == 'multipart':
-            continue
-
-        # detect main soap section
-        if (part.get('Content-ID') and part.get('Content-ID') == root) or \
-           (root == None and part == msg.get_payload()[0]):
-            soapmsg = part.get_payload()
-            continue
-
-        # binary packages
-        cte = part.get("Content-Transfer-Encoding")
-
-        payload = None
-        if cte != 'base64':
-            payload = b64encode(part.get_payload())
-        else:
-            payload = part.get_payload()
-
-        cid = part.get("Content-ID").strip("<>")
-        cloc = part.get("Content-Location")
-        numreplaces = None
-
-        # Check for Content-ID and make replacement
-        if cid:
-            soapmsg, numreplaces = join_attachment(cid, soapmsg, payload)
+    for include in list(soaptree.iter('{%s}Include' % soaplib.ns_xop)):
+        payload = attachments.get(unquote(include.get('href', '')), None)
+        if not (payload is None):
+            parent = include.getparent()
+            parent.remove(include)
+            parent.text = b64encode(payload)
 
-        # Check for Content-Location and make replacement
-        if cloc and not cid and not numreplaces:
-            soapmsg, numreplaces = join_attachment(cloc, soapmsg, payload, False)
+    for element in soaptree.iter():
+        href = element.get('href')
+        if not (href is None):
+            payload = attachments.get(unquote(href), None)
+            if not (payload is None):
+                del element.attrib['href']
+                element.text = b64encode(payload)
 
-    return soapmsg
+    return etree.tostring(soaptree)
 
 def apply_mtom(headers, envelope, params, paramvals):
     '''
@@ -248,7 +531,7 @@ def apply_mtom(headers, envelope, params, paramvals):
             incl = etree.SubElement(param, "{%s}Include" % soaplib.ns_xop)
             incl.attrib["href"] = "cid:%s" % id
 
-            if paramvals[i].fileName and not paramvals[i].data:
+            if paramvals[i].file_name and not paramvals[i].data:
                 paramvals[i].load_from_file()
 
             data = paramvals[i].data
@@ -17,6 +17,9 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 #
 
+import datetime
+import decimal
+
 import soaplib
 
 from lxml import etree
@@ -37,10 +40,45 @@ def nillable_element(func):
             return func(cls, element)
     return wrapper
 
+@nillable_value
+def codec_to_xml(cls, value, tns, parent_elt, name='retval'):
+    etree.SubElement(parent_elt, "{%s}%s" % (tns, name)).text = \
+                                                          cls.to_string(value)
+
+@nillable_element
+def codec_from_xml(cls, element):
+    return cls.from_string(element.text)
+
+def has_codec(cls):
+    '''Returns True when the given serializer class is (de)serialized by its
+    to_string and from_string methods, i.e. when it uses codec_to_xml and
+    codec_from_xml as its to_xml and from_xml methods.'''
+
+    return getattr(cls.to_xml, 'im_func', None) is codec_to_xml and \
+           getattr(cls.from_xml, 'im_func', None) is codec_from_xml
+
+# subclasses are not in there, as they can override __str__ or isoformat.
+safe_text_types = frozenset((bool, int, long, float, decimal.Decimal,
+                                         datetime.date, datetime.datetime))
+
+def is_safe_text(values):
+    '''Returns True when the given values are all of the builtin types that
+    the to_string methods of the __safe_text__ serializers turn into text
+    that never needs escaping: numbers, dates and booleans. Values of other
+    types can be passed to these serializers, so their text has to be
+    escaped like any other.'''
+
+    return safe_text_types.issuperset(map(type, values))
+
 class Base(object):
+    __slots__ = ()
+
     __namespace__ = None
     __type_name__ = None
 
+    # True when the output of to_string never needs to be escaped in xml.
+    __safe_text__ = False
+
     # There are not the xml schema defaults. The xml schema defaults are
     # considered in ClassSerializer's add_to_schema method. the defaults here
     # are to reflect what people want most.
@@ -113,8 +151,17 @@ class Base(object):
 
         cls_dict = {}
 
+        # the slot descriptors of the original class don't work for the
+        # duplicate, which gets its own from __slots__.
+        skip = set(("__dict__", "__weakref__", "_plan"))
+        slots = cls.__dict__.get('__slots__', ())
+        if isinstance(slots, basestring):
+            slots = (slots,)
+        skip.update(slots)
+
         for k in cls.__dict__:
-            if not (k in ("__dict__", "__weakref__")):
+            # compiled serializer plans belong to the original class.
+            if not (k in skip):
                 cls_dict[k] = cls.__dict__[k]
 
         class Attributes(cls.Attributes):
@@ -19,19 +19,86 @@
 
 import base64
 import cStringIO
+import shutil
+import threading
+
+from urllib import unquote
+
+import soaplib
 
 from soaplib.serializers.base import Base
 from soaplib.serializers import nillable_value, nillable_element
 
 from lxml import etree
 
+_local = threading.local()
+_xop_include = '{%s}Include' % soaplib.ns_xop
+
+def bind_attachments(attachments):
+    '''
+    Makes the given dict of MIME attachments, keyed by their 'cid:' urls and
+    Content-Locations, available to the Attachment.from_xml calls of the
+    current thread. Returns the previously bound dict, which should be bound
+    back once the request is deserialized.
+    '''
+
+    retval = getattr(_local, 'attachments', None)
+    _local.attachments = attachments
+
+    return retval
+
+def get_attachment(element):
+    '''
+    Returns the data of the MIME attachment the given element refers to,
+    either with an xop:Include child (MTOM) or with an href attribute (SwA),
+    or None when there's no such attachment.
+    '''
+
+    attachments = getattr(_local, 'attachments', None)
+    if not attachments:
+        return None
+
+    href = element.get('href')
+    if href is None:
+        for child in element:
+            if child.tag == _xop_include:
+                href = child.get('href')
+                break
+
+        else:
+            return None
+
+    return attachments.get(unquote(href), None)
+
 class Attachment(Base):
     __type_name__ = 'base64Binary'
     __namespace__ = "http://www.w3.org/2001/XMLSchema"
 
-    def __init__(self, data=None, file_name=None):
-        self.data = data
+    def __init__(self, data=None, file_name=None, file=None):
+        '''
+        @param data      the attachment data
+        @param file_name the name of the file the data is loaded from or
+                         saved to
+        @param file      a file object that contains the attachment data, as
+                         given to the attachments of multipart requests. The
+                         data attribute reads it on first access.
+        '''
+
+        self.__data = data
         self.file_name = file_name
+        self.file = file
+
+    def __get_data(self):
+        if self.__data is None and not (self.file is None):
+            self.file.seek(0)
+            self.__data = self.file.read()
+
+        return self.__data
+
+    def __set_data(self, data):
+        self.__data = data
+
+    data = property(__get_data, __set_data)
 
     def save_to_file(self):
         '''
@@ -42,14 +109,26 @@ class Attachment(Base):
         disk.
         '''
 
-        if not self.data:
+        if self.file is None and not self.data:
             raise Exception("No data to write")
 
         if not self.file_name:
             raise Exception("No file_name specified")
 
         f = open(self.file_name, 'wb')
-        f.write(self.data)
+        if self.__data is None and not (self.file is None):
+            self.file.seek(0)
+            shutil.copyfileobj(self.file, f)
+
+        elif isinstance(self.data, memoryview):
+            # the attachments returned by mime.split_mtom are memoryviews,
+            # which file objects can't write.
+            for i in range(0, len(self.data), 1 << 20):
+                f.write(self.data[i:i + (1 << 20)].tobytes())
+
+        else:
+            f.write(self.data)
+
         f.close()
 
     def load_from_file(self):
@@ -103,8 +182,15 @@ class Attachment(Base):
     def from_xml(cls, element):
         '''
         This method returns an Attachment object that contains
-        the base64 decoded string of the text of the given element
+        the base64 decoded string of the text of the given element, or the
+        MIME attachment the element refers to, as is.
         '''
-        data = base64.decodestring(element.text)
+        data = get_attachment(element)
+        if hasattr(data, 'read'):
+            return Attachment(file=data)
+
+        if data is None:
+            data = base64.decodestring(element.text)
+
         a = Attachment(data=data)
         return a
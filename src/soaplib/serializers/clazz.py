@@ -17,11 +17,24 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 #
 
+import array
+import keyword
+import re
+
 from lxml import etree
+from xml.sax.saxutils import quoteattr
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import soaplib
 
 from soaplib.serializers import Base
+from soaplib.serializers import Null
+from soaplib.serializers import has_codec
+from soaplib.serializers import is_safe_text
 from soaplib.serializers import nillable_element
 from soaplib.serializers import nillable_value
 
@@ -83,11 +96,186 @@ class ClassSerializerMeta(type(Base)):
         else:
             _type_info = cls_dict['_type_info']
             if not isinstance(_type_info, TypeInfo):
-                cls_dict['_type_info'] = TypeInfo(_type_info)
+                cls_dict['_type_info'] = _type_info = TypeInfo(_type_info)
+
+        if not ('__slots__' in cls_dict):
+            _set_slots(cls_bases, cls_dict, _type_info)
 
         return type.__new__(cls, cls_name, cls_bases, cls_dict)
 
+_identifier = re.compile('^[A-Za-z_][A-Za-z0-9_]*$')
+
+def _get_slots(cls):
+    retval = set()
+
+    for c in cls.__mro__:
+        slots = c.__dict__.get('__slots__', ())
+        if isinstance(slots, basestring):
+            slots = (slots,)
+
+        retval.update(slots)
+
+    return retval
+
+def _set_slots(cls_bases, cls_dict, type_info):
+    '''Makes the members of the class slots, so that its instances don't
+    carry a __dict__ when the instances of its bases don't either. Classes
+    with members whose names can't be slot names are left alone.
+    '''
+
+    for k in type_info:
+        if k.startswith('__') or keyword.iskeyword(k) or \
+                                                   not _identifier.match(k):
+            return
+
+    inherited = set()
+    for b in cls_bases:
+        inherited.update(_get_slots(b))
+
+    # the order of _type_info follows the one of the class dict, which
+    # depends on string hashes. slots are sorted so that the layout of the
+    # instances is the same on every run.
+    cls_dict['__slots__'] = tuple(sorted([k for k in type_info
+                                                    if not (k in inherited)]))
+
+    # the member types are in _type_info. as class attributes, they would
+    # hide the slots.
+    for k in type_info:
+        cls_dict.pop(k, None)
+
+    # instances without a __dict__ can't be extended anyway, so the check in
+    # NonExtendingClass.__setattr__ is skipped.
+    if not ('__setattr__' in cls_dict) and \
+                            not any([b.__dictoffset__ for b in cls_bases]):
+        cls_dict['__setattr__'] = object.__setattr__
+
+_nil_attr = '{%s}nil' % soaplib.ns_xsi
+
+def _is_array(serializer):
+    mo = serializer.Attributes.max_occurs
+    return mo == 'unbounded' or mo > 1
+
+def _make_encoder(serializer, ns, name):
+    '''Returns a function that serializes a member value as a child of the
+    given parent element.'''
+
+    if not has_codec(serializer):
+        def encode(value, parent):
+            serializer.to_xml(value, ns, parent, name)
+
+        return encode
+
+    # primitives are serialized here, bypassing the to_xml wrappers.
+    tag = '{%s}%s' % (ns, name)
+    to_string = serializer.to_string
+    sub_element = etree.SubElement
+
+    def encode(value, parent):
+        if value is None:
+            sub_element(parent, tag).set(_nil_attr, 'true')
+        else:
+            sub_element(parent, tag).text = to_string(value)
+
+    return encode
+
+def _make_decoder(serializer):
+    '''Returns a function that deserializes a member element.'''
+
+    if not has_codec(serializer):
+        return serializer.from_xml
+
+    from_string = serializer.from_string
+
+    # xsi:nil is looked for even when the member is not nillable, as clients
+    # can send it anyway.
+    def decode(element):
+        if element.get(_nil_attr):
+            return None
+
+        return from_string(element.text)
+
+    return decode
+
+def _bulk_element(parent_elt, tns, name, ns, member_name, texts):
+    """Returns the array element with the given member texts as children,
+    parsed from a single string instead of being built one child at a time.
+    Prefixes already in scope of parent_elt are reused, so that the
+    redundant declarations are dropped when the element is appended to it.
+    """
+
+    scope = parent_elt.nsmap
+    prefixes = dict([(v, k) for k, v in scope.items() if not (k is None)])
+
+    declarations = []
+    for n in (tns, ns):
+        if n in prefixes and not (n in declarations):
+            declarations.append(n)
+
+    i = 0
+    for n in (tns, ns):
+        if not (n in prefixes):
+            while ('ns%d' % i) in scope:
+                i += 1
+            prefixes[n] = 'ns%d' % i
+            declarations.append(n)
+            i += 1
+
+    xmlns = ''.join([' xmlns:%s=%s' % (prefixes[n], quoteattr(n))
+                                                      for n in declarations])
+    tag = '%s:%s' % (prefixes[tns], name)
+    member_tag = '%s:%s' % (prefixes[ns], member_name)
+
+    return etree.fromstring('<%s%s><%s>%s</%s></%s>' % (tag, xmlns,
+        member_tag, ('</%s><%s>' % (member_tag, member_tag)).join(texts),
+        member_tag, tag))
+
+class TypePlan(object):
+    '''
+    The flattened, precompiled member information of a ClassSerializer. It's
+    compiled once, on first use, so that (de)serialization doesn't have to
+    walk _type_info and the __extends__ chain for every element.
+
+    fields is the ordered sequence of (name, serializer, is_array, namespace)
+    tuples, parent members first. tags maps member names to
+    (serializer, is_array) tuples. encoders is the ordered sequence of
+    (name, is_array, encode) tuples and decoders maps member names to
+    (decode, is_array) tuples, where encode and decode are functions that
+    (de)serialize a member value, with a shortcut for primitives.
+    '''
+
+    def __init__(self, cls):
+        fields = []
+
+        parent_cls = getattr(cls, '__extends__', None)
+        if not (parent_cls is None):
+            fields.extend(parent_cls.get_plan().fields)
+
+        ns = cls.get_namespace()
+        for k, v in cls._type_info.items():
+            fields.append( (k, v, _is_array(v), ns) )
+
+        # members of the child class take precedence, as they come last.
+        tags = {}
+        for k, v, is_array, ns in fields:
+            tags[k] = (v, is_array)
+
+        names = []
+        for k, v, is_array, ns in fields:
+            if not (k in names):
+                names.append(k)
+
+        self.fields = tuple(fields)
+        self.names = tuple(names)
+        self.tags = tags
+
+        self.encoders = tuple([(k, is_array, _make_encoder(v, ns, k))
+                                        for k, v, is_array, ns in fields])
+        self.decoders = dict([(k, (_make_decoder(v), is_array))
+                                        for k, (v, is_array) in tags.items()])
+
 class NonExtendingClass(object):
+    __slots__ = ()
+
     def __setattr__(self, k, v):
         if not hasattr(self,k) and getattr(self, '__NO_EXTENSION', False):
             raise Exception("'%s' object is not extendable at this point in "
@@ -101,16 +289,38 @@ class ClassSerializerBase(NonExtendingClass, Base):
     inherit from
     """
 
+    __slots__ = ()
+
     def __init__(self, **kwargs):
-        #print self.__class__
-        super(ClassSerializerBase,self).__init__(**kwargs)
+        super(ClassSerializerBase,self).__init__()
+
+        names = self.get_plan().names
+        if kwargs:
+            for k in names:
+                setattr(self, k, kwargs.get(k, None))
 
-        cls = self.__class__
-        for k in cls._type_info.keys():
-            setattr(self, k, kwargs.get(k, None))
-            #print k
+        else:
+            for k in names:
+                setattr(self, k, None)
 
-        self.__NO_EXTENSION=True
+    def __getstate__(self):
+        # instances with slots can't be pickled by the protocols before 2
+        # otherwise.
+        slots = {}
+        for k in _get_slots(self.__class__):
+            if not (k in ('__dict__', '__weakref__')) and hasattr(self, k):
+                slots[k] = getattr(self, k)
+
+        return getattr(self, '__dict__', None), slots
+
+    def __setstate__(self, state):
+        attrs, slots = state
+
+        if attrs:
+            self.__dict__.update(attrs)
+
+        for k, v in slots.items():
+            setattr(self, k, v)
 
     def __len__(self):
         return len(self._type_info)
@@ -150,22 +360,76 @@ class ClassSerializerBase(NonExtendingClass, Base):
         return cls()
 
     @classmethod
-    def get_members(cls, inst, parent):
-        parent_cls = getattr(cls, '__extends__', None)
-        if not (parent_cls is None):
-            parent_cls.get_members(inst, parent)
+    def get_plan(cls):
+        """Returns the TypePlan of this class, compiling it on first use."""
 
-        for k, v in cls._type_info.items():
-            mo = v.Attributes.max_occurs
+        # the plan is looked up in the class' own dict, so that subclasses
+        # don't pick up the plan of their parents.
+        plan = cls.__dict__.get('_plan', None)
+        if plan is None:
+            plan = cls._plan = TypePlan(cls)
+
+        return plan
+
+    @classmethod
+    def reset_plan(cls):
+        """Throws away the compiled TypePlan. Must be called whenever the
+        members of the class or their namespaces change.
+        """
+
+        cls._plan = None
+
+    @classmethod
+    def get_members(cls, inst, parent):
+        for k, is_array, encode in cls.get_plan().encoders:
             subvalue = getattr(inst, k, None)
 
-            if mo == 'unbounded' or mo > 1:
-                if subvalue != None:
+            if is_array:
+                if not (subvalue is None):
                     for sv in subvalue:
-                        v.to_xml(sv, cls.get_namespace(), parent, k)
+                        encode(sv, parent)
+
+            else:
+                encode(subvalue, parent)
+
+    @classmethod
+    def get_members_stream(cls, inst, parent, streams):
+        """Same as get_members, but array members are not serialized. Their
+        place is marked with a comment node instead, and a
+        (marker, values, serializer, namespace, name) tuple is appended to
+        the streams list so that the items can be serialized one by one
+        later on.
+        """
+
+        for k, v, is_array, ns in cls.get_plan().fields:
+            subvalue = getattr(inst, k, None)
+
+            if is_array:
+                if not (subvalue is None):
+                    marker = etree.Comment('soaplib-stream-%d' % len(streams))
+                    parent.append(marker)
+                    streams.append( (marker, subvalue, v, ns, k) )
+
+            elif issubclass(v, ClassSerializerBase) and not (subvalue is None):
+                v.to_xml_stream(subvalue, ns, parent, k, streams)
 
             else:
-                v.to_xml(subvalue, cls.get_namespace(), parent, k)
+                v.to_xml(subvalue, ns, parent, k)
+
+    @classmethod
+    def to_xml_stream(cls, value, tns, parent_elt, name, streams):
+        """Serializes the value, leaving placeholders for array members. See
+        get_members_stream.
+        """
+
+        if value is None:
+            Null.to_xml(value, tns, parent_elt, name)
+
+        else:
+            element = etree.SubElement(parent_elt, "{%s}%s" % (tns, name))
+            inst = cls.get_serialization_instance(value)
+
+            cls.get_members_stream(inst, element, streams)
 
     @classmethod
     @nillable_value
@@ -184,6 +448,7 @@ class ClassSerializerBase(NonExtendingClass, Base):
     @nillable_element
     def from_xml(cls, element):
         inst = cls.get_deserialization_instance()
+        decoders = cls.get_plan().decoders
 
         for c in element:
             if isinstance(c, etree._Comment):
@@ -191,27 +456,22 @@ class ClassSerializerBase(NonExtendingClass, Base):
 
             key = c.tag.split('}')[-1]
 
-            member = cls._type_info.get(key, None)
-            clz = getattr(cls,'__extends__', None)
-            while not (clz is None) and (member is None):
-                member = clz._type_info.get(key, None)
-                clz = getattr(clz,'__extends__', None)
-
-            if member is None:
+            field = decoders.get(key, None)
+            if field is None:
                 raise Exception('the %s object does not have a "%s" member' %
                                                              (cls.__name__,key))
 
-            mo = member.Attributes.max_occurs
-            if mo == 'unbounded' or mo > 1:
+            decode, is_array = field
+            if is_array:
                 value = getattr(inst, key, None)
                 if value is None:
                     value = []
 
-                value.append(member.from_xml(c))
+                value.append(decode(c))
                 setattr(inst, key, value)
 
             else:
-                setattr(inst, key, member.from_xml(c))
+                setattr(inst, key, decode(c))
 
         return inst
 
@@ -221,6 +481,7 @@ class ClassSerializerBase(NonExtendingClass, Base):
             cls.__extends__.resolve_namespace(cls.__extends__, default_ns)
 
         Base.resolve_namespace(cls, default_ns)
+        cls.reset_plan()
 
         for k, v in cls._type_info.items():
             if v.__type_name__ is Base.Empty:
@@ -305,11 +566,38 @@ class ClassSerializer(ClassSerializerBase):
     customized duplicates of the original class definition.
     Those who'd like to customize the class should use the customize method.
     (see soaplib.serializers.base.Base)
+
+    The members of ClassSerializer instances are stored in slots generated by
+    the metaclass, so the instances have no __dict__ and new attributes can't
+    be set on them. Subclasses that need one can declare '__dict__' in their
+    own __slots__.
     """
 
     __metaclass__ = ClassSerializerMeta
 
 class Array(ClassSerializer):
+    """
+    The array of the given serializer. Arrays of primitives whose text needs
+    no escaping (numbers, dates and booleans) are (de)serialized in bulk.
+    Besides lists, such arrays can be serialized from array.array, memoryview
+    and numpy arrays.
+
+    Arrays are deserialized to lists, unless either the typecode attribute
+    is set, in which case they are deserialized to array.array instances of
+    the given typecode, or the dtype attribute is set, in which case they are
+    deserialized to numpy arrays of the given dtype. e.g.:
+
+        Array(Double, typecode='d')
+    """
+
+    class Attributes(ClassSerializer.Attributes):
+        typecode = None
+        dtype = None
+
+    # the member of an array is only known once it's customized, so arrays
+    # keep a __dict__.
+    __slots__ = ('__dict__',)
+
     def __new__(cls, serializer, ** kwargs):
         retval = cls.customize(**kwargs)
 
@@ -356,13 +644,64 @@ class Array(ClassSerializer):
             setattr(inst, member_name, value)
             return inst
 
+    @classmethod
+    @nillable_value
+    def to_xml(cls, value, tns, parent_elt, name=None):
+        if name is None:
+            name = cls.get_type_name()
+
+        if hasattr(value, 'tolist'):
+            # array.array, memoryview or numpy array
+            value = value.tolist()
+
+        ((k, serializer, is_array, ns),) = cls.get_plan().fields
+
+        # the texts are pasted into markup, so the values must be known to
+        # produce text that needs no escaping. namespaces that were not
+        # resolved are left to the per-item path.
+        if serializer.__safe_text__ and has_codec(serializer) and \
+                            tns and ns and isinstance(value, (list, tuple)) \
+                            and len(value) > 0 and is_safe_text(value):
+            parent_elt.append(_bulk_element(parent_elt, tns, name, ns, k,
+                                            map(serializer.to_string, value)))
+            return
+
+        element = etree.SubElement(parent_elt, "{%s}%s" % (tns, name))
+        cls.get_members(cls.get_serialization_instance(value), element)
+
     @classmethod
     @nillable_element
     def from_xml(cls, element):
-        retval = []
         (serializer,) = cls._type_info.values()
+        children = element.getchildren()
 
-        for child in element.getchildren():
-            retval.append(serializer.from_xml(child))
+        retval = None
+        if has_codec(serializer):
+            texts = [child.text for child in children]
 
-        return retval
+            # nil or empty children are left to from_xml.
+            if not (None in texts):
+                retval = map(serializer.from_string, texts)
+
+        if retval is None:
+            retval = [serializer.from_xml(child) for child in children]
+
+        return cls.from_list(retval)
+
+    @classmethod
+    def from_list(cls, values):
+        """Returns the deserialized array with the given items, according to
+        the typecode and dtype attributes.
+        """
+
+        if not (cls.Attributes.typecode is None):
+            return array.array(cls.Attributes.typecode, values)
+
+        if not (cls.Attributes.dtype is None):
+            if numpy is None:
+                raise Exception("numpy is needed to deserialize %s" %
+                                                            cls.get_type_name())
+
+            return numpy.array(values, dtype=cls.Attributes.dtype)
+
+        return values
@@ -0,0 +1,274 @@
+
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import re
+
+import soaplib
+
+from soaplib.serializers import has_codec
+from soaplib.serializers import is_safe_text
+from soaplib.serializers import safe_text_types
+from soaplib.serializers.clazz import Array
+from soaplib.serializers.clazz import ClassSerializerBase
+from soaplib.serializers.primitive import String
+
+# anything but the printable ascii characters that don't need escaping
+_special = re.compile(u'[^\t\n\x20-\x25\x27-\x3b\x3d\x3f-\x7e]')
+_invalid = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_unusual = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\x80-\xff]')
+
+_array_to_xml = Array.to_xml.im_func
+_class_to_xml = ClassSerializerBase.to_xml.im_func
+_class_get_members = ClassSerializerBase.get_members.im_func
+_string_to_string = String.to_string.im_func
+
+class UnsupportedType(Exception):
+    '''Raised when a type can't be serialized by the Emitter, e.g. because
+    it overrides to_xml.'''
+
+def escape(text):
+    '''Returns the given text as an escaped utf-8 string, the way lxml
+    serializes element texts.'''
+
+    # control characters don't occur in multibyte utf-8 sequences, so
+    # they're looked for in the encoded text.
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+
+    elif _unusual.search(text):
+        try:
+            text.decode('utf-8')
+        except UnicodeDecodeError:
+            text = '\x00' # rejected below, like lxml does.
+
+    if _invalid.search(text):
+        raise ValueError('All strings must be XML compatible: Unicode or '
+                         'ASCII, no NULL bytes or control characters')
+
+    return text.replace('&', '&amp;').replace('<', '&lt;') \
+               .replace('>', '&gt;').replace('\r', '&#13;')
+
+def _get(function, name):
+    return getattr(getattr(function, name, None), 'im_func', None)
+
+class Emitter(object):
+    '''
+    Serializes values as xml strings directly, without building element
+    trees, for the documents whose namespace declarations are those of the
+    given namespace map, e.g. the soap envelopes of an Application. The
+    output is the same as the one of etree.tostring(..., encoding='utf-8')
+    for the elements built by the to_xml methods.
+
+    ClassSerializers, Arrays, and primitives that have codecs are supported.
+    The start and end tags of every member are computed once, along with the
+    function that serializes it. UnsupportedType is raised for other types,
+    or when a namespace is not in the map.
+    '''
+
+    def __init__(self, nsmap):
+        # namespaces that are the default one, or that have more than one
+        # prefix are left to lxml.
+        self.prefixes = {}
+        ambiguous = set()
+        for prefix, ns in nsmap.items():
+            if prefix is None or ns in self.prefixes:
+                ambiguous.add(ns)
+            else:
+                self.prefixes[ns] = prefix
+
+        for ns in ambiguous:
+            self.prefixes.pop(ns, None)
+
+        self.__encoders = {}
+
+        xsi = self.prefixes.get(soaplib.ns_xsi, None)
+        if xsi is None:
+            raise UnsupportedType(soaplib.ns_xsi)
+
+        self.nil = ' %s:nil="true"/>' % xsi
+
+    def get_tag(self, ns, name):
+        prefix = self.prefixes.get(ns, None)
+        if prefix is None:
+            raise UnsupportedType(ns)
+
+        return '%s:%s' % (prefix, name)
+
+    def get_encoder(self, serializer, ns, name):
+        '''Returns the function that appends the serialized value of the
+        given type, as an element with the given name and namespace, to the
+        list of strings it's given.
+        '''
+
+        key = (serializer, ns, name)
+
+        retval = self.__encoders.get(key, None)
+        if retval is None:
+            try:
+                retval = self.__compile(serializer, ns, name)
+            except UnsupportedType, e:
+                retval = e
+
+            self.__encoders[key] = retval
+
+        if isinstance(retval, UnsupportedType):
+            raise retval
+
+        return retval
+
+    def __compile(self, serializer, ns, name):
+        tag = self.get_tag(ns, name)
+
+        start = '<%s>' % tag
+        end = '</%s>' % tag
+        empty = '<%s/>' % tag
+        nil = '<%s%s' % (tag, self.nil)
+
+        if has_codec(serializer):
+            to_string = serializer.to_string
+            special = _special.search
+
+            # String.to_string only decodes strs, which escape does as
+            # well, so it's skipped for them.
+            plain_str = _get(serializer, 'to_string') is _string_to_string
+
+            def encode_text(value, out):
+                if value is None:
+                    out.append(nil)
+                    return
+
+                if plain_str and value.__class__ is str:
+                    text = value
+                    if special(text):
+                        text = escape(text)
+
+                else:
+                    text = to_string(value)
+                    if special(text):
+                        text = escape(text)
+                    elif isinstance(text, unicode):
+                        text = str(text)
+
+                out.append(start)
+                out.append(text)
+                out.append(end)
+
+            if not serializer.__safe_text__:
+                return encode_text
+
+            # the text of numbers, dates and booleans is appended as is.
+            # values of other types are escaped like any other text.
+            def encode(value, out):
+                if value.__class__ in safe_text_types:
+                    out.append(start)
+                    out.append(to_string(value))
+                    out.append(end)
+
+                else:
+                    encode_text(value, out)
+
+            return encode
+
+        to_xml = _get(serializer, 'to_xml')
+
+        if to_xml is _array_to_xml:
+            ((k, member, is_array, member_ns),) = \
+                                             serializer.get_plan().fields
+            encode_member = self.get_encoder(member, member_ns, k)
+
+            # like Array.to_xml, arrays of numbers, dates and the like are
+            # serialized in bulk.
+            bulk = member.__safe_text__ and has_codec(member)
+            if bulk:
+                member_tag = self.get_tag(member_ns, k)
+                separator = '</%s><%s>' % (member_tag, member_tag)
+                bulk_start = '%s<%s>' % (start, member_tag)
+                bulk_end = '</%s>%s' % (member_tag, end)
+                to_string = member.to_string
+
+            def encode(value, out):
+                if value is None:
+                    out.append(nil)
+                    return
+
+                if hasattr(value, 'tolist'):
+                    # array.array, memoryview or numpy array
+                    value = value.tolist()
+
+                if bulk and isinstance(value, (list, tuple)) and \
+                                        len(value) > 0 and is_safe_text(value):
+                    out.append(bulk_start)
+                    out.append(separator.join(map(to_string, value)))
+                    out.append(bulk_end)
+                    return
+
+                pos = len(out)
+                out.append(start)
+                for v in value:
+                    encode_member(v, out)
+
+                if len(out) == pos + 1:
+                    out[pos] = empty
+                else:
+                    out.append(end)
+
+            return encode
+
+        if to_xml is _class_to_xml and \
+                        _get(serializer, 'get_members') is _class_get_members:
+            # the encoders of the members are looked up on first use, as
+            # classes can refer to themselves. so UnsupportedType can also be
+            # raised by encode.
+            members = []
+            get_serialization_instance = serializer.get_serialization_instance
+
+            def encode(value, out):
+                if value is None:
+                    out.append(nil)
+                    return
+
+                if len(members) == 0:
+                    members[:] = [(k, is_array,
+                             self.get_encoder(v, member_ns, k))
+                             for k, v, is_array, member_ns
+                                         in serializer.get_plan().fields]
+
+                inst = get_serialization_instance(value)
+
+                pos = len(out)
+                out.append(start)
+                for k, is_array, encode_member in members:
+                    subvalue = getattr(inst, k, None)
+
+                    if is_array:
+                        if not (subvalue is None):
+                            for sv in subvalue:
+                                encode_member(sv, out)
+
+                    else:
+                        encode_member(subvalue, out)
+
+                if len(out) == pos + 1:
+                    out[pos] = empty
+                else:
+                    out.append(end)
+
+            return encode
+
+        raise UnsupportedType(serializer)
@@ -26,6 +26,8 @@ from pytz import FixedOffset
 
 import soaplib
 from soaplib.serializers import SimpleType
+from soaplib.serializers import codec_from_xml
+from soaplib.serializers import codec_to_xml
 from soaplib.serializers import nillable_element
 from soaplib.serializers import nillable_value
 from soaplib.util.etreeconv import etree_to_dict
@@ -33,15 +35,26 @@ from soaplib.util.etreeconv import dict_to_etree
 
 string_encoding = 'utf-8'
 
-_date_pattern = r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})'
-_time_pattern = r'(?P<hr>\d{2}):(?P<min>\d{2}):(?P<sec>\d{2})(?P<sec_frac>\.\d+)?'
-_offset_pattern = r'(?P<tz_hr>[+-]\d{2}):(?P<tz_min>\d{2})'
-_datetime_pattern = _date_pattern + '[T ]' + _time_pattern
+_date_re = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
 
-_local_re = re.compile(_datetime_pattern)
-_utc_re = re.compile(_datetime_pattern + 'Z')
-_offset_re = re.compile(_datetime_pattern + _offset_pattern)
-_date_re = re.compile(_date_pattern)
+# matches the utc, offset and local forms in one pass. the groups are: year,
+# month, day, hr, min, sec, sec_frac, 'Z', tz_sign, tz_hr, tz_min
+_datetime_re = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})'
+                          r'(?:\.(\d+))?(?:(Z)|([+-])(\d{2}):(\d{2}))?')
+
+# FixedOffset instances, by offset in minutes
+_offsets = {}
+
+def _get_offset(sign, hr, min):
+    minutes = int(hr) * 60 + int(min)
+    if sign == '-':
+        minutes = -minutes
+
+    retval = _offsets.get(minutes, None)
+    if retval is None:
+        retval = _offsets[minutes] = FixedOffset(minutes)
+
+    return retval
 
 _ns_xs = soaplib.ns_xsd
 _ns_xsi = soaplib.ns_xsi
@@ -132,151 +145,161 @@ class String(SimpleType):
                 pattern = etree.SubElement(restriction, '{%s}pattern' % _ns_xs)
                 pattern.set('value', cls.Attributes.pattern)
 
+    to_xml = classmethod(codec_to_xml)
+    from_xml = classmethod(codec_from_xml)
+
     @classmethod
-    @nillable_value
-    def to_xml(cls, value, tns, parent_elt, name='retval'):
-        if not isinstance(value, unicode):
-            value = unicode(value, string_encoding)
+    def to_string(cls, value):
+        if isinstance(value, unicode):
+            return value
 
-        SimpleType.to_xml(value, tns, parent_elt, name)
+        return unicode(value, string_encoding)
 
     @classmethod
-    @nillable_element
-    def from_xml(cls, element):
-        u = element.text or ""
-        try:
-            u = str(u)
-            return u.encode(string_encoding)
+    def from_string(cls, string):
+        # lxml returns str for ascii-only text, unicode otherwise. ascii-only
+        # unicode values are returned as str all the same.
+        if string is None:
+            return ""
+
+        if isinstance(string, unicode):
+            try:
+                return str(string)
+            except UnicodeEncodeError:
+                return string
 
-        except:
-            return u
+        return string
 
 class AnyUri(String):
     __type_name__ = 'anyURI'
 
 class Decimal(SimpleType):
+    __safe_text__ = True
+
+    to_xml = classmethod(codec_to_xml)
+    from_xml = classmethod(codec_from_xml)
+
     @classmethod
-    @nillable_value
-    def to_xml(cls, value, tns, parent_elt, name='retval'):
-        SimpleType.to_xml(str(value), tns, parent_elt, name)
+    def to_string(cls, value):
+        return str(value)
 
     @classmethod
-    @nillable_element
-    def from_xml(cls, element):
-        return decimal.Decimal(element.text)
+    def from_string(cls, string):
+        return decimal.Decimal(string)
 
 class Integer(Decimal):
     @classmethod
-    @nillable_element
-    def from_xml(cls, element):
-        i = element.text
-
-        try:
-            return int(i)
-        except:
-            return long(i)
+    def from_string(cls, string):
+        # int() returns a long when the value doesn't fit in an int.
+        return int(string)
 
 class Date(SimpleType):
+    __safe_text__ = True
+
+    to_xml = classmethod(codec_to_xml)
+    from_xml = classmethod(codec_from_xml)
+
     @classmethod
-    @nillable_value
-    def to_xml(cls, value, tns, parent_elt, name='retval'):
-        SimpleType.to_xml(value.isoformat(), tns, parent_elt, name)
+    def to_string(cls, value):
+        return value.isoformat()
 
     @classmethod
-    @nillable_element
-    def from_xml(cls, element):
+    def from_string(cls, string):
         """expect ISO formatted dates"""
-        text = element.text
-
-        def parse_date(date_match):
-            fields = date_match.groupdict(0)
-            year, month, day = [int(fields[x]) for x in
-                ("year", "month", "day")]
-            return datetime.date(year, month, day)
 
-        match = _date_re.match(text)
+        match = _date_re.match(string)
         if not match:
-            raise Exception("Date [%s] not in known format" % text)
+            raise Exception("Date [%s] not in known format" % string)
 
-        return parse_date(match)
+        year, month, day = match.groups()
+        return datetime.date(int(year), int(month), int(day))
 
 class DateTime(SimpleType):
     __type_name__ = 'dateTime'
+    __safe_text__ = True
+
+    to_xml = classmethod(codec_to_xml)
+    from_xml = classmethod(codec_from_xml)
 
     @classmethod
-    @nillable_value
-    def to_xml(cls, value, tns, parent_elt, name='retval'):
-        SimpleType.to_xml(value.isoformat('T'), tns, parent_elt, name)
+    def to_string(cls, value):
+        return value.isoformat('T')
 
     @classmethod
-    @nillable_element
-    def from_xml(cls, element):
+    def from_string(cls, string):
         """expect ISO formatted dates"""
 
-        text = element.text
-        def parse_date(date_match, tz=None):
-            fields = date_match.groupdict(0)
-            year, month, day, hr, min, sec = [int(fields[x]) for x in
-                ("year", "month", "day", "hr", "min", "sec")]
-            # use of decimal module here (rather than float) might be better
-            # here, if willing to require python 2.4 or higher
-            microsec = int(float(fields.get("sec_frac", 0)) * 10 ** 6)
-            return datetime.datetime(year, month, day, hr, min, sec, microsec, tz)
-
-        match = _utc_re.match(text)
-        if match:
-            return parse_date(match, tz=pytz.utc)
-
-        match = _offset_re.match(text)
-        if match:
-            tz_hr, tz_min = [int(match.group(x)) for x in "tz_hr", "tz_min"]
-            return parse_date(match, tz=FixedOffset(tz_hr * 60 + tz_min, {}))
-
-        match = _local_re.match(text)
+        match = _datetime_re.match(string)
         if not match:
-            raise Exception("DateTime [%s] not in known format" % text)
+            raise Exception("DateTime [%s] not in known format" % string)
+
+        year, month, day, hr, min, sec, sec_frac, utc, tz_sign, tz_hr, \
+                                                      tz_min = match.groups()
+
+        if sec_frac is None:
+            microsec = 0
+        else:
+            microsec = int((sec_frac + '00000')[:6])
 
-        return parse_date(match)
+        if not (utc is None):
+            tz = pytz.utc
+        elif not (tz_sign is None):
+            tz = _get_offset(tz_sign, tz_hr, tz_min)
+        else:
+            tz = None
+
+        return datetime.datetime(int(year), int(month), int(day), int(hr),
+                                             int(min), int(sec), microsec, tz)
 
 class Duration(SimpleType):
     __type_name__ = 'duration'
+    __safe_text__ = True
+
+    to_xml = classmethod(codec_to_xml)
+    from_xml = classmethod(codec_from_xml)
 
     @classmethod
-    @nillable_value
-    def to_xml(cls, value, tns, parent_elt, name='retval'):
-        SimpleType.to_xml(str(value), tns, parent_elt, name)
+    def to_string(cls, value):
+        return str(value)
 
     @classmethod
-    @nillable_element
-    def from_xml(cls, element):
+    def from_string(cls, string):
         from soaplib.util.duration import duration
-        return duration.parse(element.text)
+        return duration.parse(string)
 
 class Double(SimpleType):
+    __safe_text__ = True
+
+    to_xml = classmethod(codec_to_xml)
+    from_xml = classmethod(codec_from_xml)
+
     @classmethod
-    @nillable_element
-    def from_xml(cls, element):
-        return float(element.text)
+    def to_string(cls, value):
+        return str(value)
 
     @classmethod
-    @nillable_value
-    def to_xml(cls, value, tns, parent_elt, name='retval'):
-        SimpleType.to_xml(str(value), tns, parent_elt, name)
+    def from_string(cls, string):
+        return float(string)
 
 class Float(Double):
     pass
 
 class Boolean(SimpleType):
+    __safe_text__ = True
+
+    to_xml = classmethod(codec_to_xml)
+    from_xml = classmethod(codec_from_xml)
+
     @classmethod
-    @nillable_value
-    def to_xml(cls, value, tns, parent_elt, name='retval'):
-        SimpleType.to_xml(str(bool(value)).lower(), tns, parent_elt, name)
+    def to_string(cls, value):
+        if value:
+            return 'true'
+
+        return 'false'
 
     @classmethod
-    @nillable_element
-    def from_xml(cls, element):
-        s = element.text
-        return (s and s.lower() in ['true', '1'])
+    def from_string(cls, string):
+        return (string and string.lower() in ('true', '1'))
 
 # a class that is really a namespace
 class Mandatory(object):
@@ -0,0 +1,234 @@
+
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+from lxml import etree
+
+import soaplib
+
+from soaplib.serializers import has_codec
+from soaplib.serializers.clazz import Array
+from soaplib.serializers.clazz import ClassSerializerBase
+from soaplib.serializers.exception import Fault
+
+_nil_attr = '{%s}nil' % soaplib.ns_xsi
+_array_from_xml = Array.from_xml.im_func
+_class_from_xml = ClassSerializerBase.from_xml.im_func
+
+# frame kinds
+_CLASS, _ARRAY, _CODEC, _TREE, _SKIP = range(5)
+
+# frame slots
+_KIND, _SERIALIZER, _VALUE, _KEY, _IS_ARRAY, _EXTRA = range(6)
+
+class PayloadTarget(object):
+    '''
+    An lxml parser target that deserializes an element of the given
+    serializer class as its events arrive, without building the element tree
+    first. ClassSerializers, Arrays and the primitives that have codecs are
+    built directly, using the compiled TypePlan of the classes. Members of
+    other types, and of classes that override from_xml, are built as small
+    subtrees and handed to their from_xml method.
+
+    Only the elements that are being deserialized are kept, so memory use
+    scales with the depth of the document instead of its size.
+
+    It's used as:
+
+        parser = etree.XMLParser(target=PayloadTarget(SomeClass))
+        parser.feed(data)
+        native = parser.close()
+    '''
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+
+        self.__stack = []
+        self.__result = None
+
+        # (parent serializer, tag) -> (serializer, key, is_array) and
+        # serializer -> (kind, extra) caches, as the same members are seen
+        # over and over in arrays.
+        self.__members = {}
+        self.__kinds = {}
+
+    def start(self, tag, attrib):
+        stack = self.__stack
+
+        if len(stack) == 0:
+            self.__push(self.serializer, attrib, tag, None, False)
+            return
+
+        parent = stack[-1]
+        kind = parent[_KIND]
+
+        if kind == _CLASS:
+            member = self.__members.get((parent[_SERIALIZER], tag), None)
+            if member is None:
+                member = self.__get_member(parent, tag)
+
+            self.__push(member[0], attrib, tag, member[1], member[2])
+
+        elif kind == _ARRAY:
+            self.__push(parent[_EXTRA], attrib, tag, None, False)
+
+        elif kind == _TREE:
+            parent[_EXTRA][0].start(tag, attrib)
+            parent[_EXTRA][1] += 1
+
+        else:
+            # children of primitives are ignored, like they are by from_xml.
+            stack.append([_SKIP, None, None, None, False, None])
+
+        if attrib and 'href' in attrib:
+            raise Fault('Client.SoapError', 'Multiref messages can not be '
+                                            'deserialized by a parser target')
+
+    def __get_member(self, parent, tag):
+        key = tag.split('}')[-1]
+
+        field = parent[_EXTRA].get(key, None)
+        if field is None:
+            raise Exception('the %s object does not have a "%s" member' %
+                                           (parent[_SERIALIZER].__name__, key))
+
+        serializer, is_array = field
+        retval = self.__members[(parent[_SERIALIZER], tag)] = \
+                                                   (serializer, key, is_array)
+
+        return retval
+
+    def __get_kind(self, serializer):
+        if has_codec(serializer):
+            retval = (_CODEC, None)
+
+        else:
+            # customized arrays are not Array subclasses, so the kind of the
+            # serializer is told by its from_xml method.
+            from_xml = getattr(serializer.from_xml, 'im_func', None)
+
+            if from_xml is _array_from_xml:
+                (member,) = serializer._type_info.values()
+                retval = (_ARRAY, member)
+
+            elif from_xml is _class_from_xml:
+                retval = (_CLASS, serializer.get_plan().tags)
+
+            else:
+                retval = (_TREE, None)
+
+        self.__kinds[serializer] = retval
+
+        return retval
+
+    def __push(self, serializer, attrib, tag, key, is_array):
+        kind, extra = self.__kinds.get(serializer, None) or \
+                                                   self.__get_kind(serializer)
+
+        if attrib and attrib.get(_nil_attr):
+            self.__stack.append([_SKIP, serializer, None, key, is_array, None])
+
+        elif kind == _CODEC:
+            self.__stack.append([_CODEC, serializer, None, key, is_array, []])
+
+        elif kind == _CLASS:
+            self.__stack.append([_CLASS, serializer,
+                serializer.get_deserialization_instance(), key, is_array,
+                                                                        extra])
+
+        elif kind == _ARRAY:
+            self.__stack.append([_ARRAY, serializer, [], key, is_array, extra])
+
+        else:
+            builder = etree.TreeBuilder()
+            builder.start(tag, attrib)
+            self.__stack.append([_TREE, serializer, None, key, is_array,
+                                                                 [builder, 0]])
+
+    def data(self, data):
+        frame = self.__stack[-1]
+        kind = frame[_KIND]
+
+        if kind == _CODEC:
+            frame[_EXTRA].append(data)
+
+        elif kind == _TREE:
+            frame[_EXTRA][0].data(data)
+
+    def end(self, tag):
+        stack = self.__stack
+        frame = stack[-1]
+        kind = frame[_KIND]
+
+        if kind == _TREE:
+            builder = frame[_EXTRA][0]
+            builder.end(tag)
+
+            if frame[_EXTRA][1] > 0:
+                frame[_EXTRA][1] -= 1
+                return
+
+            value = frame[_SERIALIZER].from_xml(builder.close())
+
+        elif kind == _CODEC:
+            texts = frame[_EXTRA]
+            if len(texts) == 0:
+                text = None
+            else:
+                text = ''.join(texts)
+
+            value = frame[_SERIALIZER].from_string(text)
+
+        elif kind == _ARRAY:
+            value = frame[_SERIALIZER].from_list(frame[_VALUE])
+
+        else:
+            value = frame[_VALUE]
+
+        stack.pop()
+
+        if len(stack) == 0:
+            self.__result = value
+            return
+
+        parent = stack[-1]
+        if parent[_KIND] == _CLASS:
+            inst = parent[_VALUE]
+            key = frame[_KEY]
+
+            if frame[_IS_ARRAY]:
+                values = getattr(inst, key, None)
+                if values is None:
+                    values = []
+                    setattr(inst, key, values)
+
+                values.append(value)
+
+            else:
+                setattr(inst, key, value)
+
+        elif parent[_KIND] == _ARRAY:
+            parent[_VALUE].append(value)
+
+    def close(self):
+        retval = self.__result
+
+        self.__stack = []
+        self.__result = None
+
+        return retval
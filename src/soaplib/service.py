@@ -20,6 +20,8 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import threading
+
 import soaplib
 from lxml import etree
 
@@ -110,6 +112,10 @@ def rpc(*params, **kparams):
                 _mtom = kparams.get('_mtom', False)
                 _in_header = kparams.get('_in_header', None)
                 _out_header = kparams.get('_out_header', None)
+                _streaming = kparams.get('_streaming', False)
+                _callback = kparams.get('_callback', None)
+                _cache = kparams.get('_cache', None)
+                _coalesce = kparams.get('_coalesce', False)
 
                 # the decorator function does not have a reference to the
                 # class and needs to be passed in
@@ -126,7 +132,8 @@ def rpc(*params, **kparams):
                 doc = getattr(f, '__doc__')
                 descriptor = MethodDescriptor(f.func_name, _public_name,
                         in_message, out_message, doc, _is_callback, _is_async,
-                        _mtom, _in_header, _out_header)
+                        _mtom, _in_header, _out_header, _streaming, _callback,
+                        _cache, _coalesce)
 
                 return descriptor
 
@@ -141,6 +148,49 @@ def rpc(*params, **kparams):
     return explain
 
 _public_methods_cache = {}
+_method_index_cache = {}
+
+class MethodContext(object):
+    '''
+    The state of a single soap call. It's created for every request, so that
+    service instances can be shared between requests. It's passed to all
+    hooks that are called during the processing of the request.
+
+    The udc (user defined context) attribute is free to be used by the
+    implementation hooks to carry state between them. The attachments
+    attribute is the dict of the MIME attachments of the request, if any.
+    The cache_key attribute is the key of the response in the response cache
+    of the method, if it has one.
+    '''
+
+    __slots__ = ('service', 'descriptor', 'method_name', 'header_xml',
+                 'body_xml', 'soap_in_header', 'soap_out_header', 'soap_body',
+                 'udc', 'attachments', 'cache_key')
+
+    def __init__(self, service=None):
+        self.service = service
+        self.descriptor = None
+        self.method_name = None
+        self.header_xml = None
+        self.body_xml = None
+        self.soap_in_header = None
+        self.soap_out_header = None
+        self.soap_body = None
+        self.udc = None
+        self.attachments = None
+        self.cache_key = None
+
+def _context_property(name):
+    '''Returns a property that proxies the given attribute of the
+    MethodContext that's currently bound to the service instance.'''
+
+    def getter(self):
+        return getattr(self.get_context(), name)
+
+    def setter(self, value):
+        setattr(self.get_context(), name, value)
+
+    return property(getter, setter)
 
 class DefinitionBase(object):
     '''
@@ -157,9 +207,18 @@ class DefinitionBase(object):
     __in_header__ = None
     __out_header__ = None
 
+    descriptor = _context_property('descriptor')
+    method_name = _context_property('method_name')
+    header_xml = _context_property('header_xml')
+    body_xml = _context_property('body_xml')
+    soap_in_header = _context_property('soap_in_header')
+    soap_out_header = _context_property('soap_out_header')
+    soap_body = _context_property('soap_body')
+
     def __init__(self, environ=None):
-        self.soap_in_header = None
-        self.soap_out_header = None
+        # the service instance can be shared between threads, so the context
+        # of the current call is kept in thread local storage.
+        self.__local = threading.local()
 
         cls = self.__class__
         if not (cls in _public_methods_cache):
@@ -167,9 +226,45 @@ class DefinitionBase(object):
 
         self.public_methods = _public_methods_cache[cls]
 
-    def on_method_call(self, environ, method_name, py_params, soap_params):
+        if not (cls in _method_index_cache):
+            _method_index_cache[cls] = self.build_method_index()
+
+        self.__method_index = _method_index_cache[cls]
+
+    def get_context(self):
+        '''
+        Returns the MethodContext of the call that's being processed by the
+        current thread.
+        '''
+
+        retval = getattr(self.__local, 'ctx', None)
+        if retval is None:
+            retval = self.__local.ctx = MethodContext(self)
+
+        return retval
+
+    def set_context(self, ctx):
+        '''
+        Binds the given MethodContext to the current thread.
+        '''
+
+        self.__local.ctx = ctx
+
+    def clear_context(self, ctx):
+        '''
+        Unbinds the given MethodContext from the current thread once its call
+        is done, so that the thread doesn't keep the request alive until it
+        gets another one. The context of another call is left alone.
+        '''
+
+        if getattr(self.__local, 'ctx', None) is ctx:
+            del self.__local.ctx
+
+    def on_method_call(self, ctx, environ, method_name, py_params,
+                                                                   soap_params):
         '''
         Called BEFORE the service implementing the functionality is called
+        @param the MethodContext of the call
         @param the wsgi environment
         @param the method name
         @param the body element of the soap request
@@ -178,10 +273,11 @@ class DefinitionBase(object):
         '''
         pass
 
-    def on_method_return(self, environ, py_results, soap_results,
+    def on_method_return(self, ctx, environ, py_results, soap_results,
                                                              http_resp_headers):
         '''
         Called AFTER the service implementing the functionality is called
+        @param the MethodContext of the call
         @param the wsgi environment
         @param the python results from the method
         @param the xml element containing the return value(s) from the method
@@ -189,20 +285,20 @@ class DefinitionBase(object):
         '''
         pass
 
-    def on_method_exception_object(self, exc):
+    def on_method_exception_object(self, ctx, exc):
         '''
         Called BEFORE the exception is serialized, when an error occurs durring
         execution
-        @param the wsgi environment
+        @param the MethodContext of the call
         @param the exception object
         '''
         pass
 
-    def on_method_exception_xml(self, fault_xml):
+    def on_method_exception_xml(self, ctx, fault_xml):
         '''
         Called AFTER the exception is serialized, when an error occurs durring
         execution
-        @param the wsgi environment
+        @param the MethodContext of the call
         @param the xml element containing the exception object serialized to a
         soap fault
         '''
@@ -245,21 +341,38 @@ class DefinitionBase(object):
 
         return public_methods
 
+    def build_method_index(self):
+        '''Returns a dict that maps request element names and public names to
+        method descriptors. Element names take precedence.'''
+
+        retval = {}
+
+        for method in self.public_methods:
+            retval.setdefault(method.public_name, method)
+
+        for method in self.public_methods:
+            retval[method.in_message.get_type_name()] = method
+
+        return retval
+
     def get_method(self, name):
         '''
         Returns the metod descriptor based on element name or soap action
         '''
 
-        for method in self.public_methods:
-            type_name = method.in_message.get_type_name()
-            if '{%s}%s' % (self.get_tns(), type_name) == name:
-                return method
+        method = None
+        if name.startswith('{'):
+            tns, type_name = name[1:].split('}', 1)
+            if tns == self.get_tns():
+                method = self.__method_index.get(type_name, None)
 
-        for method in self.public_methods:
-            if method.public_name == name:
-                return method
+        else:
+            method = self.__method_index.get(name, None)
+
+        if method is None:
+            raise Exception('Method "%s" not found' % name)
 
-        raise Exception('Method "%s" not found' % name)
+        return method
 
     def _has_callbacks(self):
         '''Determines if this object has callback methods or not'''
@@ -20,6 +20,7 @@
 import logging
 logger = logging.getLogger(__name__)
 
+from cStringIO import StringIO
 from lxml import etree
 
 import soaplib
@@ -33,7 +34,8 @@ class MethodDescriptor(object):
 
     def __init__(self, name, public_name, in_message, out_message, doc,
                  is_callback=False, is_async=False, mtom=False, in_header=None,
-                 out_header=None):
+                 out_header=None, streaming=False, callback=None, cache=None,
+                 coalesce=False):
 
         self.name = name
         self.public_name = public_name
@@ -45,43 +47,235 @@ class MethodDescriptor(object):
         self.mtom = mtom
         self.in_header = in_header
         self.out_header = out_header
+        self.streaming = streaming
+        self.callback = callback
+        self.cache = cache
+        self.coalesce = coalesce
 
-def from_soap(xml_string, charset):
+def _get_source(xml_string, charset):
+    if hasattr(xml_string, 'read'):
+        return xml_string, charset
+
+    if isinstance(xml_string, unicode):
+        xml_string = xml_string.encode('utf-8')
+        charset = 'utf-8'
+
+    return StringIO(xml_string), charset
+
+def from_soap(xml_string, charset=None, schema=None):
     '''
-    Parses the xml string into the header and payload
+    Parses the xml string into the header and payload. xml_string can also be
+    a file-like object, in which case it's read and parsed incrementally.
+
+    The envelope is parsed with iterparse, so Envelope, Header and Body are
+    found by parser events and not by searching the finished tree. Only the
+    first child of the body is kept, the subsequent ones are freed as soon as
+    they are parsed, unless they are or contain multiref targets (i.e.
+    elements with an 'id' attribute). The href resolution is only done when
+    there are such targets, wherever they are in the envelope.
+
+    @param xml_string the soap envelope, as a string or a file-like object
+    @param charset    the charset from the http headers. when given, it
+                      overrides the one in the xml declaration.
+    @param schema     an optional etree.XMLSchema for the whole envelope. when
+                      given, the document is validated while it's parsed.
     '''
 
+    source, charset = _get_source(xml_string, charset)
+
+    tag_envelope = '{%s}Envelope' % soaplib.ns_soap_env
+    tag_header = '{%s}Header' % soaplib.ns_soap_env
+    tag_body = '{%s}Body' % soaplib.ns_soap_env
+
+    root = None
+    header_envelope = None
+    body_envelope = None
+    header = None
+    body = None
+
+    # the number of elements with an id attribute, and that number at the
+    # beginning of the current child of the body.
+    ids = 0
+    ids_before = 0
+
+    depth = 0
+    section = None
+
     try:
-        root, xmlids = etree.XMLID(xml_string.decode(charset))
-    except ValueError,e:
-        logger.debug('%s -- falling back to str decoding.' % (e))
-        root, xmlids = etree.XMLID(xml_string)
+        for event, element in etree.iterparse(source, events=('start', 'end'),
+                                              encoding=charset, schema=schema):
+            if event == 'start':
+                depth += 1
 
-    if xmlids:
-        resolve_hrefs(root, xmlids)
+                if depth == 1:
+                    if element.tag != tag_envelope:
+                        raise Fault('Client.SoapError', 'No {%s}Envelope '
+                                    'element was found!' % soaplib.ns_soap_env)
+                    root = element
 
-    if root.tag != '{%s}Envelope' % soaplib.ns_soap_env:
-        raise Fault('Client.SoapError', 'No {%s}Envelope element was found!' %
-                                                            soaplib.ns_soap_env)
+                elif depth == 2:
+                    section = element.tag
+                    if section == tag_header:
+                        header_envelope = element
+                    elif section == tag_body:
+                        body_envelope = element
+
+                elif depth == 3:
+                    ids_before = ids
+
+                continue
 
-    header_envelope = root.xpath('e:Header',
-                                         namespaces={'e': soaplib.ns_soap_env})
-    body_envelope = root.xpath('e:Body', namespaces={'e': soaplib.ns_soap_env})
+            if not (element.get('id') is None):
+                ids += 1
 
-    if len(header_envelope) == 0 and len(body_envelope) == 0:
-        raise Fault('Client.SoapError', 'Soap envelope is empty!' %
-                                                            soaplib.ns_soap_env)
+            if depth == 3:
+                if section == tag_header:
+                    if header is None:
+                        header = element
 
-    header=None
-    if len(header_envelope) > 0 and len(header_envelope[0]) > 0:
-        header = header_envelope[0].getchildren()[0]
+                elif section == tag_body:
+                    if body is None:
+                        body = element
 
-    body=None
-    if len(body_envelope) > 0 and len(body_envelope[0]) > 0:
-        body = body_envelope[0].getchildren()[0]
+                    elif ids == ids_before:
+                        element.clear()
+                        body_envelope.remove(element)
+
+            depth -= 1
+
+    except etree.XMLSyntaxError, e:
+        err = e.error_log.last_error
+        if not (err is None) and err.domain_name == 'SCHEMASV':
+            raise Fault('Client.SchemaValidation', str(err))
+
+        raise Fault('Client.XMLSyntax', str(e))
+
+    if header_envelope is None and body_envelope is None:
+        raise Fault('Client.SoapError', 'Soap envelope is empty!')
+
+    if ids > 0:
+        xmlids = dict([(e.get('id'), e) for e in root.xpath('//*[@id]')])
+        resolve_hrefs(root, xmlids)
 
     return header, body
 
+class _EnvelopeTarget(object):
+    '''
+    The parser target of decode_soap. The soap header is built as an element
+    tree, the events of the first child of the body are passed to the target
+    that get_target returns for its tag, and the rest is ignored.
+    '''
+
+    def __init__(self, get_target):
+        self.get_target = get_target
+
+        self.depth = 0
+        self.section = None
+        self.builder = None
+        self.header = None
+        self.method_name = None
+        self.payload = None
+        self.in_payload = False
+        self.native = None
+        self.has_body = False
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        depth = self.depth
+
+        if self.in_payload:
+            self.payload.start(tag, attrib)
+
+        elif depth == 1:
+            if tag != '{%s}Envelope' % soaplib.ns_soap_env:
+                raise Fault('Client.SoapError', 'No {%s}Envelope '
+                                    'element was found!' % soaplib.ns_soap_env)
+
+        elif depth == 2:
+            self.section = tag
+            if tag == '{%s}Header' % soaplib.ns_soap_env:
+                self.builder = etree.TreeBuilder()
+                self.builder.start(tag, attrib)
+
+            elif tag == '{%s}Body' % soaplib.ns_soap_env:
+                self.has_body = True
+
+        elif not (self.builder is None):
+            self.builder.start(tag, attrib)
+
+        elif self.section == '{%s}Body' % soaplib.ns_soap_env:
+            # the subsequent children of the body are ignored.
+            if depth == 3 and self.method_name is None:
+                self.method_name = tag
+                self.payload = self.get_target(tag)
+                self.in_payload = True
+
+            if self.in_payload:
+                self.payload.start(tag, attrib)
+
+    def data(self, data):
+        if self.in_payload:
+            self.payload.data(data)
+
+        elif not (self.builder is None):
+            self.builder.data(data)
+
+    def end(self, tag):
+        depth = self.depth
+        self.depth -= 1
+
+        if self.in_payload:
+            self.payload.end(tag)
+
+            if depth == 3:
+                self.native = self.payload.close()
+                self.in_payload = False
+
+        elif not (self.builder is None):
+            self.builder.end(tag)
+
+            if depth == 2:
+                header = self.builder.close()
+                self.builder = None
+
+                if len(header) > 0:
+                    self.header = header[0]
+
+    def close(self):
+        if self.header is None and not self.has_body:
+            raise Fault('Client.SoapError', 'Soap envelope is empty!')
+
+        return self.header, self.method_name, self.native
+
+def decode_soap(xml_string, get_target, charset=None, chunk_size=64 * 1024):
+    '''
+    Same as from_soap, but the payload is deserialized while it's parsed,
+    without building its element tree, by the lxml parser target that the
+    get_target callable returns for the tag of the payload, e.g. a
+    soaplib.serializers.target.PayloadTarget. Multiref messages and schema
+    validation are not supported.
+
+    @return tuple of length 3 with the first child of the soap header, the
+            tag of the payload and the deserialized payload
+    '''
+
+    source, charset = _get_source(xml_string, charset)
+
+    parser = etree.XMLParser(target=_EnvelopeTarget(get_target),
+                                                              encoding=charset)
+    try:
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                break
+
+            parser.feed(data)
+
+        return parser.close()
+
+    except etree.XMLSyntaxError, e:
+        raise Fault('Client.XMLSyntax', str(e))
+
 # see http://www.w3.org/TR/2000/NOTE-SOAP-20000508/
 # section 5.2.1 for an example of how the id and href attributes are used.
 def resolve_hrefs(element, xmlids):
@@ -90,7 +284,7 @@ def resolve_hrefs(element, xmlids):
             continue # don't need to resolve this element
 
         elif e.get('href'):
-            resolved_element = xmlids[e.get('href').replace('#', '')]
+            resolved_element = xmlids.get(e.get('href').replace('#', ''))
             if resolved_element is None:
                 continue
             resolve_hrefs(resolved_element, xmlids)
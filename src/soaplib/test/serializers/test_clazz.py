@@ -17,16 +17,22 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 #
 
+import array
 import datetime
+import pickle
 import unittest
 
+import soaplib
+
 from soaplib.serializers.clazz import ClassSerializer
 from soaplib.serializers.clazz import Array
 
 from soaplib.serializers.primitive import DateTime
 from soaplib.serializers.primitive import Float
 from soaplib.serializers.primitive import Integer
+from soaplib.serializers.primitive import Mandatory
 from soaplib.serializers.primitive import String
+from soaplib.serializers.target import PayloadTarget
 
 from lxml import etree
 
@@ -199,6 +205,150 @@ class TestClassSerializer(unittest.TestCase):
         self.assertEquals(len(l1.level4), len(l.level4))
         self.assertEquals(100, len(l.level3))
 
+    def test_plan_inheritance(self):
+        names = [f[0] for f in Employee.get_plan().fields]
+
+        self.assertEquals(names[:len(Person._type_info)],
+                                                   Person._type_info.keys())
+        self.assertEquals(names[len(Person._type_info):],
+                                                 Employee._type_info.keys())
+        self.assertTrue('name' in Employee.get_plan().tags)
+        self.assertTrue(Employee.get_plan() is Employee.get_plan())
+        self.assertFalse(Employee.get_plan() is Person.get_plan())
+
+    def test_plan_invalidation(self):
+        plan = Address.get_plan()
+        Address2 = Address.customize(nillable=False)
+
+        self.assertFalse(Address2.get_plan() is plan)
+
+        Address.resolve_namespace(Address, __name__)
+        self.assertFalse(Address.get_plan() is plan)
+
+    def test_plan_codecs(self):
+        class Upper(String):
+            @classmethod
+            def from_xml(cls, element):
+                return element.text.upper()
+
+        class Codecs(ClassSerializer):
+            s = String
+            i = Integer
+            u = Upper
+            m = Mandatory.Integer
+
+        c = Codecs()
+        c.s = None
+        c.i = 5
+        c.u = 'abc'
+        c.m = 7
+
+        element = etree.Element('test')
+        Codecs.to_xml(c, ns_test, element)
+        element = element[0]
+
+        s = element.xpath('*[local-name()="s"]')[0]
+        self.assertEquals(s.get('{%s}nil' % soaplib.ns_xsi), 'true')
+
+        c2 = Codecs.from_xml(element)
+        self.assertEquals((c2.s, c2.i, c2.u, c2.m), (None, 5, 'ABC', 7))
+
+        # nil values of non-nillable members are still decoded as None
+        m = element.xpath('*[local-name()="m"]')[0]
+        m.text = None
+        m.set('{%s}nil' % soaplib.ns_xsi, 'true')
+
+        self.assertEquals(Codecs.from_xml(element).m, None)
+
+        parser = etree.XMLParser(target=PayloadTarget(Codecs))
+        parser.feed(etree.tostring(element))
+        self.assertEquals(parser.close().m, None)
+
+    def test_bulk_array(self):
+        serializer = Array(Integer)
+        serializer.resolve_namespace(serializer, ns_test)
+
+        values = [1, 2, 3]
+
+        # the bulk path must produce what the per-item path does
+        parent = etree.Element('{%s}test' % ns_test)
+        element = etree.SubElement(parent, '{%s}integerArray' % ns_test)
+        serializer.get_members(serializer.get_serialization_instance(values),
+                                                                      element)
+        expected = etree.tostring(parent)
+
+        for value in (values, array.array('l', values),
+                                      memoryview(bytearray(values))):
+            parent = etree.Element('{%s}test' % ns_test)
+            serializer.to_xml(value, ns_test, parent)
+            self.assertEquals(etree.tostring(parent), expected)
+
+        self.assertEquals(serializer.from_xml(parent[0]), values)
+
+        serializer = Array(Float, typecode='d')
+        serializer.resolve_namespace(serializer, ns_test)
+
+        parent = etree.Element('{%s}test' % ns_test)
+        serializer.to_xml([1.5, None], ns_test, parent)
+        self.assertRaises(TypeError, serializer.from_xml, parent[0])
+
+        parent = etree.Element('{%s}test' % ns_test)
+        serializer.to_xml(array.array('d', [1.5, -2.25]), ns_test, parent)
+
+        retval = serializer.from_xml(parent[0])
+        self.assertEquals(retval, array.array('d', [1.5, -2.25]))
+
+        # values that aren't numbers are escaped like any other text
+        serializer = Array(Integer)
+        serializer.resolve_namespace(serializer, ns_test)
+
+        parent = etree.Element('{%s}test' % ns_test)
+        serializer.to_xml(['1</ns0:integer><ns0:integer>2', '3'], ns_test,
+                                                                       parent)
+        self.assertEquals([c.text for c in parent[0]],
+                                      ['1</ns0:integer><ns0:integer>2', '3'])
+
+        # as are arrays whose namespace was never resolved
+        parent = etree.Element('test')
+        Array(Integer).to_xml([1, 2], None, parent)
+        self.assertEquals(len(parent[0]), 2)
+
+    def test_inherited_class(self):
+        e = Employee()
+        e.name = 'bob'
+        e.employee_id = 12
+        e.salary = 1.5
+
+        element = etree.Element('test')
+        Employee.to_xml(e, ns_test, element)
+        element = element[0]
+
+        e2 = Employee.from_xml(element)
+
+        self.assertEquals(e2.name, 'bob')
+        self.assertEquals(e2.employee_id, 12)
+        self.assertEquals(e2.salary, 1.5)
+
+    def test_slots(self):
+        e = Employee(name='bob', salary=1.5)
+
+        self.assertFalse(hasattr(e, '__dict__'))
+        self.assertEquals((e.name, e.salary, e.age), ('bob', 1.5, None))
+        self.assertEquals(Employee.__slots__, ('employee_id', 'salary'))
+        self.assertRaises(AttributeError, setattr, e, 'nickname', 'b')
+
+        # the types of the members are still in _type_info
+        self.assertTrue(Employee._type_info['salary'] is Float)
+
+        Employee2 = Employee.customize(nillable=False)
+        e2 = Employee2()
+        e2.salary = 2.5
+        self.assertEquals((e2.name, e2.salary), (None, 2.5))
+
+        for protocol in (0, 2):
+            e3 = pickle.loads(pickle.dumps(e, protocol))
+            self.assertEquals((e3.name, e3.salary), ('bob', 1.5))
+
     def test_customize(self):
         class Base(ClassSerializer):
             class Attributes(ClassSerializer.Attributes):
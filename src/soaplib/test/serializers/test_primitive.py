@@ -78,6 +78,20 @@ class TestPrimitive(unittest.TestCase):
         self.assertEquals(dt.month, 5)
         self.assertEquals(dt.day, 15)
 
+    def test_offset_datetime(self):
+        e = etree.Element('test')
+        e.text = '2007-05-15T13:40:44.000001-05:30'
+
+        dt = DateTime.from_xml(e)
+
+        self.assertEquals(dt.microsecond, 1)
+        self.assertEquals(dt.utcoffset(), -datetime.timedelta(hours=5,
+                                                                  minutes=30))
+
+        e.text = '2007-05-15T13:40:44+02:00'
+        self.assertTrue(DateTime.from_xml(e).tzinfo is
+                                                    DateTime.from_xml(e).tzinfo)
+
     def test_integer(self):
         i = 12
         integer = Integer()
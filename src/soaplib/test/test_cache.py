@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from soaplib.util import normalize_url
+from soaplib.util.cache import LRUCache
+from soaplib.util.cache import ResponseCache
+from soaplib.util.cache import SingleFlight
+from soaplib.util.cache import get_canonical_key
+from soaplib.util.shared_cache import SharedResponseCache
+
+class TestCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        self.assertEquals(cache.get('a'), 1) # 'b' is now the oldest
+        cache.set('c', 3)
+
+        self.assertEquals(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+        cache.delete('a')
+        self.assertEquals(cache.get('a', 'default'), 'default')
+
+    def test_get_or_create(self):
+        cache = LRUCache(10)
+        calls = []
+
+        def factory():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        results = []
+        def worker():
+            results.append(cache.get_or_create('key', factory))
+
+        threads = [threading.Thread(target=worker) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEquals(results, ['value'] * 10)
+        self.assertEquals(len(calls), 1)
+
+    def test_single_flight_exception(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise KeyError('x')
+
+        self.assertRaises(KeyError, flight.do, 'key', fail)
+        self.assertEquals(flight.in_flight(), 0)
+        self.assertEquals(flight.do('key', lambda: 5), 5)
+        self.assertEquals(flight.get_stats(),
+                                  {'calls': 2, 'collapsed': 0, 'in_flight': 0})
+
+    def test_response_cache(self):
+        cache = ResponseCache(max_entries=3, max_size=10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        self.assertEquals(cache.get('a'), 'aaaa') # 'b' is now the oldest
+
+        cache.set('c', 'cccc') # 12 bytes, 'b' is evicted
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(len(cache), 2)
+
+        cache.set('d', 'x' * 11) # larger than the cache
+        self.assertEquals(cache.get('d'), None)
+
+        self.assertEquals(cache.get_stats(), {'entries': 2, 'size': 8,
+                                  'hits': 1, 'misses': 2, 'evictions': 1})
+
+        cache = ResponseCache(ttl=0.01)
+        cache.set('a', 'aaaa')
+        self.assertEquals(cache.get('a'), 'aaaa')
+        time.sleep(0.02)
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.size, 0)
+
+    def test_response_cache_invalidation(self):
+        cache = ResponseCache()
+        for name in ('{tns}a', '{tns}b'):
+            for params in ([1, 'x'], [2, 'x']):
+                cache.set(cache.get_key(name, params), name)
+
+        cache.invalidate('a', [1, 'x'])
+        self.assertEquals(len(cache), 3)
+        self.assertEquals(cache.get(cache.get_key('{tns}a', [2, 'x'])),
+                                                                      '{tns}a')
+
+        cache.invalidate('{tns}b')
+        self.assertEquals(len(cache), 1)
+
+        cache.invalidate()
+        self.assertEquals(len(cache), 0)
+
+    def test_canonical_key(self):
+        self.assertEquals(get_canonical_key('a', [1, {'x': 1, 'y': 2}]),
+                          get_canonical_key('a', (1, {'y': 2, 'x': 1})))
+        self.assertNotEquals(get_canonical_key('a', [1]),
+                                                   get_canonical_key('a', [1.0]))
+        self.assertNotEquals(get_canonical_key('a', [1]),
+                                                    get_canonical_key('b', [1]))
+
+    def test_shared_response_cache(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+
+        try:
+            # one set of two slots
+            cache = SharedResponseCache(path, size=2048, slot_size=1024,
+                                                                       ways=2)
+            other = SharedResponseCache(path, size=2048, slot_size=1024,
+                                                                       ways=2)
+
+            a, b, c = [cache.get_key('{tns}m', [i]) for i in range(3)]
+
+            cache.set(a, 'aaaa')
+            self.assertEquals(other.get(a), 'aaaa')
+
+            cache.set(b, 'bbbb')
+            other.set(c, 'cccc') # 'a' is the oldest
+            self.assertEquals((cache.get(a), cache.get(b), cache.get(c)),
+                                                       (None, 'bbbb', 'cccc'))
+
+            cache.set(a, 'x' * 1024) # larger than a slot
+            self.assertEquals(cache.get(a), None)
+
+            stats = other.get_stats()
+            self.assertEquals((stats['entries'], stats['size'], stats['sets'],
+                                          stats['evictions']), (2, 8, 3, 1))
+
+            other.invalidate('m', [1])
+            self.assertEquals((cache.get(b), cache.get(c)), (None, 'cccc'))
+
+            cache.set(b, 'bbbb')
+            other.invalidate('m')
+            self.assertEquals(len(cache), 0)
+
+            pid = os.fork()
+            if pid == 0:
+                cache.set(a, 'from child')
+                os._exit(0)
+
+            os.waitpid(pid, 0)
+            self.assertEquals(other.get(a), 'from child')
+
+            # files of another layout are not reset under the processes
+            # that use them
+            self.assertRaises(ValueError, SharedResponseCache, path,
+                                             size=2048, slot_size=512, ways=2)
+            self.assertEquals(other.get(a), 'from child')
+
+            cache.close()
+            other.close()
+
+        finally:
+            os.unlink(path)
+
+    def test_normalize_url(self):
+        self.assertEquals(normalize_url('HTTP://Example.COM:80/Path?wsdl'),
+                                                   'http://example.com/Path')
+        self.assertEquals(normalize_url('https://example.com:443/a.wsdl'),
+                                                     'https://example.com/a')
+        self.assertEquals(normalize_url('http://example.com:8080/a'),
+                                                'http://example.com:8080/a')
+        self.assertEquals(normalize_url(''), '')
+
+if __name__ == '__main__':
+    unittest.main()
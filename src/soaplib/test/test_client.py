@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import threading
+import unittest
+
+from wsgiref.simple_server import make_server
+from wsgiref.simple_server import WSGIRequestHandler
+
+from soaplib.client import make_service_client
+from soaplib.serializers.clazz import Array
+from soaplib.serializers.exception import Fault
+from soaplib.serializers.primitive import Integer
+from soaplib.serializers.primitive import String
+from soaplib.service import rpc
+from soaplib.service import DefinitionBase
+from soaplib.wsgi import Application
+
+try:
+    from twisted.trial import unittest as trial
+    from twisted.internet import defer
+    from twisted.internet import reactor
+    from twisted.web.server import Site
+
+    from soaplib.util.server import SoapResource
+    from soaplib.util.twisted_client import TwistedServiceClient
+
+except ImportError:
+    trial = None
+
+class CalculatorService(DefinitionBase):
+    @rpc(Integer, Integer, _returns=Integer)
+    def add(self, a, b):
+        return a + b
+
+    @rpc(String, _returns=Array(String))
+    def split(self, s):
+        return s.split()
+
+    @rpc(String)
+    def fail(self, s):
+        raise Fault('Client.Bad', s)
+
+class BatchApplication(Application):
+    batch_enabled = True
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class TestServiceClient(unittest.TestCase):
+    def setUp(self):
+        app = BatchApplication([CalculatorService], 'tns')
+
+        self.server = make_server('127.0.0.1', 0, app,
+                                                  handler_class=QuietHandler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+        self.client = make_service_client('http://127.0.0.1:%d/' %
+                          self.server.server_port, CalculatorService, 'tns')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_call(self):
+        self.assertEquals(self.client.add(2, 3), 5)
+        self.assertEquals(self.client.add(2, b=5), 7)
+        self.assertEquals(self.client.split('a b c'), ['a', 'b', 'c'])
+
+        self.assertRaises(TypeError, self.client.add, 1, c=2)
+        self.assertRaises(AttributeError, getattr, self.client, 'mul')
+
+    def test_fault(self):
+        try:
+            self.client.fail('oops')
+
+        except Fault, e:
+            self.assertEquals(e.faultcode, 'senv:Client.Bad')
+            self.assertEquals(e.faultstring, 'oops')
+
+        else:
+            self.fail('no fault was raised')
+
+    def test_call_concurrently(self):
+        calls = [('add', (i, i)) for i in range(20)] + [('fail', ('x',))]
+
+        results = self.client.call_concurrently(calls)
+
+        self.assertEquals(results[:20], [i * 2 for i in range(20)])
+        self.assertTrue(isinstance(results[20], Fault))
+
+    def test_call_batch(self):
+        calls = [('add', (1, 2)), ('fail', ('oops',)), ('split', ('a b',))]
+
+        results = self.client.call_batch(calls)
+
+        self.assertEquals(results[0], 3)
+        self.assertTrue(isinstance(results[1], Fault))
+        self.assertEquals(results[1].faultstring, 'oops')
+        self.assertEquals(results[2], ['a', 'b'])
+
+if not (trial is None):
+    class TestTwistedServiceClient(trial.TestCase):
+        def setUp(self):
+            app = Application([CalculatorService], 'tns')
+            self.port = reactor.listenTCP(0, Site(SoapResource(app)),
+                                                         interface='127.0.0.1')
+
+            self.client = TwistedServiceClient('http://127.0.0.1:%d/' %
+                  self.port.getHost().port, CalculatorService, 'tns',
+                  max_per_host=2)
+
+        def tearDown(self):
+            d = self.client.close()
+            d.addCallback(lambda _: self.port.stopListening())
+
+            return d
+
+        def test_call(self):
+            d = self.client.add(2, 3)
+            d.addCallback(self.assertEquals, 5)
+
+            return d
+
+        def test_concurrent_calls(self):
+            d = defer.gatherResults([self.client.add(i, i) for i in range(10)])
+            d.addCallback(self.assertEquals, [i * 2 for i in range(10)])
+
+            return d
+
+        def test_fault(self):
+            d = self.client.fail('oops')
+
+            return self.assertFailure(d, Fault)
+
+if __name__ == '__main__':
+    unittest.main()
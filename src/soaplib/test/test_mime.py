@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import base64
+import cgi
+import unittest
+
+from StringIO import StringIO
+
+from lxml import etree
+
+import soaplib
+
+from soaplib import service
+from soaplib import wsgi
+from soaplib.mime import MultipartParser
+from soaplib.mime import collapse_swa
+from soaplib.mime import split_mtom
+from soaplib.serializers.binary import Attachment
+from soaplib.serializers.exception import Fault
+from soaplib.serializers.primitive import Integer
+from soaplib.service import rpc
+
+boundary = 'MIME_boundary'
+content_type = ('multipart/related; type="application/xop+xml"; '
+                'boundary="%s"; start="<root>"' % boundary)
+
+envelope = ('<senv:Envelope xmlns:senv="%s" xmlns:xop="%s" xmlns:tns="tns">'
+            '<senv:Body><tns:upload><tns:data>'
+            '<xop:Include href="cid:blob%%40soaplib"/>'
+            '</tns:data></tns:upload></senv:Body></senv:Envelope>' %
+                                           (soaplib.ns_soap_env, soaplib.ns_xop))
+
+payload = ''.join([chr(i % 256) for i in range(1000)]) + '\r\n--MIME'
+
+def make_message(parts):
+    retval = []
+    for headers, body in parts:
+        retval.append('--%s\r\n%s\r\n\r\n%s\r\n' % (boundary,
+                                                     '\r\n'.join(headers), body))
+    retval.append('--%s--\r\n' % boundary)
+
+    return ''.join(retval)
+
+message = make_message([
+    (['Content-Type: application/octet-stream', 'Content-ID: <blob@soaplib>',
+      'Content-Transfer-Encoding: binary'], payload),
+    (['Content-Type: application/xop+xml', 'Content-ID: <root>'], envelope),
+])
+
+class UploadService(service.DefinitionBase):
+    @rpc(Attachment, _returns=Integer)
+    def upload(self, data):
+        UploadService.received = data
+
+        return len(data.data)
+
+class TestMime(unittest.TestCase):
+    def test_split_mtom(self):
+        soapmsg, attachments = split_mtom(cgi.parse_header(content_type),
+                                                                       message)
+
+        self.assertEquals(soapmsg, envelope)
+        self.assertEquals(attachments.keys(), ['cid:blob@soaplib'])
+
+        data = attachments['cid:blob@soaplib']
+        self.assertTrue(isinstance(data, memoryview))
+        self.assertEquals(data.tobytes(), payload)
+
+    def test_parser(self):
+        message = make_message([
+            (['Content-ID: <root>'], envelope),
+            (['Content-ID: <blob@soaplib>'], payload),
+            (['Content-Location: encoded', 'Content-Transfer-Encoding: base64'],
+                                                  base64.encodestring(payload)),
+        ])
+
+        # fed one byte at a time, so that delimiters are split every way.
+        parser = MultipartParser(cgi.parse_header(content_type), 100)
+        for c in message:
+            parser.feed(c)
+        soapmsg, attachments = parser.close()
+
+        self.assertEquals(soapmsg.read(), envelope)
+        self.assertEquals(sorted(attachments.keys()),
+                                              ['cid:blob@soaplib', 'encoded'])
+
+        for f in attachments.values():
+            self.assertTrue(f._rolled) # spooled to disk
+            self.assertEquals(f.read(), payload)
+
+        parser = MultipartParser(cgi.parse_header(content_type))
+        parser.feed(message[:-10])
+        self.assertRaises(Fault, parser.close)
+
+    def test_collapse_swa(self):
+        soaptree = etree.fromstring(collapse_swa(cgi.parse_header(content_type),
+                                                                      message))
+        data = soaptree.find('.//{tns}data')
+
+        self.assertEquals(len(data), 0)
+        self.assertEquals(base64.b64decode(data.text), payload)
+
+    def test_mtom_request(self):
+        app = wsgi.Application([UploadService], 'tns')
+
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': content_type,
+            'CONTENT_LENGTH': str(len(message)),
+            'wsgi.input': StringIO(message),
+            'wsgi.url_scheme': 'http',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'PATH_INFO': '/',
+            'QUERY_STRING': '',
+        }
+
+        body = ''.join(app(environ, lambda code, headers: None))
+        result = etree.fromstring(body).find('.//{tns}uploadResult')
+
+        self.assertEquals(result.text, str(len(payload)))
+        self.assertFalse(UploadService.received.file is None)
+        self.assertEquals(UploadService.received.data, payload)
+
+if __name__ == '__main__':
+    unittest.main()
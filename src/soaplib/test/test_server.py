@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import unittest
+
+from StringIO import StringIO
+
+from lxml import etree
+
+from soaplib.serializers.primitive import String
+from soaplib.service import rpc
+from soaplib.service import DefinitionBase
+from soaplib.wsgi import Application
+
+try:
+    from twisted.internet import defer
+    from twisted.web.server import NOT_DONE_YET
+    from twisted.web.test.requesthelper import DummyRequest
+
+    from soaplib.util.server import SoapResource
+
+except ImportError:
+    DummyRequest = None
+
+class DeferredService(DefinitionBase):
+    pending = []
+
+    @rpc(String, _returns=String)
+    def echo(self, s):
+        return s
+
+    @rpc(String, _returns=String)
+    def deferred_echo(self, s):
+        d = defer.Deferred()
+        DeferredService.pending.append((d, s))
+
+        return d
+
+    @rpc(String, _returns=String, _coalesce=True)
+    def coalesced_echo(self, s):
+        d = defer.Deferred()
+        DeferredService.pending.append((d, s))
+
+        return d
+
+    @rpc(String, _returns=String)
+    def deferred_fail(self, s):
+        return defer.fail(ValueError(s))
+
+if not (DummyRequest is None):
+    class Request(DummyRequest):
+        def __init__(self, method, body=''):
+            DummyRequest.__init__(self, [''])
+
+            self.method = method
+            self.content = StringIO(body)
+            self.requestHeaders.setRawHeaders('content-type', ['text/xml'])
+            self.requestHeaders.setRawHeaders('content-length',
+                                                               [str(len(body))])
+
+        def isSecure(self):
+            return False
+
+def envelope(method, arg):
+    return '''<?xml version="1.0"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"
+                   xmlns:tns="tns">
+    <SOAP-ENV:Body>
+        <tns:%s><tns:s>%s</tns:s></tns:%s>
+    </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>''' % (method, arg, method)
+
+class TestSoapResource(unittest.TestCase):
+    def setUp(self):
+        if DummyRequest is None:
+            self.skipTest('twisted is not installed')
+
+        self.resource = SoapResource(Application([DeferredService], 'tns'))
+        del DeferredService.pending[:]
+
+    def __post(self, method, arg):
+        request = Request('POST', envelope(method, arg))
+        self.assertEquals(self.resource.render(request), NOT_DONE_YET)
+
+        return request
+
+    def __result(self, request):
+        self.assertEquals(request.finished, 1)
+
+        elt = etree.fromstring(''.join(request.written))
+        return elt.xpath('//*[local-name()="%s"]/text()' % 'faultstring') or \
+               elt.xpath('//*[local-name()="%s"]/text()' % 'echoResult') or \
+               elt.xpath('//*[local-name()="%s"]/text()' %
+                                                       'deferred_echoResult') or \
+               elt.xpath('//*[local-name()="%s"]/text()' %
+                                                       'coalesced_echoResult')
+
+    def test_sync(self):
+        request = self.__post('echo', 'hello')
+
+        self.assertEquals(request.responseCode, 200)
+        self.assertEquals(self.__result(request), ['hello'])
+
+    def test_deferred(self):
+        request = self.__post('deferred_echo', 'hello')
+        self.assertEquals(request.finished, 0)
+
+        d, s = DeferredService.pending.pop()
+        d.callback(s.upper())
+
+        self.assertEquals(request.responseCode, 200)
+        self.assertEquals(self.__result(request), ['HELLO'])
+
+    def test_coalescing(self):
+        requests = [self.__post('coalesced_echo', 'hello') for i in range(3)]
+        other = self.__post('coalesced_echo', 'bye')
+
+        self.assertEquals(len(DeferredService.pending), 2)
+        self.assertEquals(self.resource.get_coalescing_stats(),
+                                  {'calls': 2, 'collapsed': 2, 'in_flight': 2})
+
+        for d, s in DeferredService.pending:
+            d.callback(s.upper())
+
+        for request in requests:
+            self.assertEquals(request.responseCode, 200)
+            self.assertEquals(self.__result(request), ['HELLO'])
+
+        self.assertEquals(self.__result(other), ['BYE'])
+        self.assertEquals(self.resource.get_coalescing_stats()['in_flight'], 0)
+
+    def test_deferred_fault(self):
+        request = self.__post('deferred_fail', 'oops')
+
+        self.assertEquals(request.responseCode, 500)
+        self.assertEquals(self.__result(request), ['oops'])
+
+    def test_client_fault(self):
+        request = self.__post('no_such_method', 'hello')
+
+        self.assertEquals(request.responseCode, 500)
+
+    def test_content_length(self):
+        request = Request('POST', envelope('echo', 'hello'))
+        request.requestHeaders.removeHeader('content-length')
+        self.resource.render(request)
+
+        self.assertEquals(request.responseCode, 500)
+        self.assertEquals(self.__result(request),
+                                ['A valid Content-Length header is required'])
+
+    def test_wsdl(self):
+        request = Request('GET')
+        request.uri = 'http://dummy/?wsdl'
+
+        wsdl = self.resource.render(request)
+
+        self.assertEquals(request.responseCode, 200)
+        self.assertTrue('deferred_echo' in wsdl)
+
+if __name__ == '__main__':
+    unittest.main()
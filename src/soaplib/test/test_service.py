@@ -18,8 +18,15 @@
 #
 
 import datetime
+import gzip
+import os
+import tempfile
+import threading
+import time
 import unittest
 
+from StringIO import StringIO
+
 from lxml import etree
 
 from soaplib.serializers.clazz import ClassSerializer
@@ -28,10 +35,17 @@ from soaplib.serializers.primitive import DateTime
 from soaplib.serializers.primitive import Float
 from soaplib.serializers.primitive import Integer
 from soaplib.serializers.primitive import String
+from soaplib.serializers.exception import Fault
+from soaplib.serializers.emitter import Emitter
+
+import soaplib
 
 from soaplib import service
 from soaplib import wsgi
+from soaplib.client import ServiceClientBase
 from soaplib.service import rpc
+from soaplib.util.cache import ResponseCache
+from soaplib.util.shared_cache import SharedResponseCache
 
 class Address(ClassSerializer):
     __namespace__ = "TestService"
@@ -119,6 +133,74 @@ class MultipleReturnService(service.DefinitionBase):
     def multi(self, s):
         return s, 'a', 'b'
 
+class StreamingService(service.DefinitionBase):
+    @rpc(Integer, _returns=Array(Person), _streaming=True)
+    def people(self, count):
+        for i in range(count):
+            p = Person()
+            p.name = u'\u00e7 %d' % i
+            p.age = i
+            p.titles = ['t%d' % i]
+            yield p
+
+class Cursor(object):
+    closed = False
+
+    def __init__(self, count):
+        self.rows = iter(range(count))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return 'row %d' % self.rows.next()
+
+    def close(self):
+        Cursor.closed = True
+
+class BrokenCursor(Cursor):
+    def next(self):
+        raise ValueError('the connection is gone')
+
+class GeneratorService(service.DefinitionBase):
+    @rpc(Integer, _returns=Array(String))
+    def rows(self, count):
+        return Cursor(count)
+
+    @rpc(Integer, _returns=Array(String))
+    def broken_rows(self, count):
+        return BrokenCursor(count)
+
+    @rpc(Integer, _returns=String)
+    def text(self, count):
+        return 'text'
+
+class HeaderService(service.DefinitionBase):
+    @rpc(_returns=String)
+    def header(self):
+        return self.soap_in_header
+
+class CachedService(service.DefinitionBase):
+    calls = []
+
+    @rpc(Person, _returns=String, _cache=ResponseCache())
+    def greet(self, p):
+        CachedService.calls.append(p.name)
+        return 'hello %s' % p.name
+
+    @rpc(String, _returns=String, _cache=True)
+    def shared(self, s):
+        CachedService.calls.append(s)
+        return s
+
+    released = threading.Event()
+
+    @rpc(String, _returns=String, _coalesce=True)
+    def coalesced(self, s):
+        CachedService.calls.append(s)
+        CachedService.released.wait()
+        return s
+
 class Test(unittest.TestCase):
     '''
     Most of the service tests are excersized through the interop tests
@@ -159,9 +241,586 @@ class Test(unittest.TestCase):
         self.assertEqual(response_data[1], 'b')
         self.assertEqual(response_data[2], 'c')
 
+    def test_streaming(self):
+        app = wsgi.Application([StreamingService], 'tns')
+        app.get_wsdl('')
+        app.stream_chunk_size = 128
+
+        srv = StreamingService()
+        ctx = service.MethodContext(srv)
+        ctx.descriptor = srv.get_method('people')
+        self.assertTrue(ctx.descriptor.streaming)
+
+        expected = app.serialize_soap(ctx, list(srv.people(10)))
+        chunks = list(app.serialize_soap_stream(ctx, srv.people(10)))
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertEquals(''.join(chunks), expected)
+
+    def test_generator_return(self):
+        app = wsgi.Application([GeneratorService], 'tns',
+                                    service_lifecycle=soaplib.SERVICE_SINGLETON)
+        app.stream_chunk_size = 128
+
+        req = ('<senv:Envelope xmlns:senv="http://schemas.xmlsoap.org/soap/'
+               'envelope/" xmlns:tns="tns"><senv:Body><tns:rows>'
+               '<tns:count>100</tns:count></tns:rows></senv:Body>'
+               '</senv:Envelope>')
+
+        Cursor.closed = False
+        status, headers, result = self.__post(app, req)
+
+        self.assertEquals(status, '200 OK')
+        self.assertFalse('Content-Length' in headers)
+
+        # the call is still bound to the thread while it's being streamed
+        srv = app.get_service(GeneratorService)
+        self.assertEquals(srv.method_name, '{tns}rows')
+
+        chunks = list(result)
+        result.close()
+
+        self.assertEquals(srv.method_name, None)
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(Cursor.closed)
+
+        body = etree.fromstring(''.join(chunks))[0]
+        self.assertEquals(len(body[0][0]), 100)
+        self.assertEquals(body[0][0][99].text, 'row 99')
+
+        # when the first items fail, the response is a fault, and the result
+        # is closed all the same
+        Cursor.closed = False
+        status, headers, result = self.__post(app,
+                                  req.replace('tns:rows', 'tns:broken_rows'))
+
+        self.assertEquals(status, wsgi.HTTP_500)
+        self.assertTrue('the connection is gone' in ''.join(result))
+        self.assertTrue(Cursor.closed)
+
+        # only the methods declared to return an array are streamed
+        ctx = service.MethodContext(srv)
+        ctx.descriptor = srv.get_method('text')
+        self.assertFalse(app.is_streaming(ctx, Cursor(1)))
+
+        ctx.descriptor = srv.get_method('rows')
+        self.assertTrue(app.is_streaming(ctx, Cursor(1)))
+
+    def test_routes(self):
+        cls, descriptor = self.app.get_route('{tns}aa')
+        self.assertTrue(cls is TestService)
+        self.assertEquals(descriptor.name, 'aa')
+
+        self.assertTrue(self.app.get_route('aa') is
+                                              self.app.get_route('{tns}aa'))
+        self.assertTrue(self.app.get_route('"aa"') is
+                                              self.app.get_route('{tns}aa'))
+        self.assertTrue(self.srv.get_method('{tns}aa') is descriptor)
+
+        self.assertRaises(Fault, self.app.get_route, '{tns}nonexistent')
+        self.assertRaises(Exception, wsgi.Application,
+                                                 [TestService, TestService], 'tns')
+
+        # methods can't share soap actions with other methods either
+        class ActionService(service.DefinitionBase):
+            @rpc(String, _returns=String, _public_name='aa')
+            def other(self, s):
+                return s
+
+        self.assertRaises(Exception, wsgi.Application,
+                                             [TestService, ActionService], 'tns')
+
+    def test_service_lifecycle(self):
+        app = wsgi.Application([TestService], 'tns')
+        self.assertFalse(app.get_service(TestService) is
+                                                   app.get_service(TestService))
+
+        app = wsgi.Application([TestService], 'tns',
+                                   service_lifecycle=soaplib.SERVICE_PER_THREAD)
+        self.assertTrue(app.get_service(TestService) is
+                                                   app.get_service(TestService))
+
+        instances = []
+        t = threading.Thread(target=lambda:
+                                 instances.append(app.get_service(TestService)))
+        t.start()
+        t.join()
+        self.assertFalse(instances[0] is app.get_service(TestService))
+
+        app = wsgi.Application([TestService], 'tns',
+                                    service_lifecycle=soaplib.SERVICE_SINGLETON)
+        self.assertTrue(app.get_service(TestService) is
+                                                   app.get_service(TestService))
+
+        self.assertRaises(ValueError, wsgi.Application, [TestService], 'tns',
+                                                service_lifecycle='whatever')
+
+    def test_method_context(self):
+        app = wsgi.Application([HeaderService], 'tns',
+                                    service_lifecycle=soaplib.SERVICE_SINGLETON)
+        srv = app.get_service(HeaderService)
+
+        ctx1 = service.MethodContext(srv)
+        ctx1.descriptor = srv.get_method('header')
+        ctx1.soap_in_header = 'first'
+
+        ctx2 = service.MethodContext(srv)
+        ctx2.descriptor = srv.get_method('header')
+        ctx2.soap_in_header = 'second'
+
+        # the shared instance sees the state of the call being processed
+        self.assertEquals(app.process_request(ctx1, []), 'first')
+        self.assertEquals(app.process_request(ctx2, []), 'second')
+
+        srv.soap_out_header = 'out'
+        self.assertEquals(ctx2.soap_out_header, 'out')
+        self.assertEquals(ctx1.soap_out_header, None)
+
+        self.assertFalse(hasattr(ctx1, '__dict__'))
+
+        # the context of a request is unbound once its response is produced
+        req = ('<senv:Envelope xmlns:senv="http://schemas.xmlsoap.org/soap/'
+               'envelope/" xmlns:tns="tns"><senv:Body><tns:header/>'
+               '</senv:Body></senv:Envelope>')
+        self.__post(app, req)
+
+        self.assertEquals(srv.body_xml, None)
+        self.assertEquals(srv.method_name, None)
+
+        # another call's context is left alone
+        srv.set_context(ctx1)
+        srv.clear_context(ctx2)
+        self.assertTrue(srv.get_context() is ctx1)
+        srv.clear_context(ctx1)
+        self.assertFalse(srv.get_context() is ctx1)
+
+    def test_hooks(self):
+        calls = []
+        class HookedService(HeaderService):
+            def on_method_call(self, ctx, environ, method_name, py_params,
+                                                                  soap_params):
+                calls.append(('call', ctx))
+                ctx.udc = 'udc'
+
+            def on_method_return(self, ctx, environ, py_results,
+                                              soap_results, http_resp_headers):
+                calls.append(('return', ctx))
+
+        class HookedApplication(wsgi.Application):
+            def on_return(self, ctx, environ, http_headers, return_str):
+                calls.append(('app_return', ctx))
+
+        app = HookedApplication([HookedService], 'tns')
+
+        req = ('<senv:Envelope xmlns:senv="http://schemas.xmlsoap.org/soap/'
+               'envelope/" xmlns:tns="tns"><senv:Body><tns:header/>'
+               '</senv:Body></senv:Envelope>')
+        self.__post(app, req)
+
+        self.assertEquals([c[0] for c in calls],
+                                              ['call', 'return', 'app_return'])
+        ctx = calls[0][1]
+        self.assertTrue(isinstance(ctx, service.MethodContext))
+        self.assertTrue(calls[1][1] is ctx and calls[2][1] is ctx)
+        self.assertEquals(ctx.udc, 'udc')
+        self.assertEquals(ctx.method_name, '{tns}header')
+
+    def __post(self, app, body, **headers):
+        # the response is returned as is, so that streamed responses can be
+        # checked before they're consumed.
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'text/xml',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+            'wsgi.url_scheme': 'http',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'PATH_INFO': '/',
+            'QUERY_STRING': '',
+        }
+        environ.update(headers)
+
+        status = []
+        def start_response(code, headers):
+            status.append((code, dict(headers)))
+
+        result = app(environ, start_response)
+
+        return status[0][0], status[0][1], result
+
+    def __get(self, app, path_info, query_string='', **headers):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'wsgi.url_scheme': 'http',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'PATH_INFO': path_info,
+            'QUERY_STRING': query_string,
+        }
+        environ.update(headers)
+
+        status = []
+        def start_response(code, headers):
+            status.append((code, dict(headers)))
+
+        body = ''.join(app(environ, start_response))
+
+        return status[0][0], status[0][1], body
+
+    def test_wsdl_conditional_get(self):
+        app = wsgi.Application([TestService], 'tns')
+
+        code, headers, body = self.__get(app, '/', 'wsdl')
+        self.assertEquals(code, '200 OK')
+        self.assertEquals(body, app.get_wsdl('http://localhost/'))
+        self.assertEquals(headers['Content-Length'], str(len(body)))
+        self.assertEquals(headers['Vary'], 'Accept-Encoding')
+
+        etag = headers['ETag']
+        code, headers, body = self.__get(app, '/', 'wsdl',
+                                               HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(code, '304 Not Modified')
+        self.assertEquals(body, '')
+
+        code, headers, body = self.__get(app, '/', 'wsdl',
+                                           HTTP_IF_NONE_MATCH='"other"')
+        self.assertEquals(code, '200 OK')
+
+        code, headers, body = self.__get(app, '/', 'wsdl',
+                                   HTTP_ACCEPT_ENCODING='deflate, gzip;q=0.5')
+        self.assertEquals(headers['Content-Encoding'], 'gzip')
+        self.assertNotEquals(headers['ETag'], etag)
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(body)).read(),
+                                           app.get_wsdl('http://localhost/'))
+
+        code, headers, body = self.__get(app, '/', 'wsdl',
+                                               HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse('Content-Encoding' in headers)
+
+    def test_wsdl_per_url(self):
+        app = wsgi.Application([TestService], 'tns')
+
+        def get_address(url):
+            wsdl = etree.fromstring(app.get_wsdl(url))
+            return wsdl.find('.//{http://schemas.xmlsoap.org/wsdl/soap/}'
+                                                       'address').get('location')
+
+        self.assertEquals(get_address('http://a.example.com/svc?wsdl'),
+                                                 'http://a.example.com/svc')
+        self.assertEquals(get_address('HTTP://B.example.com:80/svc.wsdl'),
+                                                 'http://b.example.com/svc')
+        self.assertEquals(get_address('http://c/svc?a="b"&c<d'),
+                                                 'http://c/svc')
+        self.assertEquals(get_address('http://c/"&<'), 'http://c/"&<')
+
+        self.assertTrue(app.get_wsdl('http://a.example.com/svc') is
+                                        app.get_wsdl('http://A.example.com/svc'))
+
+    def test_xsd_documents(self):
+        app = wsgi.Application([MultipleNamespaceService], 'tns')
+        documents = app.get_schema_documents()
+
+        for file_name, document in documents.items():
+            code, headers, body = self.__get(app, '/svc/%s' % file_name)
+            self.assertEquals(code, '200 OK')
+            self.assertEquals(body, document)
+
+        code, headers, body = self.__get(app, '/svc/nonexistent.xsd')
+        self.assertEquals(code, '404 Not Found')
+
     def test_multiple_ns(self):
         svc = wsgi.Application([MultipleNamespaceService], 'tns')
         wsdl = svc.get_wsdl("URL")
 
+    def test_multiple_ns_validation(self):
+        app = wsgi.ValidatingApplication([MultipleNamespaceService], 'tns')
+
+        req = etree.fromstring('<tns:a xmlns:tns="tns">'
+                                   '<tns:t1><ns1:i xmlns:ns1="TestService.NS1">'
+                                       '%s</ns1:i></tns:t1></tns:a>')
+        req[0][0].text = '5'
+        app.validate_request(req)
+
+        req[0][0].text = 'abc'
+        self.assertRaises(Fault, app.validate_request, req)
+
+        descriptor = app.get_route('{tns}a')[1]
+        self.assertTrue(app.get_validator(descriptor) is
+                                                app.get_validator(descriptor))
+        self.assertFalse(app.get_validator(descriptor) is app.schema)
+
+    def test_validate_while_parsing(self):
+        class ParseValidatingApplication(wsgi.ValidatingApplication):
+            validate_while_parsing = True
+
+        app = ParseValidatingApplication([MultipleNamespaceService], 'tns')
+
+        req = ('<senv:Envelope xmlns:senv="http://schemas.xmlsoap.org/soap/'
+               'envelope/"><senv:Body><tns:a xmlns:tns="tns"><tns:t1>'
+               '<ns1:i xmlns:ns1="TestService.NS1">%s</ns1:i></tns:t1>'
+               '</tns:a></senv:Body></senv:Envelope>')
+
+        ctx, params = app.deserialize_soap(req % '5')
+        self.assertEquals(params[0].i, 5)
+
+        ctx, fault = app.deserialize_soap(req % 'abc')
+        self.assertTrue(ctx is None)
+        self.assertEquals(fault.faultcode, 'senv:Client.SchemaValidation')
+
+    def test_batch(self):
+        class BatchApplication(wsgi.Application):
+            batch_enabled = True
+            batch_workers = 4
+
+        app = BatchApplication([TestService], 'tns')
+        self.assertTrue('"batch"' in app.get_wsdl('http://localhost/'))
+
+        req = ('<senv:Envelope xmlns:senv="http://schemas.xmlsoap.org/soap/'
+               'envelope/" xmlns:tns="tns"><senv:Body><tns:batch>'
+               '<tns:payloads>%s</tns:payloads></tns:batch></senv:Body>'
+               '</senv:Envelope>')
+        items = ''.join(['<tns:anyType>%s</tns:anyType>' % p for p in (
+            '<tns:aa><tns:s>x</tns:s></tns:aa>',
+            '<tns:unknown/>',
+            '<tns:batch/>',
+            '<tns:aa><tns:s>y</tns:s></tns:aa>',
+        )])
+
+        ctx, params = app.deserialize_soap(req % items)
+        results = app.process_request(ctx, params)
+
+        self.assertEquals([r.tag.split('}')[-1] for r in results],
+                                ['aaResponse', 'Fault', 'Fault', 'aaResponse'])
+        self.assertTrue('nested' in etree.tostring(results[2]))
+
+        response = etree.fromstring(app.serialize_soap(ctx, results))
+        self.assertEquals(len(response.xpath('//tns:anyType',
+                                              namespaces={'tns': 'tns'})), 4)
+
+        # the items of a batch aren't left bound to the thread either
+        for workers in (1, 4):
+            BatchApplication.batch_workers = workers
+            app = BatchApplication([TestService], 'tns',
+                                    service_lifecycle=soaplib.SERVICE_SINGLETON)
+            srv = app.get_service(TestService)
+
+            ctx, params = app.deserialize_soap(req % items)
+            app.process_request(ctx, params)
+
+            self.assertEquals(srv.get_context().method_name, None)
+            self.assertEquals(srv.get_context().body_xml, None)
+
+    def test_parser_target(self):
+        class TargetApplication(wsgi.Application):
+            use_parser_target = True
+
+        p = Person()
+        p.name = 'bob'
+        p.birthdate = datetime.datetime(1979, 1, 1)
+        p.titles = ['a', 'b']
+        p.addresses = []
+        for i in range(3):
+            a = Address()
+            a.street = 'street %d' % i
+            a.zip = i
+            p.addresses.append(a)
+
+        client = ServiceClientBase('http://localhost/', TestService, 'tns')
+        req, headers = client.serialize_request(client.methods['b'],
+                                                          (p, None, a), {})
+
+        ctx, tree_params = self.app.deserialize_soap(req)
+        ctx, params = TargetApplication([TestService], 'tns'
+                                                       ).deserialize_soap(req)
+
+        self.assertEquals(ctx.method_name, '{tns}b')
+        self.assertTrue(ctx.body_xml is None)
+
+        for i in range(3):
+            p, tree_p = params[i], tree_params[i]
+            if i == 1:
+                self.assertEquals(p, None)
+                self.assertEquals(tree_p, None)
+                continue
+
+            for k in p._type_info:
+                if k != 'addresses':
+                    self.assertEquals(getattr(p, k), getattr(tree_p, k))
+
+        self.assertEquals([(a.street, a.zip, a.city) for a in params[0].addresses],
+                    [('street %d' % i, i, None) for i in range(3)])
+
+        req = ('<senv:Envelope xmlns:senv="http://schemas.xmlsoap.org/soap/'
+               'envelope/" xmlns:tns="tns"><senv:Body><tns:aa>'
+               '<tns:s href="#id0"/></tns:aa><tns:s id="id0">x</tns:s>'
+               '</senv:Body></senv:Envelope>')
+
+        ctx, fault = TargetApplication([TestService], 'tns'
+                                                       ).deserialize_soap(req)
+        self.assertTrue(ctx is None)
+        self.assertEquals(fault.faultcode, 'senv:Client.SoapError')
+
+    def test_direct_emitter(self):
+        class EmitterApplication(wsgi.Application):
+            use_direct_emitter = True
+
+        # the texts of numbers that aren't numbers are escaped
+        address = Address()
+        address.zip = '1</s0:zip><s0:evil/><s0:zip>2'
+
+        for service_class, method_name, value in (
+                    (StreamingService, 'people', list(StreamingService(
+                                                            ).people(3))),
+                    (StreamingService, 'people', []),
+                    (TestService, 'aa', u'<a href="x">&\r\u00e7</a>'),
+                    (TestService, 'aa', None),
+                    (TestService, 'b', Address()),
+                    (TestService, 'b', address),
+                ):
+            srv = service_class()
+            expected = wsgi.Application([service_class], 'tns')
+            app = EmitterApplication([service_class], 'tns')
+
+            for i in range(2):
+                ctx = service.MethodContext(srv)
+                ctx.descriptor = srv.get_method(method_name)
+                tree = expected.serialize_soap(ctx, value)
+
+                ctx = service.MethodContext(srv)
+                ctx.descriptor = srv.get_method(method_name)
+                self.assertEquals(app.serialize_soap(ctx, value), tree)
+                self.assertTrue(ctx.soap_body is None)
+
+                # generating the wsdl renames the prefix of the tns.
+                expected.get_wsdl('')
+                app.get_wsdl('')
+
+        ctx = service.MethodContext(srv)
+        ctx.descriptor = srv.get_method('aa')
+        self.assertRaises(ValueError, app.serialize_soap, ctx, 'a\x00')
+
+        serializer = Array(Integer)
+        serializer.resolve_namespace(serializer, 'tns')
+
+        out = []
+        encode = Emitter({'tns': 'tns', 'xsi': soaplib.ns_xsi}).get_encoder(
+                                                      serializer, 'tns', 'a')
+        encode(['1</tns:integer><tns:integer>2', 3], out)
+        self.assertEquals(''.join(out), '<tns:a><tns:integer>'
+                 '1&lt;/tns:integer&gt;&lt;tns:integer&gt;2</tns:integer>'
+                 '<tns:integer>3</tns:integer></tns:a>')
+
+    def test_response_cache(self):
+        app = wsgi.Application([CachedService], 'tns')
+        client = ServiceClientBase('http://localhost/', CachedService, 'tns')
+
+        def call(name):
+            p = Person()
+            p.name = name
+            p.titles = ['a', 'b']
+
+            req, headers = client.serialize_request(client.methods['greet'],
+                                                                     (p,), {})
+
+            return ''.join(self.__post(app, req)[2])
+
+        cache = CachedService().get_method('greet').cache
+        cache.clear()
+        del CachedService.calls[:]
+
+        first = call('bob')
+        self.assertEquals(call('bob'), first)
+        self.assertEquals(CachedService.calls, ['bob'])
+
+        call('jim')
+        self.assertEquals(CachedService.calls, ['bob', 'jim'])
+        self.assertEquals((cache.hits, len(cache)), (1, 2))
+
+        cache.invalidate('greet')
+        self.assertEquals(call('bob'), first)
+        self.assertEquals(CachedService.calls, ['bob', 'jim', 'bob'])
+
+    def test_shared_response_cache(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+
+        apps = []
+        try:
+            for i in range(2):
+                app = wsgi.Application([CachedService], 'tns')
+                app.response_cache = SharedResponseCache(path, size=64 * 1024)
+                apps.append(app)
+
+            srv = CachedService()
+            del CachedService.calls[:]
+
+            results = []
+            for app in apps:
+                ctx = service.MethodContext(srv)
+                ctx.descriptor = srv.get_method('shared')
+                ctx.method_name = '{tns}shared'
+
+                result_str = app.get_cached_response(ctx, ['x'])
+                if result_str is None:
+                    result = app.process_request(ctx, ['x'])
+                    result_str = app.serialize_soap(ctx, result)
+                    app.cache_response(ctx, result, result_str)
+
+                results.append(result_str)
+
+            self.assertEquals(CachedService.calls, ['x'])
+            self.assertEquals(results[0], results[1])
+
+            # the wsdl is cached there as well
+            wsdl = apps[0].get_wsdl('http://localhost/')
+            self.assertEquals(apps[1].response_cache.get_stats()['entries'], 2)
+            self.assertEquals(apps[1].get_wsdl('http://localhost/'), wsdl)
+
+        finally:
+            for app in apps:
+                app.response_cache.close()
+            os.unlink(path)
+
+    def test_coalescing(self):
+        app = wsgi.Application([CachedService], 'tns')
+        srv = CachedService()
+
+        del CachedService.calls[:]
+        CachedService.released.clear()
+
+        results = []
+        def call():
+            ctx = service.MethodContext(srv)
+            ctx.descriptor = srv.get_method('coalesced')
+            ctx.method_name = '{tns}coalesced'
+
+            self.assertTrue(app.is_coalesced(ctx))
+            results.append(app.process_coalesced(ctx, ['x']))
+
+        threads = [threading.Thread(target=call) for i in range(4)]
+        for t in threads:
+            t.start()
+
+        try:
+            deadline = time.time() + 5
+            while app.get_coalescing_stats()['collapsed'] < 3:
+                if time.time() > deadline:
+                    self.fail('the calls were not coalesced: %r' %
+                                                 app.get_coalescing_stats())
+                time.sleep(0.01)
+
+        finally:
+            CachedService.released.set()
+            for t in threads:
+                t.join()
+
+        self.assertEquals(CachedService.calls, ['x'])
+        self.assertEquals(len(results), 4)
+        self.assertEquals(len(set(results)), 1)
+        self.assertEquals(app.get_coalescing_stats(),
+                                  {'calls': 1, 'collapsed': 3, 'in_flight': 0})
+
 if __name__ == '__main__':
     unittest.main()
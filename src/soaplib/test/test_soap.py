@@ -20,6 +20,7 @@
 import unittest
 
 from lxml import etree
+from StringIO import StringIO
 
 from soaplib.serializers.clazz import ClassSerializer
 
@@ -106,6 +107,61 @@ xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
         # quick and dirty test href reconstruction
         self.assertEquals(len(payload.getchildren()[0].getchildren()), 2)
 
+    def test_from_soap_stream(self):
+        a = '''<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Header><h1>a</h1><h2>b</h2></soap:Header>
+  <soap:Body>
+    <payload><a>1</a></payload>
+    <sibling><b>2</b></sibling>
+  </soap:Body>
+</soap:Envelope>'''
+
+        header, body = from_soap(StringIO(a), None)
+
+        self.assertEquals(header.tag, 'h1')
+        self.assertEquals(body.tag, 'payload')
+        self.assertEquals(body.getnext(), None)
+        self.assertEquals(len(body.getparent()), 1)
+
+    def test_multiref(self):
+        a = '''<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Body>
+    <myResponse><myResult href="#id1" /></myResponse>
+    <MyData id="id1"><Machine>somemachine</Machine></MyData>
+  </soap:Body>
+</soap:Envelope>'''
+
+        header, body = from_soap(a, 'utf8')
+
+        self.assertEquals(header, None)
+        self.assertEquals(body[0].find('Machine').text, 'somemachine')
+
+        # the targets can also be in the header, in the payload itself, or
+        # nested in the subsequent children of the body
+        a = '''<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <soap:Header><h1><HeaderData id="id1">inheader</HeaderData></h1></soap:Header>
+  <soap:Body>
+    <myResponse>
+      <a href="#id1" />
+      <b href="#id2" />
+      <c href="#id3" />
+      <nested><NestedData id="id2">inpayload</NestedData></nested>
+    </myResponse>
+    <sibling><SiblingData id="id3">insibling</SiblingData></sibling>
+    <other><d>freed</d></other>
+  </soap:Body>
+</soap:Envelope>'''
+
+        header, body = from_soap(a, 'utf8')
+
+        self.assertEquals(body.find('a').text, 'inheader')
+        self.assertEquals(body.find('b').text, 'inpayload')
+        self.assertEquals(body.find('c').text, 'insibling')
+        self.assertEquals(len(body.getparent()), 2)
+
     def test_namespaces(self):
         m = Message.produce(
             namespace="some_namespace",
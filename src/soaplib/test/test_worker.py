@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import threading
+import time
+import unittest
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from Queue import Queue
+from StringIO import StringIO
+
+from lxml import etree
+
+import soaplib
+
+from soaplib import service
+from soaplib import wsgi
+from soaplib.serializers.primitive import String
+from soaplib.service import rpc
+from soaplib.util import create_callback_info_headers
+from soaplib.util.worker import AsyncEngine
+from soaplib.util.worker import STATE_DELIVERED
+
+class SleepingService(service.DefinitionBase):
+    gate = threading.Event()
+
+    @rpc(String, _is_async=True)
+    def sleep(self, message):
+        SleepingService.gate.wait()
+
+        if message == 'nightmare':
+            raise Exception('woke up screaming')
+
+        return message.upper()
+
+    @rpc(String, _is_callback=True)
+    def woke_up(self, message):
+        pass
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.posts += 1
+
+        if self.server.statuses:
+            status = self.server.statuses.pop(0)
+        else:
+            status = 200
+
+        if status is None:
+            # the connection is dropped without a response
+            self.close_connection = 1
+            return
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+        # the connection is closed without telling the client
+        self.close_connection = self.server.close_idle
+
+        if status == 200:
+            self.server.received.put((self.headers, body))
+
+    def log_message(self, *args):
+        pass
+
+class TestAsyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), CallbackHandler)
+        self.server.received = Queue()
+        self.server.statuses = []
+        self.server.posts = 0
+        self.server.close_idle = False
+
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+        self.reply_to = 'http://127.0.0.1:%d/callback' % \
+                                                    self.server.server_port
+
+        self.engine = AsyncEngine(workers=1, max_pending=1, retry_delay=0.01)
+        self.app = wsgi.Application([SleepingService], 'tns',
+                                                   async_engine=self.engine)
+
+        SleepingService.gate.set()
+
+    def tearDown(self):
+        SleepingService.gate.set()
+
+        self.engine.shutdown()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __call(self, message, message_id, reply_to=None):
+        envelope = etree.Element('{%s}Envelope' % soaplib.ns_soap_env)
+        header = etree.SubElement(envelope, '{%s}Header' % soaplib.ns_soap_env)
+        if not (reply_to is None):
+            message_id_elt, reply_to_elt = create_callback_info_headers(
+                                                          message_id, reply_to)
+            header.append(reply_to_elt)
+            header.append(message_id_elt)
+
+        body = etree.SubElement(envelope, '{%s}Body' % soaplib.ns_soap_env)
+        sleep = etree.SubElement(body, '{tns}sleep')
+        etree.SubElement(sleep, '{tns}message').text = message
+
+        req = etree.tostring(envelope)
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'text/xml',
+            'CONTENT_LENGTH': str(len(req)),
+            'wsgi.input': StringIO(req),
+            'wsgi.url_scheme': 'http',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'PATH_INFO': '/',
+            'QUERY_STRING': '',
+        }
+
+        status = []
+        def start_response(code, headers):
+            status.append(code)
+
+        response = ''.join(self.app(environ, start_response))
+
+        return response, status
+
+    def __wait_for(self, predicate):
+        for i in range(500):
+            if predicate():
+                return
+            time.sleep(0.01)
+
+        self.fail('timeout')
+
+    def __callback(self):
+        headers, body = self.server.received.get(timeout=5)
+
+        envelope = etree.fromstring(body)
+        relates_to = envelope.find('.//{%s}RelatesTo' % soaplib.ns_wsa).text
+        body = envelope.find('{%s}Body' % soaplib.ns_soap_env)[0]
+
+        return headers, relates_to, body
+
+    def test_callback(self):
+        self.server.statuses = [503] # the first attempt is retried
+
+        response, status = self.__call('hello', 'msg-1', self.reply_to)
+        self.assertEquals(status, [wsgi.HTTP_202])
+        self.assertEquals(response, '')
+
+        headers, relates_to, body = self.__callback()
+        self.assertEquals(relates_to, 'msg-1')
+        self.assertEquals(headers['SOAPAction'], '"woke_up"')
+        self.assertEquals(body.tag, '{tns}woke_up')
+        self.assertEquals(body[0].text, 'HELLO')
+
+        self.__wait_for(lambda: self.engine.get_status('msg-1') ==
+                                                               STATE_DELIVERED)
+        stats = self.engine.get_stats()
+        self.assertEquals(stats['completed'], 1)
+        self.assertEquals(stats['retries'], 1)
+        self.assertEquals(stats['queued'], 0)
+
+    def test_connection_pool(self):
+        pool = self.engine.connection_pool
+        host = '127.0.0.1:%d' % self.server.server_port
+
+        # idle connections closed by the server are not reused
+        self.server.close_idle = True
+        self.assertEquals(pool.request('POST', self.reply_to, 'a')[0], 200)
+        self.assertEquals(pool.idle_count('http', host), 1)
+
+        time.sleep(0.1)
+        self.assertEquals(pool.request('POST', self.reply_to, 'b')[0], 200)
+
+        # requests that were sent are not sent again
+        self.server.close_idle = False
+        self.assertEquals(pool.request('POST', self.reply_to, 'c')[0], 200)
+        self.assertEquals(pool.idle_count('http', host), 1)
+
+        self.server.statuses = [None]
+        self.server.posts = 0
+        self.assertRaises(Exception, pool.request, 'POST', self.reply_to, 'd')
+        self.assertEquals(self.server.posts, 1)
+
+    def test_fault_callback(self):
+        self.__call('nightmare', 'msg-2', self.reply_to)
+
+        headers, relates_to, body = self.__callback()
+        self.assertEquals(relates_to, 'msg-2')
+        self.assertEquals(body.tag, '{%s}Fault' % soaplib.ns_soap_env)
+
+    def test_missing_reply_to(self):
+        response, status = self.__call('hello', 'msg-3')
+
+        self.assertEquals(status, [wsgi.HTTP_500])
+        self.assertTrue('MessageID and ReplyTo' in response)
+
+    def test_backpressure(self):
+        SleepingService.gate.clear()
+
+        self.assertEquals(self.__call('a', 'a', self.reply_to)[1],
+                                                               [wsgi.HTTP_202])
+        self.__wait_for(lambda: self.engine.get_stats()['active'] == 1)
+
+        self.assertEquals(self.__call('b', 'b', self.reply_to)[1],
+                                                               [wsgi.HTTP_202])
+        self.assertEquals(self.engine.get_stats()['queued'], 1)
+
+        response, status = self.__call('c', 'c', self.reply_to)
+        self.assertEquals(status, [wsgi.HTTP_500])
+        self.assertTrue('Server.Busy' in response)
+        self.assertEquals(self.engine.get_stats()['rejected'], 1)
+        self.assertEquals(self.engine.get_status('c'), None)
+
+        SleepingService.gate.set()
+        self.assertEquals(sorted([self.__callback()[1] for i in range(2)]),
+                                                                    ['a', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
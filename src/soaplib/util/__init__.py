@@ -37,26 +37,27 @@ def create_relates_to_header(relatesTo, attrs={}):
 def create_callback_info_headers(message_id, reply_to):
     '''Creates MessageId and ReplyTo headers for initiating an
     async function'''
-    message_id = etree.Element('{%s}MessageID' % soaplib.ns_wsa)
-    message_id.text = message_id
+    message_id_elt = etree.Element('{%s}MessageID' % soaplib.ns_wsa)
+    message_id_elt.text = message_id
 
-    reply_to = etree.Element('{%s}ReplyTo' % soaplib.ns_wsa)
-    address = etree.SubElement(reply_to, '{%s}Address' % soaplib.ns_wsa)
+    reply_to_elt = etree.Element('{%s}ReplyTo' % soaplib.ns_wsa)
+    address = etree.SubElement(reply_to_elt, '{%s}Address' % soaplib.ns_wsa)
     address.text = reply_to
 
-    return message_id, reply_to
+    return message_id_elt, reply_to_elt
 
-def get_callback_info(request):
+def get_callback_info(ctx):
     '''
-    Retrieves the messageId and replyToAddress from the message header.
-    This is used for async calls.
+    Retrieves the messageId and replyToAddress from the message header of the
+    call with the given MethodContext. This is used for async calls.
     '''
     message_id = None
     reply_to_address = None
-    header = request.soap_req_header
+    header = ctx.header_xml
 
-    if header:
-        headers = header.getchildren()
+    if not (header is None):
+        # header_xml is the first header entry
+        headers = header.getparent().getchildren()
         for header in headers:
             if header.tag.lower().endswith("messageid"):
                 message_id = header.text
@@ -70,11 +71,11 @@ def get_callback_info(request):
 
     return message_id, reply_to_address
 
-def get_relates_to_info(request):
+def get_relates_to_info(ctx):
     '''Retrieves the relatesTo header. This is used for callbacks'''
-    header = request.soap_req_header
-    if header:
-        headers = header.getchildren()
+    header = ctx.header_xml
+    if not (header is None):
+        headers = header.getparent().getchildren()
         for header in headers:
             if header.tag.lower().find('relatesto') != -1:
                 return header.text
@@ -85,6 +86,34 @@ def split_url(url):
     host, path = urllib.splithost(remainder)
     return scheme.lower(), host, path
 
+def normalize_url(url):
+    '''
+    Returns the canonical form of the given endpoint url, to be used e.g. as a
+    cache key: the query string and the '.wsdl' suffix are removed, the scheme
+    and the host are lowercased and the default port is dropped.
+    '''
+
+    url = url.split('?', 1)[0].split('#', 1)[0]
+    if url.endswith('.wsdl'):
+        url = url[:-len('.wsdl')]
+
+    scheme, remainder = urllib.splittype(url)
+    if scheme is None:
+        return url
+
+    host, path = urllib.splithost(remainder)
+    if host is None:
+        return url
+
+    scheme = scheme.lower()
+    host = host.lower()
+
+    if (scheme == 'http' and host.endswith(':80')) or \
+                               (scheme == 'https' and host.endswith(':443')):
+        host = host.rsplit(':', 1)[0]
+
+    return '%s://%s%s' % (scheme, host, path)
+
 def reconstruct_url(environ):
     '''
     Rebuilds the calling url from values found in the
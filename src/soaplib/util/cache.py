@@ -0,0 +1,458 @@
+
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import hashlib
+import sys
+import threading
+import time
+
+from lxml import etree
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls with the same key into one: the first caller
+    runs the function, the others wait for it to finish and get the same
+    result, or the same exception.
+
+    calls is the number of calls that ran the function, collapsed the number
+    of those that waited for another one instead.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = {}
+
+        self.calls = 0
+        self.collapsed = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Calls func(*args, **kwargs), unless a call with the same key is
+        already in progress, in which case its result is returned instead.
+        """
+
+        self.__lock.acquire()
+        try:
+            call = self.__calls.get(key, None)
+            if call is None:
+                call = self.__calls[key] = _Call()
+                leader = True
+                self.calls += 1
+
+            else:
+                call.waiters += 1
+                leader = False
+                self.collapsed += 1
+
+        finally:
+            self.__lock.release()
+
+        if leader:
+            try:
+                call.result = func(*args, **kwargs)
+            except:
+                call.exc_info = sys.exc_info()
+
+            self.__lock.acquire()
+            try:
+                del self.__calls[key]
+            finally:
+                self.__lock.release()
+
+            call.event.set()
+
+        else:
+            call.event.wait()
+
+        if not (call.exc_info is None):
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+
+        return call.result
+
+    def in_flight(self):
+        """Returns the number of calls in progress."""
+
+        return len(self.__calls)
+
+    def get_stats(self):
+        """Returns the counters as a dict."""
+
+        return {
+            'calls': self.calls,
+            'collapsed': self.collapsed,
+            'in_flight': self.in_flight(),
+        }
+
+class _Node(object):
+    __slots__ = ('key', 'value', 'prev', 'next')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.prev = None
+        self.next = None
+
+class _RecencyList(object):
+    """
+    A circular doubly linked list of nodes, most recently used first. It
+    isn't thread-safe, its owner is supposed to hold a lock when using it.
+    """
+
+    def __init__(self):
+        self.__head = _Node(None, None)
+        self.clear()
+
+    def clear(self):
+        self.__head.prev = self.__head.next = self.__head
+
+    def unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def push_front(self, node):
+        node.prev = self.__head
+        node.next = self.__head.next
+        node.next.prev = node
+        self.__head.next = node
+
+    def move_to_front(self, node):
+        self.unlink(node)
+        self.push_front(node)
+
+    def last(self):
+        """Returns the least recently used node."""
+
+        return self.__head.prev
+
+class LRUCache(object):
+    """
+    A thread-safe dict with a maximum number of entries. When it's full, the
+    least recently used entry is evicted.
+    """
+
+    class Empty(object):
+        pass
+
+    def __init__(self, max_size):
+        assert max_size > 0
+
+        self.max_size = max_size
+
+        self.__lock = threading.Lock()
+        self.__flight = SingleFlight()
+        self.__map = {}
+        self.__list = _RecencyList()
+
+    def __len__(self):
+        return len(self.__map)
+
+    def __contains__(self, key):
+        return key in self.__map
+
+    def get(self, key, default=None):
+        self.__lock.acquire()
+        try:
+            node = self.__map.get(key, None)
+            if node is None:
+                return default
+
+            self.__list.move_to_front(node)
+
+            return node.value
+
+        finally:
+            self.__lock.release()
+
+    def set(self, key, value):
+        self.__lock.acquire()
+        try:
+            node = self.__map.get(key, None)
+            if node is None:
+                node = self.__map[key] = _Node(key, value)
+                self.__list.push_front(node)
+
+                if len(self.__map) > self.max_size:
+                    oldest = self.__list.last()
+                    self.__list.unlink(oldest)
+                    del self.__map[oldest.key]
+
+            else:
+                node.value = value
+                self.__list.move_to_front(node)
+
+        finally:
+            self.__lock.release()
+
+    def delete(self, key):
+        self.__lock.acquire()
+        try:
+            node = self.__map.pop(key, None)
+            if not (node is None):
+                self.__list.unlink(node)
+
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__map.clear()
+            self.__list.clear()
+
+        finally:
+            self.__lock.release()
+
+    def get_or_create(self, key, factory):
+        """Returns the value for the given key. When it's not in the cache,
+        it's created by calling factory(). Concurrent calls for the same
+        missing key call the factory only once.
+        """
+
+        retval = self.get(key, LRUCache.Empty)
+        if retval is LRUCache.Empty:
+            retval = self.__flight.do(key, self.__create, key, factory)
+
+        return retval
+
+    def __create(self, key, factory):
+        # another thread could have created the value between our lookup and
+        # the beginning of this flight.
+        retval = self.get(key, LRUCache.Empty)
+        if retval is LRUCache.Empty:
+            retval = factory()
+            self.set(key, retval)
+
+        return retval
+
+def _canonicalize(value, out):
+    if value is None or isinstance(value, (bool, int, long, float, str,
+                                                                   unicode)):
+        out.append(repr(value))
+
+    elif isinstance(value, (list, tuple)):
+        out.append('[')
+        for v in value:
+            _canonicalize(v, out)
+            out.append(',')
+        out.append(']')
+
+    elif isinstance(value, dict):
+        out.append('{')
+        for k in sorted(value):
+            _canonicalize(k, out)
+            out.append(':')
+            _canonicalize(value[k], out)
+            out.append(',')
+        out.append('}')
+
+    elif hasattr(value, 'get_plan'):
+        # ClassSerializer instances, member by member.
+        out.append(value.__class__.__name__)
+        out.append('(')
+        for k, v, is_array, ns in value.get_plan().fields:
+            out.append(k)
+            out.append('=')
+            _canonicalize(getattr(value, k, None), out)
+            out.append(',')
+        out.append(')')
+
+    elif etree.iselement(value):
+        out.append(etree.tostring(value, method='c14n'))
+
+    elif hasattr(value, 'tolist'):
+        # array.array, memoryview or numpy array
+        _canonicalize(value.tolist(), out)
+
+    else:
+        out.append(value.__class__.__name__)
+        out.append(repr(value))
+
+def get_canonical_key(name, *values):
+    """Returns a key for the given values that only depends on what they
+    hold, e.g. the deserialized parameters of a call. Two calls with equal
+    parameters get the same key, whatever their xml looked like.
+    """
+
+    out = []
+    _canonicalize(values, out)
+
+    return (name, hashlib.sha1(''.join(out)).hexdigest())
+
+class _Entry(_Node):
+    __slots__ = ('expires',)
+
+class ResponseCache(object):
+    """
+    A cache for the serialized responses of a method, which is passed to the
+    rpc decorator as _cache:
+
+        @rpc(String, _returns=Array(String), _cache=ResponseCache(ttl=60))
+        def get_countries(self, continent):
+            ...
+
+    When a response is found in the cache, the method is not called, and the
+    response is not serialized again. Responses are looked up by the name of
+    the method along with the canonical form of the parameters and of the
+    soap header of the request, see get_canonical_key. So a cache can be
+    shared by several methods. Faults are not cached, nor are streamed,
+    asynchronous and mtom responses.
+
+    Entries expire ttl seconds after being stored, unless ttl is None. When
+    there are more than max_entries entries, or when the responses add up to
+    more than max_size bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, max_entries=1024, max_size=None, ttl=None):
+        assert max_entries > 0
+
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+
+        self.__lock = threading.Lock()
+        self.__map = {}
+        self.__list = _RecencyList()
+
+    def __len__(self):
+        return len(self.__map)
+
+    def __remove(self, node):
+        self.__list.unlink(node)
+        del self.__map[node.key]
+        self.size -= len(node.value)
+
+    def get_key(self, name, params, header=None):
+        return get_canonical_key(name, params, header)
+
+    def get(self, key):
+        """Returns the cached response for the given key, or None."""
+
+        self.__lock.acquire()
+        try:
+            node = self.__map.get(key, None)
+            if not (node is None or node.expires is None or
+                                                 node.expires > time.time()):
+                self.__remove(node)
+                node = None
+
+            if node is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.__list.move_to_front(node)
+
+            return node.value
+
+        finally:
+            self.__lock.release()
+
+    def set(self, key, value):
+        if not (self.max_size is None) and len(value) > self.max_size:
+            return
+
+        self.__lock.acquire()
+        try:
+            node = self.__map.get(key, None)
+            if not (node is None):
+                self.__remove(node)
+
+            node = self.__map[key] = _Entry(key, value)
+            if self.ttl is None:
+                node.expires = None
+            else:
+                node.expires = time.time() + self.ttl
+
+            self.__list.push_front(node)
+            self.size += len(value)
+
+            while len(self.__map) > self.max_entries or not (
+                         self.max_size is None or self.size <= self.max_size):
+                self.__remove(self.__list.last())
+                self.evictions += 1
+
+        finally:
+            self.__lock.release()
+
+    def delete(self, key):
+        self.__lock.acquire()
+        try:
+            node = self.__map.get(key, None)
+            if not (node is None):
+                self.__remove(node)
+
+        finally:
+            self.__lock.release()
+
+    def invalidate(self, name=None, params=None, header=None):
+        """Removes the cached responses of the method with the given name,
+        or only the one to the given parameters and header when params is
+        not None. The name can be qualified with the namespace of the method,
+        as in '{tns}name'. Without a name, the cache is cleared.
+        """
+
+        if name is None:
+            self.clear()
+            return
+
+        digest = None
+        if not (params is None):
+            digest = self.get_key(name, params, header)[1]
+
+        self.__lock.acquire()
+        try:
+            for key in self.__map.keys():
+                if (key[0] == name or key[0].endswith('}' + name)) and \
+                                          (digest is None or key[1] == digest):
+                    self.__remove(self.__map[key])
+
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__map.clear()
+            self.__list.clear()
+            self.size = 0
+
+        finally:
+            self.__lock.release()
+
+    def get_stats(self):
+        """Returns the counters of the cache as a dict."""
+
+        return {
+            'entries': len(self.__map),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,316 @@
+
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import gzip
+import httplib
+import select
+import socket
+import threading
+import time
+
+from cStringIO import StringIO
+from email.utils import formatdate
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+from hashlib import md5
+
+from soaplib.util import split_url
+
+HTTP_200 = '200 OK'
+HTTP_304 = '304 Not Modified'
+
+def gzip_string(data):
+    '''Returns the gzip-compressed data. The output doesn't depend on the
+    time of the compression, so it's the same for the same input.'''
+
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    f.write(data)
+    f.close()
+
+    return buf.getvalue()
+
+def accepts_gzip(accept_encoding):
+    '''Returns True when the given Accept-Encoding header value allows gzip
+    content coding.'''
+
+    if not accept_encoding:
+        return False
+
+    retval = False
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        if not (name in ('gzip', 'x-gzip', '*')):
+            continue
+
+        q = 1.0
+        for param in params[1:]:
+            k, sep, v = param.strip().partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+
+        if name == '*':
+            # the wildcard doesn't override an explicit gzip entry
+            retval = retval or q > 0
+
+        else:
+            return q > 0
+
+    return retval
+
+def etag_matches(if_none_match, etag):
+    '''Returns True when the given If-None-Match header value matches the etag.
+    Uses the weak comparison function, as required for If-None-Match.'''
+
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+
+        if tag.startswith('W/'):
+            tag = tag[2:]
+
+        if tag == etag:
+            return True
+
+    return False
+
+class StaticDocument(object):
+    '''
+    A document that doesn't change once generated, e.g. a wsdl or a schema
+    document. Its gzip variant, its etags and its modification date are
+    computed once, when it's created, so serving it costs no more than sending
+    the bytes.
+    '''
+
+    def __init__(self, data, content_type='text/xml'):
+        self.data = data
+        self.content_type = content_type
+
+        digest = md5(data).hexdigest()
+        self.etag = '"%s"' % digest
+
+        # the gzip variant is a different representation, so it needs its own
+        # etag.
+        self.gzip_data = gzip_string(data)
+        self.gzip_etag = '"%s-gzip"' % digest
+        if len(self.gzip_data) >= len(data):
+            self.gzip_data = None
+
+        self.last_modified = int(time.time())
+        self.last_modified_str = formatdate(self.last_modified, usegmt=True)
+
+    def is_not_modified(self, req_env, etag):
+        '''Evaluates the conditional headers of the given request.'''
+
+        if_none_match = req_env.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            # If-Modified-Since must be ignored when If-None-Match is present.
+            return etag_matches(if_none_match, etag)
+
+        if_modified_since = req_env.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            date = parsedate_tz(if_modified_since)
+            if not (date is None):
+                return self.last_modified <= mktime_tz(date)
+
+        return False
+
+    def respond(self, req_env, start_response):
+        '''Sends the document as a response to the given wsgi request. Returns
+        the wsgi response iterable.'''
+
+        data = self.data
+        etag = self.etag
+        headers = [
+            ('ETag', None),
+            ('Last-Modified', self.last_modified_str),
+            ('Vary', 'Accept-Encoding'),
+        ]
+
+        if not (self.gzip_data is None) and \
+                            accepts_gzip(req_env.get('HTTP_ACCEPT_ENCODING')):
+            data = self.gzip_data
+            etag = self.gzip_etag
+            headers.append(('Content-Encoding', 'gzip'))
+
+        headers[0] = ('ETag', etag)
+
+        if self.is_not_modified(req_env, etag):
+            start_response(HTTP_304, headers)
+            return ['']
+
+        headers.append(('Content-Type', self.content_type))
+        headers.append(('Content-Length', str(len(data))))
+        start_response(HTTP_200, headers)
+
+        return [data]
+
+class ConnectionPool(object):
+    '''
+    Keeps idle http connections around, per host, so that consecutive requests
+    to the same host don't pay for a new tcp (and tls) handshake each time.
+
+    When max_per_host is not None, the number of concurrent requests to a host
+    is limited to that number; other requests wait for their turn.
+    '''
+
+    def __init__(self, max_idle=4, timeout=None, max_per_host=None):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+
+        self.__lock = threading.Lock()
+        self.__idle = {}
+        self.__slots = {}
+
+    def get(self, scheme, host):
+        '''Returns an idle connection to the given host, or a new one.'''
+
+        while True:
+            self.__lock.acquire()
+            try:
+                connections = self.__idle.get((scheme, host), None)
+                if not connections:
+                    break
+
+                conn = connections.pop()
+
+            finally:
+                self.__lock.release()
+
+            # an idle connection has nothing to read, unless the server
+            # closed it.
+            if not (conn.sock is None) and \
+                                    select.select([conn.sock], [], [], 0)[0]:
+                conn.close()
+            else:
+                return conn
+
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def put(self, scheme, host, conn):
+        '''Gives back a connection whose response was fully read.'''
+
+        self.__lock.acquire()
+        try:
+            connections = self.__idle.setdefault((scheme, host), [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+
+        finally:
+            self.__lock.release()
+
+        conn.close()
+
+    def idle_count(self, scheme, host):
+        '''Returns the number of idle connections to the given host.'''
+
+        return len(self.__idle.get((scheme, host), ()))
+
+    def __get_slots(self, scheme, host):
+        self.__lock.acquire()
+        try:
+            slots = self.__slots.get((scheme, host), None)
+            if slots is None:
+                slots = self.__slots[(scheme, host)] = \
+                                 threading.BoundedSemaphore(self.max_per_host)
+
+            return slots
+
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        '''Closes all idle connections.'''
+
+        self.__lock.acquire()
+        try:
+            idle = self.__idle
+            self.__idle = {}
+
+        finally:
+            self.__lock.release()
+
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def request(self, method, url, body=None, headers={}):
+        '''Sends a request to the given url. Returns the response status,
+        reason, headers and body.
+
+        A request that can't be sent on a reused connection is retried once
+        on a new one, as the server may have closed the idle connection in
+        the mean time. Once it's sent, it's not retried, as the server may
+        have processed it.
+        '''
+
+        scheme, host, path = split_url(url)
+        if not path:
+            path = '/'
+
+        if self.max_per_host is None:
+            return self.__request(scheme, host, method, path, body, headers)
+
+        slots = self.__get_slots(scheme, host)
+        slots.acquire()
+        try:
+            return self.__request(scheme, host, method, path, body, headers)
+
+        finally:
+            slots.release()
+
+    def __request(self, scheme, host, method, path, body, headers):
+        for attempt in (0, 1):
+            conn = self.get(scheme, host)
+            reused = not (conn.sock is None)
+
+            try:
+                conn.request(method, path, body, headers)
+
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+
+            try:
+                response = conn.getresponse()
+                data = response.read()
+
+            except:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.put(scheme, host, conn)
+
+            return response.status, response.reason, \
+                                                response.getheaders(), data
@@ -23,13 +23,386 @@ logger = logging.getLogger(__name__)
 
 import twisted.web.server
 import twisted.web.static
+from twisted.internet import defer
+from twisted.internet import threads
+from twisted.web.resource import Resource
 from twisted.web.wsgi import WSGIResource
 from twisted.internet import reactor
+from twisted.python.failure import Failure
 
-def run_twisted(apps, port):
+from soaplib.mime import apply_mtom
+from soaplib.serializers.exception import Fault
+from soaplib.wsgi import HTTP_200
+from soaplib.wsgi import HTTP_202
+from soaplib.wsgi import HTTP_500
+from soaplib.wsgi import _reconstruct_soap_request
+
+def get_environ(request):
+    """
+    Builds a wsgi-like environment from a twisted.web request, so that the
+    application hooks and helpers that expect one can be used as is.
+    """
+
+    if request.prepath:
+        script_name = '/' + '/'.join(request.prepath)
+    else:
+        script_name = ''
+
+    if request.postpath:
+        path_info = '/' + '/'.join(request.postpath)
+    else:
+        path_info = ''
+
+    parts = request.uri.split('?', 1)
+    if len(parts) == 2:
+        query_string = parts[1]
+    else:
+        query_string = ''
+
+    if request.isSecure():
+        url_scheme = 'https'
+    else:
+        url_scheme = 'http'
+
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': query_string,
+        'CONTENT_TYPE': request.getHeader('content-type') or '',
+        'CONTENT_LENGTH': request.getHeader('content-length') or '',
+        'SERVER_NAME': request.getRequestHostname(),
+        'SERVER_PORT': str(request.getHost().port),
+        'SERVER_PROTOCOL': request.clientproto,
+        'wsgi.url_scheme': url_scheme,
+        'wsgi.input': request.content,
+        'twisted.web.request': request,
+    }
+
+    for name, values in request.requestHeaders.getAllRawHeaders():
+        name = 'HTTP_' + name.upper().replace('-', '_')
+        environ[name] = ','.join(values)
+
+    return environ
+
+class DeferredSingleFlight(object):
+    """
+    The counterpart of soaplib.util.cache.SingleFlight for code that runs in
+    the reactor thread: the first call with a given key runs the function,
+    which can return a Deferred, and the calls with the same key that are
+    made before it fires get Deferreds that fire with the same result, or
+    the same failure.
+    """
+
+    def __init__(self):
+        self.__calls = {}
+
+        self.calls = 0
+        self.collapsed = 0
+
+    def do(self, key, func, *args):
+        waiters = self.__calls.get(key, None)
+        if not (waiters is None):
+            self.collapsed += 1
+
+            retval = defer.Deferred()
+            waiters.append(retval)
+
+            return retval
+
+        self.calls += 1
+        self.__calls[key] = []
+
+        retval = defer.maybeDeferred(func, *args)
+        retval.addBoth(self.__done, key)
+
+        return retval
+
+    def __done(self, result, key):
+        for d in self.__calls.pop(key):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+        return result
+
+    def in_flight(self):
+        """Returns the number of calls in progress."""
+
+        return len(self.__calls)
+
+    def get_stats(self):
+        """Returns the counters as a dict."""
+
+        return {
+            'calls': self.calls,
+            'collapsed': self.collapsed,
+            'in_flight': self.in_flight(),
+        }
+
+class SoapResource(Resource):
+    """
+    Hosts a soaplib.wsgi.Application in the reactor thread, without going
+    through the thread pool of twisted's WSGIResource.
+
+    Service methods can return Deferreds, whose results are sent as the
+    response once they fire. This way, methods that wait for other backends
+    don't hold a thread. Request parsing and response serialization are done
+    in the reactor thread, unless the request is larger than
+    large_request_size bytes or the result is a sequence of at least
+    large_result_length items (or an iterator), in which case they're deferred
+    to a thread.
+
+    Note that the soap headers of a call are only visible as
+    self.soap_in_header and self.soap_out_header in the code that runs
+    before the method returns its Deferred, unless the application creates a
+    service instance per request, which is the default. Code that runs in
+    the callbacks should use the MethodContext of the call instead.
+
+    Identical calls to methods that are published with _coalesce=True are
+    coalesced while they're in progress, see Application.process_coalesced.
+    """
+
+    isLeaf = True
+
+    large_request_size = 64 * 1024
+    large_result_length = 1000
+
+    def __init__(self, app):
+        Resource.__init__(self)
+
+        self.app = app
+        self.flight = DeferredSingleFlight()
+
+    def render_GET(self, request):
+        # wsdl and xsd documents are precomputed, so serving them from the
+        # reactor thread is fine.
+        environ = get_environ(request)
+
+        status = []
+        def start_response(code, headers):
+            status.append((code, headers))
+
+        body = ''.join(self.app(environ, start_response))
+        code, headers = status[0]
+
+        self.__set_status(request, code, headers)
+
+        return body
+
+    def render_POST(self, request):
+        environ = get_environ(request)
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        d = self.handle_soap_request(environ)
+        d.addErrback(self.__handle_error)
+        d.addCallback(self.__write_response, request, finished)
+
+        return twisted.web.server.NOT_DONE_YET
+
+    def __set_status(self, request, code, headers):
+        code, message = code.split(' ', 1)
+        request.setResponseCode(int(code), message)
+
+        for k, v in headers:
+            request.setHeader(k, v)
+
+    def __handle_error(self, failure):
+        logger.error(failure.getTraceback())
+
+        return HTTP_500, [('Content-Type', 'text/xml')], \
+                     self.app.serialize_soap(None, Fault('Server',
+                                              str(failure.getErrorMessage())))
+
+    def __write_response(self, response, request, finished):
+        if finished:
+            # the client went away
+            return
+
+        code, headers, body = response
+
+        self.__set_status(request, code, headers)
+        request.setHeader('Content-Length', str(len(body)))
+        request.write(body)
+        request.finish()
+
+    def get_coalescing_stats(self):
+        """Returns the counters of the coalesced calls, like
+        Application.get_coalescing_stats does for wsgi servers.
+        """
+
+        return self.flight.get_stats()
+
+    def is_large_result(self, result):
+        if isinstance(result, (list, tuple)):
+            return len(result) >= self.large_result_length
+
+        return hasattr(result, 'next') and hasattr(result, '__iter__')
+
+    @defer.inlineCallbacks
+    def handle_soap_request(self, environ):
+        """Processes the soap request in the given environment. Returns a
+        Deferred that fires with a (status, headers, body) tuple.
+        """
+
+        app = self.app
+        http_resp_headers = {'Content-Type': 'text/xml'}
+
+        # implementation hook
+        app.on_call(environ)
+
+        try:
+            length = int(environ['CONTENT_LENGTH'])
+        except ValueError:
+            length = -1
+
+        if length < 0:
+            defer.returnValue((HTTP_500, http_resp_headers.items(),
+                          app.serialize_soap(None, Fault('Client',
+                                'A valid Content-Length header is required'))))
+
+        http_payload, charset, attachments = _reconstruct_soap_request(environ,
+                                                     app.attachment_spool_size)
+
+        large_request = length >= self.large_request_size
+        if large_request:
+            ctx, params = yield threads.deferToThread(self.__deserialize,
+                                         http_payload, charset, attachments)
+        else:
+            ctx, params = app.deserialize_soap(http_payload, charset,
+                                                                   attachments)
+
+        if ctx is None:
+            defer.returnValue((HTTP_500, http_resp_headers.items(),
+                                             app.serialize_soap(ctx, params)))
+
+        ctx.service.set_context(ctx)
+        try:
+            response = yield self.__respond(ctx, params, environ,
+                                                                 large_request)
+        finally:
+            # the context of the call is unbound from the reactor thread
+            # once the response is produced.
+            ctx.service.clear_context(ctx)
+
+        defer.returnValue(response)
+
+    def __deserialize(self, http_payload, charset, attachments):
+        # the call is processed by the reactor thread, so the context isn't
+        # left bound to the thread of the pool that deserialized it.
+        ctx, params = self.app.deserialize_soap(http_payload, charset,
+                                                                   attachments)
+        if not (ctx is None):
+            ctx.service.clear_context(ctx)
+
+        return ctx, params
+
+    @defer.inlineCallbacks
+    def __respond(self, ctx, params, environ, large_request):
+        app = self.app
+        http_resp_headers = {'Content-Type': 'text/xml'}
+        return_code = HTTP_200
+
+        # implementation hook
+        ctx.service.on_method_call(ctx, environ, ctx.method_name, params,
+                                                                   ctx.body_xml)
+
+        result_str = app.get_cached_response(ctx, params)
+        if not (result_str is None):
+            # implementation hook
+            app.on_return(ctx, environ, http_resp_headers, result_str)
+
+            defer.returnValue((return_code, http_resp_headers.items(),
+                                                                   result_str))
+
+        if app.is_async(ctx):
+            result_raw = app.submit_request(ctx, params)
+
+            if result_raw is None:
+                # implementation hook
+                app.on_return(ctx, environ, http_resp_headers, '')
+
+                defer.returnValue((HTTP_202, http_resp_headers.items(), ''))
+
+        elif app.is_coalesced(ctx):
+            result_raw, result_str = yield self.flight.do(
+                                   app.get_coalescing_key(ctx, params),
+                                   self.__process_and_serialize, ctx, params,
+                                   large_request)
+
+        else:
+            result_raw = app.process_request(ctx, params)
+
+        result_raw = yield self.__get_result(result_raw)
+
+        if isinstance(result_raw, Exception):
+            return_code = HTTP_500
+
+        # implementation hook
+        ctx.service.on_method_return(ctx, environ, result_raw, ctx.body_xml,
+                                                              http_resp_headers)
+
+        if result_str is None:
+            result_str = yield self.__serialize(ctx, result_raw, large_request)
+
+        # implementation hook
+        app.on_return(ctx, environ, http_resp_headers, result_str)
+
+        if ctx.descriptor.mtom:
+            http_resp_headers, result_str = apply_mtom(http_resp_headers,
+                    result_str, ctx.descriptor.out_message._type_info,
+                    [result_raw])
+
+        defer.returnValue((return_code, http_resp_headers.items(), result_str))
+
+    @defer.inlineCallbacks
+    def __get_result(self, result_raw):
+        # waits for the Deferreds that service methods return.
+        if isinstance(result_raw, defer.Deferred):
+            try:
+                result_raw = yield result_raw
+
+            except Fault, e:
+                result_raw = e
+
+            except Exception, e:
+                logger.exception(e)
+                result_raw = Fault('Server', str(e))
+
+        defer.returnValue(result_raw)
+
+    @defer.inlineCallbacks
+    def __serialize(self, ctx, result_raw, large_request):
+        app = self.app
+
+        if large_request or self.is_large_result(result_raw):
+            result_str = yield threads.deferToThread(app.serialize_soap, ctx,
+                                                                     result_raw)
+        else:
+            result_str = app.serialize_soap(ctx, result_raw)
+
+        app.cache_response(ctx, result_raw, result_str)
+
+        defer.returnValue(result_str)
+
+    @defer.inlineCallbacks
+    def __process_and_serialize(self, ctx, params, large_request):
+        result_raw = yield self.__get_result(self.app.process_request(ctx,
+                                                                     params))
+        result_str = yield self.__serialize(ctx, result_raw, large_request)
+
+        defer.returnValue((result_raw, result_str))
+
+def run_twisted(apps, port, use_threads=True):
     """
     takes a list of tuples containing application, url pairs, and a port to
     to listen to.
+
+    When use_threads is False, the applications are hosted by SoapResource
+    instead of twisted's WSGIResource.
     """
 
     static_dir = os.path.abspath(".")
@@ -37,7 +410,11 @@ def run_twisted(apps, port):
     root = twisted.web.static.File(static_dir)
 
     for app,url in apps:
-        resource = WSGIResource(reactor, reactor, app)
+        if use_threads:
+            resource = WSGIResource(reactor, reactor, app)
+        else:
+            resource = SoapResource(app)
+
         logging.info("registering %r on /%s" % (app, url))
         root.putChild(url, resource)
 
@@ -0,0 +1,389 @@
+
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from soaplib.util.cache import get_canonical_key
+
+_MAGIC = 'soaplib-shared-cache-1'
+
+# magic, slot size, ways, number of sets, sets and evictions counters
+_HEADER = struct.Struct('<24sIIIQQ')
+_HEADER_SIZE = 64
+
+# seq, name hash, stored, expires, key digest, parameters digest, value
+# length. seq is odd while the slot is being written.
+_SEQ = struct.Struct('<I')
+_SLOT = struct.Struct('<IIdd20s20sI')
+
+_EMPTY = '\0' * 20
+
+# how many times a read is retried when it overlaps with a write.
+_READ_RETRIES = 3
+
+def _name_hash(name):
+    # names are matched by their local part, see SharedResponseCache.invalidate
+    return zlib.crc32(name.split('}')[-1]) & 0xffffffff
+
+def _digest(value):
+    return hashlib.sha1(repr(value)).digest()
+
+class SharedResponseCache(object):
+    """
+    A response cache that's shared by all the processes that open the same
+    file, e.g. the preforked workers of a wsgi server. It has the interface of
+    soaplib.util.cache.ResponseCache, so it can be passed to the rpc
+    decorator as _cache, or set as the response_cache of an Application.
+
+    The file is memory-mapped, and holds a hash table of size bytes, made of
+    sets of ways slots of slot_size bytes. A response goes to one of the slots
+    of the set its key hashes to. When they're all taken, the oldest entry of
+    the set is evicted. Responses larger than a slot are not cached. That
+    includes the wsdl documents that an Application stores in its
+    response_cache, which are usually larger than the default slot_size:
+    it has to be raised for them to be shared.
+
+    The file must be new or empty, or have been created with the same size,
+    slot_size and ways, otherwise ValueError is raised.
+
+    Reads take no locks: every slot has a sequence number that writers make
+    odd while they're writing, so a read that overlaps with a write is
+    detected and retried. Writes lock the set they write to, with fcntl
+    between processes and with a lock between the threads of a process.
+
+    The hits and misses counters are those of the current process, the sets
+    and evictions counters are shared.
+    """
+
+    def __init__(self, path, size=64 * 1024 * 1024, slot_size=16 * 1024,
+                                                            ways=4, ttl=None):
+        assert slot_size > _SLOT.size and ways > 0
+
+        self.path = path
+        self.slot_size = slot_size
+        self.ways = ways
+        self.ttl = ttl
+
+        self.set_count = max(1, (size - _HEADER_SIZE) // (slot_size * ways))
+        self.capacity = slot_size - _SLOT.size
+
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = threading.Lock()
+
+        length = _HEADER_SIZE + self.set_count * ways * slot_size
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+
+        try:
+            fcntl.lockf(self.__fd, fcntl.LOCK_EX)
+            try:
+                self.__map = self.__map_file(path, length)
+            finally:
+                fcntl.lockf(self.__fd, fcntl.LOCK_UN)
+
+        except:
+            os.close(self.__fd)
+            raise
+
+    def __map_file(self, path, length):
+        expected = (_MAGIC, self.slot_size, self.ways, self.set_count)
+
+        if os.fstat(self.__fd).st_size == 0:
+            os.ftruncate(self.__fd, length)
+            os.write(self.__fd, _HEADER.pack(*(expected + (0, 0))))
+
+        else:
+            # the file may be mapped by other processes, so it can't be
+            # reset: they'd be killed by SIGBUS on their next access.
+            header = os.read(self.__fd, _HEADER.size)
+            if len(header) == _HEADER.size:
+                # the magic is unpacked with its padding
+                magic, slot_size, ways, set_count = _HEADER.unpack(header)[:4]
+                header = (magic.rstrip('\0'), slot_size, ways, set_count)
+
+            if header != expected or os.fstat(self.__fd).st_size < length:
+                raise ValueError('%s is not a shared cache file of this size, '
+                                 'slot size and number of ways' % path)
+
+        return mmap.mmap(self.__fd, length, mmap.MAP_SHARED,
+                                            mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def close(self):
+        self.__map.close()
+        os.close(self.__fd)
+
+    def __get_set(self, digest):
+        index = struct.unpack_from('<I', digest)[0] % self.set_count
+        return _HEADER_SIZE + index * self.ways * self.slot_size
+
+    def __lock_range(self, start, length):
+        self.__lock.acquire()
+        try:
+            fcntl.lockf(self.__fd, fcntl.LOCK_EX, length, start)
+        except:
+            self.__lock.release()
+            raise
+
+    def __unlock_range(self, start, length):
+        try:
+            fcntl.lockf(self.__fd, fcntl.LOCK_UN, length, start)
+        finally:
+            self.__lock.release()
+
+    def __read(self, offset, digest):
+        """Returns the value in the slot at the given offset when it's the
+        one of the given key digest and it hasn't expired. Returns None
+        otherwise.
+        """
+
+        m = self.__map
+
+        for i in range(_READ_RETRIES):
+            seq = _SEQ.unpack_from(m, offset)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+
+            seq, name, stored, expires, slot_digest, params, length = \
+                                                     _SLOT.unpack_from(m, offset)
+            if seq & 1:
+                continue
+
+            if slot_digest != digest:
+                return None
+
+            if length > self.capacity:
+                continue # torn read
+
+            start = offset + _SLOT.size
+            value = m[start:start + length]
+
+            if _SEQ.unpack_from(m, offset)[0] != seq:
+                continue
+
+            if expires and expires <= time.time():
+                return None
+
+            return value
+
+        return None
+
+    def __write(self, offset, name, expires, digest, params, value):
+        m = self.__map
+
+        seq = _SEQ.unpack_from(m, offset)[0]
+        _SEQ.pack_into(m, offset, (seq + 1) & 0xffffffff)
+
+        start = offset + _SLOT.size
+        m[start:start + len(value)] = value
+        _SLOT.pack_into(m, offset, (seq + 1) & 0xffffffff, name, time.time(),
+                                      expires, digest, params, len(value))
+
+        _SEQ.pack_into(m, offset, (seq + 2) & 0xffffffff)
+
+    def get_key(self, name, params, header=None):
+        return get_canonical_key(name, params, header)
+
+    def get(self, key):
+        """Returns the cached response for the given key, or None."""
+
+        digest = _digest(key)
+        set_offset = self.__get_set(digest)
+
+        for way in range(self.ways):
+            retval = self.__read(set_offset + way * self.slot_size, digest)
+            if not (retval is None):
+                self.hits += 1
+                return retval
+
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        """Stores the given response. The key is one that's returned by
+        get_key, or a (name, value) tuple.
+        """
+
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        if len(value) > self.capacity:
+            return
+
+        digest = _digest(key)
+        set_offset = self.__get_set(digest)
+        set_size = self.ways * self.slot_size
+
+        if self.ttl is None:
+            expires = 0.0
+        else:
+            expires = time.time() + self.ttl
+
+        self.__lock_range(set_offset, set_size)
+        try:
+            now = time.time()
+            target = None
+            free = None
+            oldest = None
+            evicted = False
+
+            # the slot of the same key is reused first, then a free one.
+            for way in range(self.ways):
+                offset = set_offset + way * self.slot_size
+                seq, name, stored, slot_expires, slot_digest, params, \
+                                  length = _SLOT.unpack_from(self.__map, offset)
+
+                if slot_digest == digest:
+                    target = offset
+                    break
+
+                if free is None and (slot_digest == _EMPTY or
+                                    (slot_expires and slot_expires <= now)):
+                    free = offset
+
+                if oldest is None or stored < oldest[0]:
+                    oldest = (stored, offset)
+
+            if target is None:
+                target = free
+
+            if target is None:
+                target = oldest[1]
+                evicted = True
+
+            self.__write(target, _name_hash(key[0]), expires, digest,
+                                                        _digest(key[1]), value)
+            self.__count(evicted)
+
+        finally:
+            self.__unlock_range(set_offset, set_size)
+
+    def __count(self, evicted):
+        # the counters are updated under the lock of the set, so concurrent
+        # writers to other sets can lose increments. they're statistics.
+        magic, slot_size, ways, set_count, sets, evictions = \
+                                           _HEADER.unpack_from(self.__map, 0)
+        if evicted:
+            evictions += 1
+
+        _HEADER.pack_into(self.__map, 0, magic, slot_size, ways, set_count,
+                                                          sets + 1, evictions)
+
+    def __clear_slots(self, match):
+        """Empties the slots for which match(name hash, parameters digest) is
+        true, locking one set at a time."""
+
+        set_size = self.ways * self.slot_size
+
+        for i in range(self.set_count):
+            set_offset = _HEADER_SIZE + i * set_size
+
+            self.__lock_range(set_offset, set_size)
+            try:
+                for way in range(self.ways):
+                    offset = set_offset + way * self.slot_size
+                    seq, name, stored, expires, digest, params, length = \
+                                            _SLOT.unpack_from(self.__map, offset)
+
+                    if digest != _EMPTY and match(name, params):
+                        self.__write(offset, 0, 0.0, _EMPTY, _EMPTY, '')
+
+            finally:
+                self.__unlock_range(set_offset, set_size)
+
+    def delete(self, key):
+        digest = _digest(key)
+        set_offset = self.__get_set(digest)
+        set_size = self.ways * self.slot_size
+
+        self.__lock_range(set_offset, set_size)
+        try:
+            for way in range(self.ways):
+                offset = set_offset + way * self.slot_size
+                if _SLOT.unpack_from(self.__map, offset)[4] == digest:
+                    self.__write(offset, 0, 0.0, _EMPTY, _EMPTY, '')
+
+        finally:
+            self.__unlock_range(set_offset, set_size)
+
+    def invalidate(self, name=None, params=None, header=None):
+        """Removes the cached responses of the method with the given name,
+        or only the one to the given parameters and header when params is
+        not None. Without a name, the cache is cleared.
+
+        Unlike ResponseCache, entries are matched by the local part of the
+        method name, so the methods with the same name in other namespaces
+        are invalidated as well.
+        """
+
+        if name is None:
+            self.clear()
+            return
+
+        name_hash = _name_hash(name)
+
+        if params is None:
+            self.__clear_slots(lambda n, p: n == name_hash)
+
+        else:
+            digest = _digest(self.get_key(name, params, header)[1])
+            self.__clear_slots(lambda n, p: n == name_hash and p == digest)
+
+    def clear(self):
+        self.__clear_slots(lambda n, p: True)
+
+    def __len__(self):
+        return self.get_stats()['entries']
+
+    def get_stats(self):
+        """Returns the counters of the cache as a dict. The number of entries
+        and their size are counted by scanning the whole table.
+        """
+
+        entries = 0
+        size = 0
+        now = time.time()
+
+        for i in range(self.set_count * self.ways):
+            offset = _HEADER_SIZE + i * self.slot_size
+            seq, name, stored, expires, digest, params, length = \
+                                            _SLOT.unpack_from(self.__map, offset)
+
+            if digest != _EMPTY and not (expires and expires <= now):
+                entries += 1
+                size += length
+
+        sets, evictions = _HEADER.unpack_from(self.__map, 0)[4:]
+
+        return {
+            'entries': entries,
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'sets': sets,
+            'evictions': evictions,
+        }
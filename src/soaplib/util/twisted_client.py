@@ -0,0 +1,74 @@
+
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+from StringIO import StringIO
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.web.client import Agent
+from twisted.web.client import FileBodyProducer
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.client import readBody
+from twisted.web.http_headers import Headers
+
+from soaplib.client import ServiceClientBase
+
+class TwistedServiceClient(ServiceClientBase):
+    '''
+    The twisted counterpart of soaplib.client.ServiceClient: the methods of
+    the service return Deferreds that fire with the results of the calls.
+    Requests are sent over persistent connections, at most max_per_host at a
+    time.
+    '''
+
+    def __init__(self, url, service, tns=None, max_per_host=4, pool=None,
+                                                             reactor=reactor):
+        ServiceClientBase.__init__(self, url, service, tns)
+
+        if pool is None:
+            pool = HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost = max_per_host
+
+        self.pool = pool
+        self.agent = Agent(reactor, pool=pool)
+        self.__slots = defer.DeferredSemaphore(max_per_host)
+
+    def call(self, descriptor, *args, **kwargs):
+        data, headers = self.serialize_request(descriptor, args, kwargs)
+        headers = Headers(dict([(k, [v]) for k, v in headers.items()]))
+
+        return self.__slots.run(self.__request, descriptor, data, headers)
+
+    def __request(self, descriptor, data, headers):
+        d = self.agent.request('POST', self.url, headers,
+                                               FileBodyProducer(StringIO(data)))
+        d.addCallback(self.__read_response, descriptor)
+
+        return d
+
+    def __read_response(self, response, descriptor):
+        d = readBody(response)
+        d.addCallback(lambda data: self.deserialize_response(descriptor,
+                                                          response.code, data))
+        return d
+
+    def close(self):
+        '''Closes the idle connections. Returns a Deferred.'''
+
+        return self.pool.closeCachedConnections()
@@ -0,0 +1,229 @@
+
+#
+# soaplib - Copyright (C) Soaplib contributors.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#
+
+import logging
+logger = logging.getLogger(__name__)
+
+import httplib
+import socket
+import threading
+import time
+
+from Queue import Full
+from Queue import Queue
+
+from soaplib.serializers.exception import Fault
+from soaplib.util.cache import LRUCache
+from soaplib.util.http import ConnectionPool
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_DELIVERED = 'delivered'
+STATE_FAILED = 'failed'
+
+class DeliveryError(Exception):
+    pass
+
+class AsyncEngine(object):
+    '''
+    Runs the asynchronous (_is_async) operations of an application on a pool
+    of worker threads, and delivers their results to the callback endpoints
+    of the callers.
+
+    The number of pending calls is bounded by max_pending. When the queue is
+    full, new calls are rejected with a 'Server.Busy' fault, after waiting at
+    most submit_timeout seconds for a free slot, so that a burst of requests
+    can't use up the memory of the server.
+
+    Callbacks are posted using pooled keep-alive connections. Deliveries that
+    fail because of a network error or of a 502, 503 or 504 response are
+    retried max_retries times, waiting retry_delay seconds before the first
+    retry and twice as long before each subsequent one.
+
+    The state of the last correlation_size calls can be queried using their
+    MessageID.
+    '''
+
+    retry_statuses = (502, 503, 504)
+
+    def __init__(self, workers=4, max_pending=64, submit_timeout=0,
+                    max_retries=3, retry_delay=0.5, timeout=30,
+                    correlation_size=1024):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self.connection_pool = ConnectionPool(max_idle=workers, timeout=timeout)
+        self.correlations = LRUCache(correlation_size)
+
+        self.__queue = Queue(max_pending)
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__stats = {
+            'active': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'retries': 0,
+        }
+
+    def __incr(self, name, value=1):
+        self.__lock.acquire()
+        try:
+            self.__stats[name] += value
+        finally:
+            self.__lock.release()
+
+    def start(self):
+        '''Starts the worker threads. Called by the first submit().'''
+
+        self.__lock.acquire()
+        try:
+            while len(self.__threads) < self.workers:
+                t = threading.Thread(target=self.__run)
+                t.setDaemon(True)
+                t.start()
+
+                self.__threads.append(t)
+
+        finally:
+            self.__lock.release()
+
+    def shutdown(self, wait=True):
+        '''Stops the worker threads once the pending calls are processed.'''
+
+        self.__lock.acquire()
+        try:
+            threads = self.__threads
+            self.__threads = []
+
+        finally:
+            self.__lock.release()
+
+        for t in threads:
+            self.__queue.put(None)
+
+        if wait:
+            for t in threads:
+                t.join()
+
+        self.connection_pool.close()
+
+    def submit(self, message_id, func, *args):
+        '''Queues the func(*args) call, to be run by a worker thread. Raises
+        a Server.Busy fault when there are too many pending calls.
+        '''
+
+        if len(self.__threads) < self.workers:
+            self.start()
+
+        # the state is set first, as a worker can pick the call up and
+        # update it before put returns.
+        self.correlations.set(message_id, STATE_QUEUED)
+
+        try:
+            self.__queue.put((message_id, func, args),
+                      self.submit_timeout > 0, self.submit_timeout or None)
+
+        except Full:
+            self.correlations.delete(message_id)
+            self.__incr('rejected')
+            raise Fault('Server.Busy', 'Too many pending requests, please '
+                                                              'try again later')
+
+    def __run(self):
+        while True:
+            job = self.__queue.get()
+            if job is None:
+                break
+
+            message_id, func, args = job
+
+            self.correlations.set(message_id, STATE_RUNNING)
+            self.__incr('active')
+
+            try:
+                func(*args)
+
+            except Exception, e:
+                logger.exception(e)
+                self.correlations.set(message_id, STATE_FAILED)
+                self.__incr('failed')
+
+            else:
+                self.correlations.set(message_id, STATE_DELIVERED)
+                self.__incr('completed')
+
+            self.__incr('active', -1)
+
+    def post(self, url, body, headers):
+        '''Posts the given callback message, retrying as necessary. Raises
+        DeliveryError when it can't be delivered.
+        '''
+
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.__incr('retries')
+                time.sleep(delay)
+                delay *= 2
+
+            try:
+                status, reason, resp_headers, data = \
+                       self.connection_pool.request('POST', url, body, headers)
+
+            except (socket.error, httplib.HTTPException), e:
+                error = '%s: %s' % (url, e)
+                continue
+
+            if 200 <= status < 300:
+                return
+
+            error = '%s: %d %s' % (url, status, reason)
+            if not (status in self.retry_statuses):
+                break
+
+        raise DeliveryError(error)
+
+    def get_status(self, message_id):
+        '''Returns the state of the call with the given MessageID, one of the
+        STATE_* constants, or None when it's not known.
+        '''
+
+        return self.correlations.get(message_id)
+
+    def get_stats(self):
+        '''Returns a dict with the current queue depth and the call counters
+        of the engine.
+        '''
+
+        self.__lock.acquire()
+        try:
+            retval = dict(self.__stats)
+
+        finally:
+            self.__lock.release()
+
+        retval['queued'] = self.__queue.qsize()
+        retval['workers'] = len(self.__threads)
+        retval['max_pending'] = self.max_pending
+
+        return retval
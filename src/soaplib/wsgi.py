@@ -23,43 +23,117 @@ logger = logging.getLogger(__name__)
 import cgi
 import traceback
 
+from types import GeneratorType
+
 import soaplib
 
 from soaplib.serializers.exception import Fault
 
 from soaplib.mime import apply_mtom
-from soaplib.mime import collapse_swa
+from soaplib.mime import parse_mtom
+from soaplib.util import normalize_url
 from soaplib.util import reconstruct_url
+from soaplib.util.cache import LRUCache
+from soaplib.util.http import StaticDocument
 
 HTTP_500 = '500 Internal server error'
 HTTP_200 = '200 OK'
+HTTP_202 = '202 Accepted'
+HTTP_404 = '404 Not Found'
 HTTP_405 = '405 Method Not Allowed'
 
 class ValidationError(Fault):
     pass
 
-def _reconstruct_soap_request(http_env):
+class _InputStream(object):
+    """
+    File-like wrapper that prevents reading wsgi.input past CONTENT_LENGTH,
+    which may block on some servers.
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return ''
+
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+
+        return data
+
+def _stream_response(ctx, first_chunk, chunks, native_obj):
+    """
+    Yields the chunks of a streamed response. The response object, when it's
+    e.g. a generator or a database cursor, is closed when the wsgi server is
+    done with the response, even when the client disconnects early. That's
+    also when the context of the call is unbound from the thread.
+    """
+
+    try:
+        yield first_chunk
+        for chunk in chunks:
+            yield chunk
+
+    except Exception, e:
+        # the response is already under way, so the best we can do is to log
+        # the error and to cut the response short.
+        logger.exception(e)
+        raise
+
+    finally:
+        try:
+            _close(native_obj)
+
+        finally:
+            ctx.service.clear_context(ctx)
+
+def _close(native_obj):
+    # generators and e.g. database cursors have a close method.
+    close = getattr(native_obj, 'close', None)
+    if callable(close):
+        close()
+
+def _reconstruct_soap_request(http_env, spool_size=1024 * 1024):
     """
-    Reconstruct http payload using information in the http header
+    Reconstruct http payload using information in the http header. Plain soap
+    requests are returned as a file-like object that is parsed as it's read,
+    multipart ones are read in chunks and split into the file object of the
+    soap envelope and the dict of the file objects of their attachments,
+    which are spooled to disk past spool_size bytes. Returns a
+    (payload, charset, attachments) tuple.
     """
 
     input = http_env.get('wsgi.input')
-    length = http_env.get("CONTENT_LENGTH")
-    http_payload = input.read(int(length))
+    length = int(http_env.get("CONTENT_LENGTH"))
 
     # fyi, here's what the parse_header function returns:
     # >>> import cgi; cgi.parse_header("text/xml; charset=utf-8")
     # ('text/xml', {'charset': 'utf-8'})
     content_type = cgi.parse_header(http_env.get("CONTENT_TYPE"))
     charset = content_type[1].get('charset',None)
-    if charset is None:
-        charset = 'ascii'
 
-    return collapse_swa(content_type, http_payload), charset
+    if 'multipart/related' in content_type[0]:
+        envelope, attachments = parse_mtom(content_type,
+                                 _InputStream(input, length), spool_size)
+        return envelope, charset, attachments
+
+    return _InputStream(input, length), charset, None
 
 class Application(soaplib.Application):
     transport = 'http://schemas.xmlsoap.org/soap/http'
 
+    def __init__(self, *args, **kwargs):
+        soaplib.Application.__init__(self, *args, **kwargs)
+
+        self.__wsdl_documents = LRUCache(self.wsdl_cache_size)
+        self.__xsd_documents = None
+
     def __call__(self, req_env, start_response, wsgi_url=None):
         '''
         This method conforms to the WSGI spec for callable wsgi applications
@@ -80,6 +154,9 @@ class Application(soaplib.Application):
         if self.__is_wsdl_request(req_env):
             return self.__handle_wsdl_request(req_env, start_response, url)
 
+        elif self.__is_xsd_request(req_env):
+            return self.__handle_xsd_request(req_env, start_response)
+
         elif req_env['REQUEST_METHOD'].lower() != 'post':
             start_response(HTTP_405, [('Allow', 'POST')])
             return ['']
@@ -100,17 +177,25 @@ class Application(soaplib.Application):
             )
         )
 
+    def __is_xsd_request(self, req_env):
+        # the schema documents are served next to the service, as the wsdl
+        # imports them using relative urls: /stuff/stuff/stuff/sN.xsd
+
+        return (
+                req_env['REQUEST_METHOD'].lower() == 'get'
+            and req_env['PATH_INFO'].endswith('.xsd')
+        )
+
     def __handle_wsdl_request(self, req_env, start_response, url):
         http_resp_headers = {'Content-Type': 'text/xml'}
 
         try:
-            self.get_wsdl(url)
-            self.on_wsdl(req_env, self.__wsdl) # implementation hook
+            document = self.__wsdl_documents.get_or_create(normalize_url(url),
+                                       lambda: StaticDocument(self.get_wsdl(url)))
 
-            http_resp_headers['Content-Length'] = str(len(self.__wsdl))
-            start_response(HTTP_200, http_resp_headers.items())
+            self.on_wsdl(req_env, document.data) # implementation hook
 
-            return [self.__wsdl]
+            return document.respond(req_env, start_response)
 
         except Exception, e:
             logger.error(traceback.format_exc())
@@ -122,46 +207,133 @@ class Application(soaplib.Application):
 
             return [""]
 
+    def __handle_xsd_request(self, req_env, start_response):
+        if self.__xsd_documents is None:
+            self.__xsd_documents = dict([
+                (k, StaticDocument(v))
+                        for k, v in self.get_schema_documents().items()
+            ])
+
+        file_name = req_env['PATH_INFO'].rsplit('/', 1)[-1]
+        document = self.__xsd_documents.get(file_name, None)
+
+        if document is None:
+            start_response(HTTP_404, [('Content-Length', '0')])
+            return ['']
+
+        return document.respond(req_env, start_response)
+
     def __handle_soap_request(self, req_env, start_response):
+        # implementation hook
+        self.on_call(req_env)
+
+        http_payload, charset, attachments = _reconstruct_soap_request(req_env,
+                                                    self.attachment_spool_size)
+
+        ctx, params = self.deserialize_soap(http_payload, charset, attachments)
+
+        retval = None
+        try:
+            retval = self.__respond(ctx, params, req_env, start_response)
+            return retval
+
+        finally:
+            # the context of a call is unbound from the thread once the
+            # response is produced, or once it's sent when it's streamed.
+            if not (ctx is None or isinstance(retval, GeneratorType)):
+                ctx.service.clear_context(ctx)
+
+    def __respond(self, ctx, params, req_env, start_response):
         http_resp_headers = {
             'Content-Type': 'text/xml',
             'Content-Length': '0',
         }
         return_code = HTTP_200
-        method_name = None
-
-        # implementation hook
-        self.on_call(req_env)
-
-        http_payload, charset = _reconstruct_soap_request(req_env)
-
-        service, params = self.deserialize_soap(http_payload, charset)
 
-        if service is None:
-            result_str = self.serialize_soap(service, params)
+        if ctx is None:
+            result_str = self.serialize_soap(ctx, params)
             return_code = HTTP_500
 
         else:
             # implementation hook
-            service.on_method_call(req_env,method_name,params,service.body_xml)
+            ctx.service.on_method_call(ctx, req_env, ctx.method_name, params,
+                                                                   ctx.body_xml)
 
-            result_raw = self.process_request(service, params)
+            result_str = self.get_cached_response(ctx, params)
+            if not (result_str is None):
+                # implementation hook
+                self.on_return(ctx, req_env, http_resp_headers, result_str)
+
+                http_resp_headers['Content-Length'] = str(len(result_str))
+                start_response(return_code, http_resp_headers.items())
+
+                return [result_str]
+
+            if self.is_async(ctx):
+                result_raw = self.submit_request(ctx, params)
+
+                if result_raw is None:
+                    # the call is acknowledged, its result is delivered to
+                    # the callback endpoint of the client.
+                    self.on_return(ctx, req_env, http_resp_headers, '')
+
+                    start_response(HTTP_202, http_resp_headers.items())
+                    return ['']
+
+            elif self.is_coalesced(ctx):
+                result_raw, result_str = self.process_coalesced(ctx, params)
+
+            else:
+                result_raw = self.process_request(ctx, params)
 
             if isinstance(result_raw, Exception):
                 return_code = HTTP_500
 
             # implementation hook
-            service.on_method_return(req_env, result_raw, service.body_xml,
-                                                              http_resp_headers)
+            ctx.service.on_method_return(ctx, req_env, result_raw,
+                                           ctx.body_xml, http_resp_headers)
+
+            if not (result_str is None):
+                pass # the response of a coalesced call is already serialized
+
+            elif self.is_streaming(ctx, result_raw):
+                try:
+                    # serializing the first chunk before starting the response
+                    # lets errors in the envelope itself, or in the first
+                    # items of a generator, become soap faults.
+                    result_iter = iter(self.serialize_soap_stream(ctx,
+                                                                   result_raw))
+                    first_chunk = result_iter.next()
+
+                except Exception, e:
+                    logger.exception(e)
+                    _close(result_raw)
+
+                    result_str = self.serialize_soap(ctx,
+                                                       Fault('Server', str(e)))
+                    return_code = HTTP_500
+
+                else:
+                    # implementation hook
+                    self.on_return(ctx, req_env, http_resp_headers, None)
+
+                    # the length of the response is not known in advance
+                    del http_resp_headers['Content-Length']
+                    start_response(return_code, http_resp_headers.items())
+
+                    return _stream_response(ctx, first_chunk, result_iter,
+                                                                    result_raw)
 
-            result_str = self.serialize_soap(service, result_raw)
+            else:
+                result_str = self.serialize_soap(ctx, result_raw)
+                self.cache_response(ctx, result_raw, result_str)
 
             # implementation hook
-            self.on_return(req_env, http_resp_headers, result_str)
+            self.on_return(ctx, req_env, http_resp_headers, result_str)
 
-            if service.descriptor.mtom:
+            if ctx.descriptor.mtom:
                 http_resp_headers, result_str = apply_mtom(http_resp_headers,
-                        result_str, service.descriptor.out_message._type_info,
+                        result_str, ctx.descriptor.out_message._type_info,
                         [result_raw])
 
         # initiate the response
@@ -193,12 +365,14 @@ class Application(soaplib.Application):
         '''
         pass
 
-    def on_return(self, environ, http_headers, return_str):
+    def on_return(self, ctx, environ, http_headers, return_str):
         '''Called before the application returns
 
+        @param the MethodContext of the call
         @param the wsgi environment
         @param http response headers as dict
-        @param return string of the soap request
+        @param return string of the soap request, None when the response is
+               streamed
         '''
         pass
 